@@ -1,13 +1,65 @@
 import logging
 import requests
-from flask import Blueprint, request
+from flask import Blueprint, Response, request
 from flask_jsonpify import jsonpify
 from auth.lib import Verifyer
+from werkzeug.exceptions import BadRequest, Forbidden
 
 from .models import FlowRegistry
 
-from .controllers import upload, info
-from .config import auth_server, db_connection_string
+from .controllers import upload, upload_batch, conditional_info, batch_info, metrics, poll_events, EventStream
+from .controllers import list_datasets, list_revisions, outbox_dispatcher
+from . import codec
+from .config import auth_server, db_connection_string, event_poll_timeout
+
+
+def request_token():
+    return request.headers.get('auth-token') or request.values.get('jwt')
+
+
+def required_arg(name):
+    value = request.args.get(name)
+    if not value:
+        raise BadRequest('Missing %s' % name)
+    return value
+
+
+def authorized_owner(verifyer):
+    """The `owner` argument, when the request's token belongs to them."""
+    owner = required_arg('owner')
+    permissions = verifyer.extract_permissions(request_token())
+    if not permissions or permissions.get('userid') != owner:
+        raise Forbidden('No token or token not authorised for owner')
+    return owner
+
+
+def split_fields(fields):
+    """A comma separated `fields` selection as a list, or None for all."""
+    if isinstance(fields, str):
+        fields = fields.split(',') if fields else None
+    return fields
+
+
+def info_args():
+    return dict(if_none_match=request.if_none_match,
+                fields=split_fields(request.args.get('fields')),
+                pipelines_status=request.args.get('pipelines_status'),
+                pipelines_after=request.args.get('pipelines_after'),
+                pipelines_limit=request.args.get('pipelines_limit', type=int))
+
+
+def wants_event_stream():
+    return request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) == \
+        'text/event-stream'
+
+
+def events_since(stream):
+    """The cursor to send events after: SSE clients reconnect with a
+    Last-Event-ID header."""
+    since = request.args.get('since', type=int)
+    if since is None and stream:
+        since = request.headers.get('Last-Event-ID', type=int)
+    return since
 
 
 def make_blueprint():
@@ -16,27 +68,85 @@ def make_blueprint():
 
     verifyer = Verifyer(auth_endpoint=f'http://{auth_server}/auth/public-key')
     registry = FlowRegistry(db_connection_string)
+    outbox_dispatcher(registry).start()
 
     # Create instance
     blueprint = Blueprint('flowmanager', 'flowmanager')
 
     # Controller Proxies
     upload_controller = upload
-    info_controller = info
+    upload_batch_controller = upload_batch
+    info_controller = conditional_info
+    batch_info_controller = batch_info
+    list_datasets_controller = list_datasets
+    list_revisions_controller = list_revisions
+    metrics_controller = metrics
+    poll_events_controller = poll_events
+    event_stream_controller = EventStream
 
     def upload_():
-        token = request.headers.get('auth-token') or request.values.get('jwt')
         contents = request.get_json()
-        return jsonpify(upload_controller(token, contents, registry, verifyer))
+        return jsonpify(upload_controller(request_token(), contents, registry, verifyer))
+
+    def upload_batch_():
+        specs = request.get_json()
+        return jsonpify(upload_batch_controller(request_token(), specs, registry, verifyer))
 
     def info_(owner, dataset, revision):
-        return jsonpify(info_controller(owner, dataset, revision, registry))
+        etag, resp = info_controller(owner, dataset, revision, registry, **info_args())
+        response = Response(status=304) if resp is None else jsonpify(resp)
+        response.set_etag(etag)
+        return response
+
+    def list_datasets_():
+        return jsonpify(list_datasets_controller(authorized_owner(verifyer), registry,
+                                                 after=request.args.get('after'),
+                                                 limit=request.args.get('limit', type=int)))
+
+    def list_revisions_():
+        owner = authorized_owner(verifyer)
+        return jsonpify(list_revisions_controller(owner, required_arg('dataset'), registry,
+                                                  after=request.args.get('after', type=int),
+                                                  limit=request.args.get('limit', type=int),
+                                                  state=request.args.get('state')))
+
+    def batch_info_():
+        body = request.get_json() or {}
+        responses = batch_info_controller(body.get('datasets'), registry,
+                                          fields=split_fields(body.get('fields')))
+        return Response(codec.iterdumps(responses), mimetype='application/json')
+
+    def events_(owner, dataset, revision):
+        stream = wants_event_stream()
+        since = events_since(stream)
+        if stream:
+            stream = event_stream_controller(owner, dataset, revision, registry, since=since)
+            return Response(stream, mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        timeout = request.args.get('timeout', event_poll_timeout, type=float)
+        return jsonpify(poll_events_controller(owner, dataset, revision, registry,
+                                               since=since, timeout=timeout))
+
+    def metrics_():
+        return jsonpify(metrics_controller(registry))
 
     # Register routes
     blueprint.add_url_rule(
         'upload', 'upload', upload_, methods=['POST'])
+    blueprint.add_url_rule(
+        'upload/batch', 'upload_batch', upload_batch_, methods=['POST'])
+    blueprint.add_url_rule(
+        'datasets', 'list_datasets', list_datasets_, methods=['GET'])
+    blueprint.add_url_rule(
+        'revisions', 'list_revisions', list_revisions_, methods=['GET'])
     blueprint.add_url_rule(
         '<owner>/<dataset>/<revision>', 'info', info_, methods=['GET'])
+    blueprint.add_url_rule(
+        'info', 'batch_info', batch_info_, methods=['POST'])
+    blueprint.add_url_rule(
+        '<owner>/<dataset>/<revision>/events', 'events', events_, methods=['GET'])
+    blueprint.add_url_rule(
+        'metrics', 'metrics', metrics_, methods=['GET'])
 
     # Return blueprint
     return blueprint
@@ -0,0 +1,116 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+class Broker:
+    """In-process pub/sub of flow state transitions.
+
+    Events are numbered by a cursor that only grows, starting from the
+    current time in milliseconds so that it keeps growing across restarts.
+    The last `history` events of the most recent `max_flows` flows are kept,
+    so that subscribers can resume from the cursor of the last event they saw.
+    missed() tells when they can't, because events after their cursor were
+    published before this broker started or were since dropped.
+    """
+
+    def __init__(self, max_subscribers=100, history=100, max_flows=1000):
+        self.max_subscribers = max_subscribers
+        self.history = history
+        self.max_flows = max_flows
+        self._condition = threading.Condition()
+        self._cursor = int(time.time() * 1000)
+        self._started = self._cursor
+        self._flows = OrderedDict()
+        # Cursor of the newest event dropped from each flow's history, and
+        # of the newest event of any flow dropped altogether
+        self._dropped = {}
+        self._evicted = self._cursor
+        self.subscribers = 0
+        self.published = 0
+
+    @property
+    def cursor(self):
+        return self._cursor
+
+    def publish(self, flow_id, event):
+        with self._condition:
+            self._cursor += 1
+            events = self._flows.pop(flow_id, None)
+            if events is None:
+                events = deque(maxlen=self.history)
+            elif len(events) == events.maxlen:
+                self._dropped[flow_id] = events[0][0]
+            events.append((self._cursor, event))
+            self._flows[flow_id] = events
+            while len(self._flows) > self.max_flows:
+                evicted, evicted_events = self._flows.popitem(last=False)
+                self._dropped.pop(evicted, None)
+                self._evicted = max(self._evicted, evicted_events[-1][0])
+            self.published += 1
+            self._condition.notify_all()
+
+    def events(self, flow_id, since):
+        with self._condition:
+            return [(cursor, event) for cursor, event in self._flows.get(flow_id, ())
+                    if cursor > since]
+
+    def missed(self, flow_id, since):
+        """Whether events of `flow_id` after cursor `since` may no longer be
+        in the history."""
+        with self._condition:
+            if flow_id in self._flows:
+                horizon = self._dropped.get(flow_id, self._started)
+            else:
+                horizon = self._evicted
+            return since < horizon
+
+    def wait(self, flow_id, since, timeout):
+        """Events of `flow_id` published after cursor `since`, waiting up to
+        `timeout` seconds for one if there are none yet."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                events = self.events(flow_id, since)
+                remaining = deadline - time.monotonic()
+                if events or remaining <= 0:
+                    return events
+                self._condition.wait(remaining)
+
+    def subscribe(self):
+        """Take one of the `max_subscribers` slots, until release() is called
+        on the returned subscription."""
+        with self._condition:
+            if self.subscribers >= self.max_subscribers:
+                raise TooManySubscribers()
+            self.subscribers += 1
+        return Subscription(self)
+
+    def _release(self):
+        with self._condition:
+            self.subscribers -= 1
+
+    def stats(self):
+        return dict(subscribers=self.subscribers, published=self.published,
+                    flows=len(self._flows), cursor=self._cursor)
+
+
+class Subscription:
+    def __init__(self, broker):
+        self.broker = broker
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.broker._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
@@ -0,0 +1,203 @@
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from . import codec
+from .config import cache_backend, cache_size, cache_ttl
+
+
+class Cache:
+    """Cache of assembled info() responses, keyed on (dataset_id, selector),
+    where the selector is a revision number or the 'latest'/'successful'
+    alias. Aliases can move whenever any revision of the dataset changes, so
+    entries are only ever invalidated a whole dataset at a time.
+
+    Each invalidation moves the dataset to a new generation. A reader takes
+    generation() before loading the rows it caches and passes it to set(),
+    which doesn't keep the value if the dataset was invalidated in between,
+    so a response read before a write is never cached after it."""
+
+    def __init__(self):
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, dataset_id, selector):
+        value = self._get(dataset_id, str(selector))
+        with self._stats_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def generation(self, dataset_id):
+        return self._generation(dataset_id)
+
+    def set(self, dataset_id, selector, value, generation=None):
+        """Cache `value`, unless `dataset_id` was invalidated since
+        `generation` was taken."""
+        self._set(dataset_id, str(selector), value, generation)
+
+    def invalidate(self, dataset_id):
+        self._invalidate(dataset_id)
+        with self._stats_lock:
+            self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(
+            backend=type(self).__name__,
+            hits=self.hits,
+            misses=self.misses,
+            invalidations=self.invalidations,
+            hit_ratio=self.hits / lookups if lookups else 0.0,
+        )
+
+    def _get(self, dataset_id, selector):
+        raise NotImplementedError()
+
+    def _generation(self, dataset_id):
+        raise NotImplementedError()
+
+    def _set(self, dataset_id, selector, value, generation):
+        raise NotImplementedError()
+
+    def _invalidate(self, dataset_id):
+        raise NotImplementedError()
+
+
+class NullCache(Cache):
+    def _get(self, dataset_id, selector):
+        return None
+
+    def _generation(self, dataset_id):
+        return 0
+
+    def _set(self, dataset_id, selector, value, generation):
+        pass
+
+    def _invalidate(self, dataset_id):
+        pass
+
+
+class LocalCache(Cache):
+    """In-process LRU cache whose entries expire `ttl` seconds after being set.
+    Cached values are shared, callers must not modify them."""
+
+    def __init__(self, size=1024, ttl=10.0, clock=time.monotonic):
+        super().__init__()
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._selectors = {}
+        self._generations = {}
+
+    def _get(self, dataset_id, selector):
+        key = (dataset_id, selector)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= self.clock():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _generation(self, dataset_id):
+        with self._lock:
+            return self._generations.get(dataset_id, 0)
+
+    def _set(self, dataset_id, selector, value, generation):
+        key = (dataset_id, selector)
+        with self._lock:
+            if generation is not None and generation != self._generations.get(dataset_id, 0):
+                return
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            self._selectors.setdefault(dataset_id, set()).add(selector)
+            while len(self._entries) > self.size:
+                self._remove(next(iter(self._entries)))
+
+    def _invalidate(self, dataset_id):
+        with self._lock:
+            self._generations[dataset_id] = self._generations.get(dataset_id, 0) + 1
+            for selector in self._selectors.pop(dataset_id, ()):
+                self._entries.pop((dataset_id, selector), None)
+
+    def _remove(self, key):
+        dataset_id, selector = key
+        del self._entries[key]
+        selectors = self._selectors[dataset_id]
+        selectors.discard(selector)
+        if not selectors:
+            del self._selectors[dataset_id]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCache(Cache):
+    """Cache shared by all workers, in a Redis-compatible server. Each dataset
+    is a hash of its selectors, so it is invalidated with a single DEL.
+
+    Its generation is a counter incremented before the DEL. set() writes the
+    value before reading the counter back, and removes it if the counter
+    moved: an invalidation running concurrently either is seen by set(), or
+    deletes the value after it was written."""
+
+    def __init__(self, client, ttl=10.0, prefix='flowmanager:info:',
+                 generation_prefix='flowmanager:generation:', generation_ttl=86400):
+        super().__init__()
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.generation_prefix = generation_prefix
+        self.generation_ttl = generation_ttl
+
+    def _get(self, dataset_id, selector):
+        value = self.client.hget(self.prefix + dataset_id, selector)
+        return codec.loads(value) if value is not None else None
+
+    def _generation(self, dataset_id):
+        return int(self.client.get(self.generation_prefix + dataset_id) or 0)
+
+    def _set(self, dataset_id, selector, value, generation):
+        key = self.prefix + dataset_id
+        pipeline = self.client.pipeline()
+        pipeline.hset(key, selector, codec.dumps(value))
+        pipeline.expire(key, max(1, math.ceil(self.ttl)))
+        pipeline.get(self.generation_prefix + dataset_id)
+        current = int(pipeline.execute()[-1] or 0)
+        if generation is not None and generation != current:
+            self.client.hdel(key, selector)
+
+    def _invalidate(self, dataset_id):
+        generation_key = self.generation_prefix + dataset_id
+        pipeline = self.client.pipeline()
+        pipeline.incr(generation_key)
+        pipeline.expire(generation_key, self.generation_ttl)
+        pipeline.delete(self.prefix + dataset_id)
+        pipeline.execute()
+
+
+def make_cache(backend=cache_backend, size=cache_size, ttl=cache_ttl):
+    """Create the cache configured by `backend`: 'local', 'none' or a
+    redis:// URL (which needs the redis package)."""
+    if backend in (None, '', 'none'):
+        return NullCache()
+    if backend == 'local':
+        return LocalCache(size, ttl)
+    try:
+        import redis
+    except ImportError:
+        logging.warning('redis is not installed, using a local cache instead of %s', backend)
+        return LocalCache(size, ttl)
+    return RedisCache(redis.StrictRedis.from_url(backend), ttl)
@@ -0,0 +1,177 @@
+import logging
+import threading
+import time
+from collections import deque
+
+FINAL_STATES = ('SUCCESS', 'FAILED')
+
+
+def merge_errors(errors, more):
+    """`errors` followed by those of `more` it doesn't include yet, or None
+    when neither has any."""
+    if not errors:
+        return more
+    return list(errors) + [error for error in more or () if error not in errors]
+
+
+class CallbackQueue:
+    """Applies pipeline status callbacks on a pool of worker threads, so that
+    the runner threads reporting them don't wait for the registry.
+
+    Callbacks of the same pipeline are applied one at a time and in order.
+    A progress callback replaces one of the same pipeline that is still
+    waiting, so only the latest pending progress is applied, with the errors
+    of both. Finish callbacks are never replaced or dropped: when `max_size`
+    callbacks are waiting they block the reporting thread until there's
+    room, while a progress callback that can't be coalesced is dropped.
+
+    A progress callback that fails is dropped, as the next one supersedes
+    it. A failing finish callback is retried, up to `final_attempts` times
+    with exponential backoff from `retry_delay` seconds, since the pipeline
+    and its flow would otherwise stay running forever.
+    """
+
+    def __init__(self, callback, workers=2, max_size=10000, final_attempts=5, retry_delay=1.0):
+        self.callback = callback
+        self.workers = workers
+        self.max_size = max_size
+        self.final_attempts = final_attempts
+        self.retry_delay = retry_delay
+        self._condition = threading.Condition()
+        self._pending = {}
+        self._ready = deque()
+        self._busy = set()
+        self._threads = []
+        self.depth = 0
+        self.max_depth = 0
+        self.enqueued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.applied = 0
+        self.failed = 0
+        self.retried = 0
+        self.wait_seconds = 0.0
+        self.apply_seconds = 0.0
+        self.max_apply_seconds = 0.0
+
+    def __call__(self, pipeline_id, state, errors=None, stats=None):
+        self.put(pipeline_id, state, errors=errors, stats=stats)
+
+    def put(self, pipeline_id, state, errors=None, stats=None):
+        item = [time.monotonic(), state, errors, stats]
+        final = state in FINAL_STATES
+        with self._condition:
+            self._start()
+            self.enqueued += 1
+            pending = self._pending.get(pipeline_id)
+            if not final and pending and pending[-1][1] not in FINAL_STATES:
+                # Keep the time the replaced callback has been waiting since,
+                # and its errors, which aren't reported again
+                item[0] = pending[-1][0]
+                item[2] = merge_errors(pending[-1][2], errors)
+                pending[-1] = item
+                self.coalesced += 1
+                return
+            if self.depth >= self.max_size:
+                if not final:
+                    self.dropped += 1
+                    logging.warning('Callback queue full, dropping progress of %s', pipeline_id)
+                    return
+                while self.depth >= self.max_size:
+                    self._condition.wait()
+                pending = self._pending.get(pipeline_id)
+            if pending is None:
+                pending = self._pending[pipeline_id] = deque()
+                if pipeline_id not in self._busy:
+                    self._ready.append(pipeline_id)
+            pending.append(item)
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            self._condition.notify_all()
+
+    def join(self, timeout=None):
+        """Wait until every queued callback has been applied."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self.depth or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def stats(self):
+        with self._condition:
+            return dict(
+                workers=self.workers,
+                depth=self.depth,
+                max_depth=self.max_depth,
+                enqueued=self.enqueued,
+                coalesced=self.coalesced,
+                dropped=self.dropped,
+                applied=self.applied,
+                failed=self.failed,
+                retried=self.retried,
+                avg_wait_seconds=self.wait_seconds / self.applied if self.applied else 0.0,
+                avg_apply_seconds=self.apply_seconds / self.applied if self.applied else 0.0,
+                max_apply_seconds=self.max_apply_seconds,
+            )
+
+    def _start(self):
+        if not self._threads:
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name='callback-worker-%d' % i, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _take(self):
+        with self._condition:
+            while not self._ready:
+                self._condition.wait()
+            pipeline_id = self._ready.popleft()
+            pending = self._pending[pipeline_id]
+            item = pending.popleft()
+            if not pending:
+                del self._pending[pipeline_id]
+            self._busy.add(pipeline_id)
+            self.depth -= 1
+            self._condition.notify_all()
+            return pipeline_id, item
+
+    def _done(self, pipeline_id, queued_at, started, finished):
+        with self._condition:
+            self._busy.discard(pipeline_id)
+            self.applied += 1
+            if pipeline_id in self._pending:
+                self._ready.append(pipeline_id)
+            self.wait_seconds += started - queued_at
+            self.apply_seconds += finished - started
+            self.max_apply_seconds = max(self.max_apply_seconds, finished - started)
+            self._condition.notify_all()
+
+    def _work(self):
+        while True:
+            pipeline_id, (queued_at, state, errors, stats) = self._take()
+            started = time.monotonic()
+            self._apply(pipeline_id, state, errors, stats)
+            self._done(pipeline_id, queued_at, started, time.monotonic())
+
+    def _apply(self, pipeline_id, state, errors, stats):
+        # Later callbacks of the pipeline wait while a finish is retried, so
+        # they're still applied after it
+        attempts = self.final_attempts if state in FINAL_STATES else 1
+        for attempt in range(1, attempts + 1):
+            try:
+                self.callback(pipeline_id, state, errors=errors, stats=stats)
+                return
+            except Exception:
+                if attempt == attempts:
+                    logging.exception('Status callback for %s (%s) failed, giving up', pipeline_id, state)
+                    with self._condition:
+                        self.failed += 1
+                    return
+                logging.warning('Status callback for %s (%s) failed, retrying (%d/%d)',
+                                pipeline_id, state, attempt, attempts - 1, exc_info=True)
+                with self._condition:
+                    self.retried += 1
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
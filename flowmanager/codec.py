@@ -0,0 +1,53 @@
+import datetime
+import decimal
+import json
+import logging
+
+from .config import json_codec
+
+
+def _default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    raise TypeError('Object of type %s is not JSON serializable' % type(obj).__name__)
+
+
+def _json_dumps(value):
+    return json.dumps(value, default=_default)
+
+
+CODECS = {
+    'json': (_json_dumps, json.loads),
+}
+
+try:
+    import orjson
+
+    def _orjson_dumps(value):
+        return orjson.dumps(value, default=_default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    CODECS['orjson'] = (_orjson_dumps, orjson.loads)
+except ImportError:
+    pass
+
+
+def get_codec(name):
+    """Return the (dumps, loads) pair for `name`, falling back to stdlib json."""
+    if name not in CODECS:
+        logging.info('JSON codec %s is not available, using json', name)
+        name = 'json'
+    return CODECS[name]
+
+
+dumps, loads = get_codec(json_codec)
+
+
+def iterdumps(values):
+    """Encode an iterable as a JSON array, one chunk per value, so that large
+    responses can be streamed."""
+    yield '['
+    for i, value in enumerate(values):
+        yield (',' if i else '') + dumps(value)
+    yield ']'
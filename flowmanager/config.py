@@ -1,3 +1,4 @@
+import logging
 import os
 
 # Auth server (to get the public key)
@@ -28,3 +29,54 @@ def update_time_setter(spec, now: datetime.datetime):
 
 def create_time_setter(spec, create: datetime.datetime):
     spec['meta']['create_time'] = create.isoformat()
+
+# JSON codec for registry columns: 'orjson' (when installed) or 'json'
+json_codec = os.environ.get('FLOWMANAGER_JSON_CODEC', 'orjson')
+
+# Compress large log/stats/errors JSON values above this many bytes (0 disables)
+compression_threshold = int(os.environ.get('FLOWMANAGER_COMPRESSION_THRESHOLD', 0))
+
+# Cache for status (info) responses: 'local' (per process), 'none' or a redis:// URL
+cache_backend = os.environ.get('FLOWMANAGER_CACHE', 'local')
+cache_ttl = float(os.environ.get('FLOWMANAGER_CACHE_TTL', 10))
+cache_size = int(os.environ.get('FLOWMANAGER_CACHE_SIZE', 1024))
+
+# Status event streams: subscribers per worker process, and longest wait (in
+# seconds) of a long-poll request or between SSE keep-alives
+event_subscribers = int(os.environ.get('FLOWMANAGER_EVENT_SUBSCRIBERS', 100))
+event_poll_timeout = float(os.environ.get('FLOWMANAGER_EVENT_POLL_TIMEOUT', 30))
+# SSE streams end after this many seconds, below gunicorn's request timeout,
+# and clients reconnect with Last-Event-ID
+event_stream_lifetime = float(os.environ.get('FLOWMANAGER_EVENT_STREAM_LIFETIME', 240))
+
+# Status callbacks from the runner are applied by this many worker threads,
+# with at most this many callbacks waiting
+callback_workers = int(os.environ.get('FLOWMANAGER_CALLBACK_WORKERS', 2))
+callback_queue_size = int(os.environ.get('FLOWMANAGER_CALLBACK_QUEUE_SIZE', 10000))
+
+# Progress of a running pipeline is written at most once per this many seconds
+progress_interval = float(os.environ.get('FLOWMANAGER_PROGRESS_INTERVAL', 5))
+
+# Side effects recorded in the outbox are delivered in batches of this size,
+# polling every this many seconds, and given up on after this many attempts
+outbox_batch_size = int(os.environ.get('FLOWMANAGER_OUTBOX_BATCH_SIZE', 100))
+outbox_interval = float(os.environ.get('FLOWMANAGER_OUTBOX_INTERVAL', 1))
+outbox_max_attempts = int(os.environ.get('FLOWMANAGER_OUTBOX_MAX_ATTEMPTS', 10))
+
+# Re-submitting the spec of the latest revision of a dataset:
+#   'off' - plans and runs a new revision anyway
+#   'reuse' (or 'unchanged') - returns the flow of that revision, unless it
+#   failed, rather than a new revision whose outputs would be missing
+DEDUP_MODES = ('off', 'reuse', 'unchanged')
+
+
+def get_dedup(name):
+    """The dedup mode `name`, falling back to 'off' for unknown values."""
+    if name not in DEDUP_MODES:
+        logging.warning('Unknown FLOWMANAGER_DEDUP %r (expected one of %s), using off',
+                        name, ', '.join(DEDUP_MODES))
+        return 'off'
+    return name
+
+
+dedup = get_dedup(os.environ.get('FLOWMANAGER_DEDUP', 'off'))
@@ -1,4 +1,10 @@
 import datetime
+import functools
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from hashlib import md5
 
 import auth
 import jwt
@@ -9,16 +15,22 @@ import yaml
 import planner
 import events
 from datahub_emails import api as statuspage
-from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import BadRequest, NotFound, ServiceUnavailable
 from dpp_runner.lib import DppRunner
 
 from .schedules import parse_schedule
 from .config import dpp_module
 from .config import dataset_getter, owner_getter, update_time_setter, create_time_setter
-from .config import verbosity
+from .config import verbosity, event_subscribers, event_poll_timeout, event_stream_lifetime
+from .config import callback_workers, callback_queue_size, progress_interval
+from .config import outbox_batch_size, outbox_interval, outbox_max_attempts, dedup
+from .callbacks import CallbackQueue
+from .outbox import OutboxDispatcher
+from .broker import Broker, TooManySubscribers
+from . import codec
 from .datasets import send_dataset
 from .models import FlowRegistry, STATE_PENDING, STATE_SUCCESS, STATE_FAILED, STATE_RUNNING
-from .models import get_descriptor
+from .models import get_descriptor, spec_hash, PIPELINE_STATUS_FIELDS
 
 CONFIGS = {'allowed_types': [
     'derived/report',
@@ -32,53 +44,205 @@ CONFIGS = {'allowed_types': [
 ]}
 
 runner = DppRunner(max_workers=3)
-
-
-def _internal_upload(owner, contents, registry, config=CONFIGS):
-    errors = []
+_callback_queues = weakref.WeakKeyDictionary()
+_callback_queues_lock = threading.Lock()
+_outbox_dispatchers = weakref.WeakKeyDictionary()
+broker = Broker(max_subscribers=event_subscribers)
+
+# Default and largest page of the listing endpoints
+LIST_PAGE_SIZE = 100
+MAX_LIST_PAGE_SIZE = 1000
+
+# Flow and pipeline states as shown to clients
+STATE_NAMES = {
+    STATE_PENDING: 'QUEUED',
+    STATE_RUNNING: 'INPROGRESS',
+    STATE_SUCCESS: 'SUCCEEDED',
+    STATE_FAILED: 'FAILED',
+}
+
+# Error of the pipelines failed because of a failed dependency
+DEPENDENCY_FAILED = ('Dependency unsuccessful. '
+                     'Cannot run until dependency "{}" is successfully'
+                     'executed')
+
+
+def _prepare(owner, contents, registry, config=CONFIGS):
+    """Plan the upload of `contents` for _register(). Planning can be slow, so
+    it happens outside of any transaction: the revision number is reserved
+    beforehand, in a short transaction of its own, so that no write lock is
+    held while planning. A reserved number is skipped if the registration
+    never commits."""
     dataset_name = dataset_getter(contents)
     now = datetime.datetime.now()
     update_time_setter(contents, now)
-
-    flow_id = None
     dataset_id = registry.format_identifier(owner, dataset_name)
-    dataset_obj = registry.create_or_update_dataset(dataset_id, owner, contents, now)
-    create_time_setter(contents, dataset_obj.get('created_at'))
-    period_in_seconds, schedule_errors = parse_schedule(contents)
-    if len(schedule_errors) == 0:
-        registry.update_dataset_schedule(dataset_id, period_in_seconds, now)
-
-        revision = registry.create_revision(
-            dataset_id, now, STATE_PENDING, errors)
-
-        revision = revision['revision']
-        flow_id=registry.format_identifier(
-            owner, dataset_name, revision)
-        pipelines = planner.plan(revision, contents, **config)
-        pipeline_spec = dict(pipelines)
-        for pipeline_id, pipeline_details in pipeline_spec.items():
-            pipeline_spec[pipeline_id]
-            doc = dict(
-                pipeline_id=pipeline_id,
-                flow_id=flow_id,
-                title=pipeline_details.get('title'),
-                pipeline_details=pipeline_details,
-                status=STATE_PENDING,
-                errors=errors,
-                logs=[],
-                stats={},
-                created_at=now,
-                updated_at=now
-            )
-            registry.save_pipeline(doc)
+    registration = dict(
+        owner=owner, dataset_id=dataset_id, now=now,
+        # The dataset spec is stored without its create time
+        spec=dict(contents, meta=dict(contents['meta'])),
+        spec_hash=spec_hash(contents),
+        flow_id=None, revision=None, pipeline_spec=None, errors=[])
+    existing = registry.get_dataset(dataset_id, fields=['created_at'])
+    create_time_setter(contents, existing['created_at'] if existing is not None else now)
+    registration['period_in_seconds'], schedule_errors = parse_schedule(contents)
+    if len(schedule_errors) > 0:
+        registration['errors'].extend(schedule_errors)
+        return registration
+
+    latest = registry.get_revision(dataset_id, 'latest', fields=['revision', 'status', 'spec_hash']) \
+        if dedup != 'off' else None
+    if latest is not None and latest['spec_hash'] == registration['spec_hash'] and \
+            latest['status'] in (STATE_PENDING, STATE_RUNNING, STATE_SUCCESS):
+        # The flow's outputs are stored under its id, so an unchanged spec
+        # gets the same flow back rather than a revision without outputs
+        registration['flow_id'] = latest['revision_id']
+        logging.info('Spec of %s is unchanged, not running flow %s', dataset_id, latest['revision_id'])
+        return registration
+
+    revision = registry.reserve_revision(dataset_id)
+    registration['revision'] = revision
+    registration['flow_id'] = registry.format_identifier(owner, dataset_name, revision)
+    registration['pipeline_spec'] = dict(planner.plan(revision, contents, **config))
+    return registration
+
+
+def _register(registration, registry):
+    """Register the dataset, and the new revision and pipelines planned by
+    _prepare(), in one transaction. Returns the dataset id, flow id and
+    pipeline specs to run (None when the spec has errors, or when `dedup`
+    skips an unchanged spec), and the errors."""
+    dataset_id = registration['dataset_id']
+    now = registration['now']
+    errors = registration['errors']
+    flow_id = registration['flow_id']
+    pipeline_spec = registration['pipeline_spec']
+    with registry.transaction():
+        registry.create_or_update_dataset(dataset_id, registration['owner'], registration['spec'], now)
+        if len(errors) > 0:
+            return dataset_id, None, None, errors
+        registry.update_dataset_schedule(dataset_id, registration['period_in_seconds'], now)
+
+        if pipeline_spec is not None:
+            registry.create_revision(
+                dataset_id, now, STATE_PENDING, errors, spec_hash=registration['spec_hash'],
+                revision=registration['revision'])
+            registry.save_pipelines([
+                dict(
+                    pipeline_id=pipeline_id,
+                    flow_id=flow_id,
+                    title=pipeline_details.get('title'),
+                    pipeline_details=pipeline_details,
+                    status=STATE_PENDING,
+                    errors=errors,
+                    logs=[],
+                    stats={},
+                    created_at=now,
+                    updated_at=now
+                )
+                for pipeline_id, pipeline_details in pipeline_spec.items()
+            ])
+    return dataset_id, flow_id, pipeline_spec, errors
+
+
+def _start(pipeline_spec, registry):
+    runner.start(None, yaml.dump(pipeline_spec).encode('utf-8'),
+                 status_cb=callback_queue(registry), verbosity=verbosity)
+
+
+def callback_queue(registry):
+    """The queue applying the runner's status callbacks to `registry`, one
+    per registry."""
+    with _callback_queues_lock:
+        queue = _callback_queues.get(registry)
+        if queue is None:
+            queue = _callback_queues[registry] = CallbackQueue(
+                PipelineStatusCallback(registry), workers=callback_workers, max_size=callback_queue_size)
+        return queue
+
+
+def outbox_dispatcher(registry):
+    """The dispatcher delivering the outbox of `registry`, one per registry.
+    It only runs in the background once started."""
+    with _callback_queues_lock:
+        dispatcher = _outbox_dispatchers.get(registry)
+        if dispatcher is None:
+            handlers = {kind: functools.partial(handler, registry) for kind, handler in OUTBOX_HANDLERS.items()}
+            dispatcher = _outbox_dispatchers[registry] = OutboxDispatcher(
+                registry, handlers, batch_size=outbox_batch_size,
+                interval=outbox_interval, max_attempts=outbox_max_attempts)
+        return dispatcher
+
+
+def _send_incident(registry, payload):
+    statuspage.on_incident(payload['title'], payload['owner'], payload['errors'])
+
+
+def _send_event(registry, payload):
+    events.send_event(*payload['args'])
+
+
+def _send_dataset(registry, payload):
+    """Index the dataset's current successful revision. Entries can be
+    delivered out of order when retried, so the revision and certification
+    are read at delivery time rather than when the entry was recorded."""
+    flow_id, unlist, certified = payload['flow_id'], payload['unlist'], payload['certified']
+    if payload.get('dataset_id') is not None:
+        successful = registry.get_revision(payload['dataset_id'], 'successful', fields=['revision_id'])
+        if successful is not None:
+            flow_id, unlist = successful['revision_id'], False
+        dataset = registry.get_dataset(payload['dataset_id'], fields=['certified'])
+        if dataset is not None:
+            certified = dataset.get('certified') or False
+    descriptor : dict = get_descriptor(flow_id)
+    if descriptor is not None:
+        if unlist and descriptor['datahub'].get('findability') == 'published':
+            descriptor['datahub']['findability'] = 'unlisted'
+        send_dataset(
+            descriptor.get('id'),
+            descriptor.get('name'),
+            descriptor.get('title'),
+            descriptor.get('description'),
+            descriptor.get('datahub'),
+            descriptor,
+            certified)
+
+
+# Deliver each kind of outbox entry, given the registry it was recorded in
+OUTBOX_HANDLERS = {
+    'incident': _send_incident,
+    'event': _send_event,
+    'dataset': _send_dataset,
+}
 
-        runner.start(None, yaml.dump(pipeline_spec).encode('utf-8'),
-                     status_cb=PipelineStatusCallback(registry), verbosity=verbosity)
-    else:
-        errors.extend(schedule_errors)
+
+def _internal_upload(owner, contents, registry, config=CONFIGS):
+    registration = _prepare(owner, contents, registry, config=config)
+    dataset_id, flow_id, pipeline_spec, errors = _register(registration, registry)
+    if pipeline_spec is not None:
+        _start(pipeline_spec, registry)
     return dataset_id, flow_id, errors
 
 
+def _report_upload_incidents(failures, registry):
+    """Record a status page incident for each (contents, errors) of a failed
+    upload. The upload may have failed because the database is unavailable,
+    so failing to record them is only logged, and the upload still returns
+    its errors."""
+    now = datetime.datetime.now()
+    try:
+        with registry.transaction():
+            for contents, errors in failures:
+                registry.add_outbox('incident', dict(
+                    title='Failed To Start Pipelines for %s' % contents.get('meta', {}).get('dataset'),
+                    owner=contents.get('meta', {}).get('owner'),
+                    errors=errors), now)
+    except Exception:
+        logging.exception('Failed to record the incidents of %d uploads', len(failures))
+        return
+    outbox_dispatcher(registry).wake()
+
+
 def upload(token, contents,
            registry: FlowRegistry,
            verifyer: auth.lib.Verifyer,
@@ -93,9 +257,8 @@ def upload(token, contents,
             if permissions and permissions.get('userid') == owner:
                 limits = permissions.get('permissions')
                 max_datasets = limits.get('max_dataset_num', 0)
-                current_datasets = registry.num_datasets_for_owner(owner)
                 dataset_id = registry.format_identifier(owner, dataset_getter(contents))
-                is_revision = registry.get_dataset(dataset_id) is not None
+                current_datasets, is_revision = registry.num_datasets_and_exists(owner, dataset_id)
                 if current_datasets < max_datasets or is_revision:
                     try:
                         dataset_id, flow_id, errors = _internal_upload(owner, contents, registry, config=config)
@@ -113,9 +276,7 @@ def upload(token, contents,
         errors.append('Received empty contents (make sure your content-type is correct)')
 
     if len(errors) and contents is not None:
-        statuspage.on_incident(
-            'Failed To Start Pipelines for %s' % contents.get('meta', {}).get('dataset'),
-            contents.get('meta', {}).get('owner'), errors)
+        _report_upload_incidents([(contents, errors)], registry)
 
     return {
         'success': len(errors) == 0,
@@ -125,9 +286,183 @@ def upload(token, contents,
     }
 
 
+def _accept_batch(specs, permissions, results, registry):
+    """The (result, contents) of the specs of a batch that are well formed and
+    owned by the token's user. The others have their errors recorded."""
+    accepted = []
+    for result, contents in zip(results, specs):
+        if not isinstance(contents, dict):
+            result['errors'].append('Received empty contents (make sure your content-type is correct)')
+        elif owner_getter(contents) is None:
+            result['errors'].append('Missing owner in spec')
+        elif not permissions or permissions.get('userid') != owner_getter(contents):
+            result['errors'].append('No token or token not authorised for owner')
+        else:
+            result['dataset_id'] = registry.format_identifier(owner_getter(contents), dataset_getter(contents))
+            accepted.append((result, contents))
+    return accepted
+
+
+def _allocate_batch_quota(accepted, permissions, registry):
+    """The accepted specs which fit in the owner's dataset quota, counting
+    the new datasets of the batch in order. Revisions of existing datasets
+    always fit."""
+    max_datasets = permissions.get('permissions').get('max_dataset_num', 0)
+    current_datasets = registry.num_datasets_for_owner(permissions.get('userid'))
+    existing = set(registry.get_datasets({result['dataset_id'] for result, _ in accepted},
+                                         fields=['identifier']))
+    allowed = []
+    for result, contents in accepted:
+        if result['dataset_id'] not in existing:
+            if current_datasets >= max_datasets:
+                result['errors'].append('Max datasets for user exceeded plan limit (%d)' % max_datasets)
+                continue
+            current_datasets += 1
+            existing.add(result['dataset_id'])
+        allowed.append((result, contents))
+    return allowed
+
+
+def _roll_back_batch(allowed, failed=None, error=None):
+    for result, _ in allowed:
+        result['flow_id'] = None
+        if result is not failed:
+            result['errors'].append('Batch registration rolled back' + (': %s' % error if error else ''))
+
+
+def _register_batch(owner, allowed, registry, config=CONFIGS):
+    """_prepare() every allowed spec, then _register() them all in one
+    transaction. Returns the pipeline specs to run. A spec that fails to be
+    planned has its error recorded, and a failure to register the batch is
+    recorded on every spec; either way nothing of the batch is registered."""
+    registrations = []
+    for result, contents in allowed:
+        try:
+            registrations.append((result, _prepare(owner, contents, registry, config=config)))
+        except Exception as error:
+            result['errors'].append('Validation failed for contents' if isinstance(error, ValueError)
+                                    else 'Unexpected error: %s' % error)
+            _roll_back_batch(allowed, failed=result)
+            return {}
+
+    pipeline_specs = {}
+    try:
+        with registry.transaction():
+            for result, registration in registrations:
+                result['dataset_id'], result['flow_id'], pipeline_spec, errors = \
+                    _register(registration, registry)
+                result['errors'].extend(errors)
+                if pipeline_spec is not None:
+                    pipeline_specs.update(pipeline_spec)
+    except Exception as error:
+        logging.exception('Failed to register a batch of %d specs', len(registrations))
+        _roll_back_batch(allowed, error='Unexpected error: %s' % error)
+        return {}
+    return pipeline_specs
+
+
+def _report_batch_incidents(results, specs, registry):
+    """Mark the results' success, and record a status page incident for each
+    spec that failed."""
+    failures = []
+    for result, contents in zip(results, specs):
+        result['success'] = len(result['errors']) == 0
+        if not result['success'] and isinstance(contents, dict):
+            failures.append((contents, result['errors']))
+    if failures:
+        _report_upload_incidents(failures, registry)
+
+
+def upload_batch(token, specs,
+                 registry: FlowRegistry,
+                 verifyer: auth.lib.Verifyer,
+                 config=CONFIGS):
+    """upload() many specs at once. The token is verified and the quota
+    checked once for the whole batch, every spec is registered in a single
+    transaction, and all their pipelines are handed to the runner in one call.
+    Returns the upload() result of each spec, in order. An unexpected error
+    registering any spec rolls back the whole batch."""
+    if not isinstance(specs, list):
+        raise BadRequest('Expected a list of specs')
+    results = [dict(success=False, dataset_id=None, flow_id=None, errors=[]) for _ in specs]
+    permissions = verifyer.extract_permissions(token)
+    accepted = _accept_batch(specs, permissions, results, registry)
+    if accepted:
+        allowed = _allocate_batch_quota(accepted, permissions, registry)
+        pipeline_specs = _register_batch(permissions.get('userid'), allowed, registry, config=config)
+        if pipeline_specs:
+            _start(pipeline_specs, registry)
+    _report_batch_incidents(results, specs, registry)
+    return results
+
+
 class PipelineStatusCallback:
-    def __init__(self, flowregistry: FlowRegistry):
+    """Applies a pipeline status reported by the runner to the registry.
+
+    A progress update of a pipeline already persisted as running, within
+    `progress_interval` seconds of its last write, only has its stats merged
+    in memory. They are written with the pipeline's first update after the
+    interval, or with its finish update.
+    """
+
+    def __init__(self, flowregistry: FlowRegistry, progress_interval=progress_interval):
         self.registry = flowregistry
+        self.progress_interval = progress_interval
+        self._lock = threading.Lock()
+        # pipeline_id -> [flow_id, monotonic time of last write, held stats]
+        self._progress = {}
+        # flow_id -> [progress updates received, progress updates written]
+        self._flows = {}
+        self.received = 0
+        self.written = 0
+
+    def throttle(self, pipeline_id, stats, force=False):
+        """Hold the stats of a progress update instead of writing them, unless
+        `force`d. Returns the flow id when held, and the stats to write
+        otherwise."""
+        with self._lock:
+            self.received += 1
+            progress = self._progress.get(pipeline_id)
+            if progress is None:
+                return None, stats
+            flow_id, written_at, held = progress
+            self._flows[flow_id][0] += 1
+            held.update(stats)
+            if not force and time.monotonic() - written_at < self.progress_interval:
+                return flow_id, None
+            progress[2] = {}
+            return None, held
+
+    def written_progress(self, pipeline_id, flow_id):
+        with self._lock:
+            self.written += 1
+            counts = self._flows.setdefault(flow_id, [0, 0])
+            if pipeline_id not in self._progress:
+                counts[0] += 1
+            counts[1] += 1
+            self._progress[pipeline_id] = [flow_id, time.monotonic(), {}]
+
+    def finished(self, pipeline_id, stats):
+        """Forget a finished pipeline, returning its held stats merged with
+        the final ones."""
+        with self._lock:
+            progress = self._progress.pop(pipeline_id, None)
+        held = progress[2] if progress is not None else {}
+        return dict(held, **stats)
+
+    def flow_finished(self, flow_id):
+        with self._lock:
+            received, written = self._flows.pop(flow_id, (0, 0))
+        logging.info('Flow %s: wrote %d of %d progress updates', flow_id, written, received)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                progress_interval=self.progress_interval,
+                received=self.received,
+                written=self.written,
+                throttled=self.received - self.written,
+            )
 
     def __call__(self, pipeline_id, state, errors=None, stats=None): #noqa
         logging.info('Status %s: %s (errors#=%d, stats=%r)',
@@ -155,7 +490,48 @@ class PipelineStatusCallback:
                 pipeline_status = STATE_SUCCESS
             else:
                 pipeline_status = STATE_FAILED
-
+            stats = self.finished(pipeline_id, stats)
+        else:
+            flow_id, stats = self.throttle(pipeline_id, stats, force=bool(errors))
+            if stats is None:
+                return {
+                    'status': STATE_RUNNING,
+                    'id': flow_id,
+                    'errors': errors
+                }
+
+        # Conflicting callbacks for the same flow re-run the whole unit of
+        # work, so the flow status is always computed from committed rows
+        result = registry.run_in_transaction(
+            self.record, pipeline_id, pipeline_status, errors, stats, log, now)
+        if result is None:
+            return {
+                'status': None,
+                'id': None,
+                'errors': ['pipeline not found']
+            }
+        flow_id, flow_status = result
+        if event == 'progress':
+            self.written_progress(pipeline_id, flow_id)
+        elif flow_status not in (STATE_PENDING, STATE_RUNNING):
+            self.flow_finished(flow_id)
+        broker.publish(flow_id, dict(
+            id=flow_id,
+            state=STATE_NAMES[flow_status],
+            pipeline=pipeline_id,
+            pipeline_state=STATE_NAMES[pipeline_status],
+            modified=now.isoformat(),
+        ))
+        outbox_dispatcher(registry).wake()
+
+        return {
+            'status': flow_status,
+            'id': flow_id,
+            'errors': errors
+        }
+
+    def record(self, pipeline_id, pipeline_status, errors, stats, log, now):
+        registry = self.registry
         doc = dict(
             status=pipeline_status,
             errors=errors,
@@ -163,145 +539,419 @@ class PipelineStatusCallback:
             log=log,
             updated_at=now
         )
-        if registry.update_pipeline(pipeline_id, doc):
-            pipeline = registry.get_pipeline(pipeline_id)
-            flow_id = registry.get_flow_id(pipeline_id)
-            flow_status = registry.check_flow_status(flow_id)
-
-            if pipeline_status == STATE_FAILED:
-                update_dependants(flow_id, pipeline_id, registry)
-
-            doc = dict(
-                status = flow_status,
-                updated_at=now,
-            )
-            if errors:
-                doc['errors'] = errors
-            if stats:
-                doc['stats'] = stats
-            if log:
-                doc['logs'] = log
-
-            rev = registry.get_revision_by_revision_id(flow_id)
-            pipelines = rev.get('pipelines')
-            if pipelines is None:
-                pipelines = {}
-
-            pipeline_state = {
-                STATE_PENDING: 'QUEUED',
-                STATE_RUNNING: 'INPROGRESS',
-                STATE_SUCCESS: 'SUCCEEDED',
-                STATE_FAILED: 'FAILED',
-            }[pipeline_status]
-
-            pipelines[pipeline_id] = dict(
-                title=pipeline.get('title'),
-                status=pipeline_state,
-                stats=stats,
-                error_log=errors,
-            )
-            doc['pipelines'] = pipelines
-            revision = registry.update_revision(flow_id, doc)
-            dataset = registry.get_dataset(revision['dataset_id'])
-            if (flow_status != STATE_PENDING) and (flow_status != STATE_RUNNING):
-                registry.delete_pipelines(flow_id)
-                findability = \
-                    flow_status == STATE_SUCCESS and \
-                    dataset['spec']['meta']['findability'] == 'published'
-                findability = 'published' if findability else 'private'
-                events.send_event(
-                    'flow',       # Source of the event
-                    event,       # What happened
-                    'OK' if flow_status == STATE_SUCCESS else 'FAIL',       # Success indication
-                    findability,  # one of "published/private/internal":
-                    dataset['owner'],       # Actor
-                    dataset_getter(dataset['spec']),   # Dataset in question
-                    dataset['spec']['meta']['owner'],      # Owner of the dataset
-                    dataset['spec']['meta']['ownerid'],      # Ownerid of the dataset
-                    flow_id,      # Related flow id
-                    pipeline_id,  # Related pipeline id
-                    {
-                        'flow-id': flow_id,
-                        'errors': errors,
-
-                    }       # Other payload
+        flow_id = registry.lock_flow(pipeline_id)
+        if flow_id is None or not registry.update_pipeline(pipeline_id, doc):
+            return None
+        pipeline = registry.get_pipeline(pipeline_id, fields=['title'])
+
+        if pipeline_status == STATE_FAILED:
+            dependants = registry.fail_dependants(flow_id, pipeline_id, DEPENDENCY_FAILED, now)
+            registry.save_pipeline_statuses(flow_id, [
+                dict(
+                    pipeline_id=dependant['pipeline_id'],
+                    title=dependant['title'],
+                    status=STATE_NAMES[STATE_FAILED],
+                    stats={},
+                    error_log=dependant['errors'],
+                    updated_at=now,
                 )
-            if flow_status == STATE_FAILED:
-                statuspage.on_incident(
-                    'Pipelines Failed for %s' % dataset['spec']['meta']['dataset'],
-                    dataset['spec']['meta']['owner'], errors)
-
-            no_succesful_revision = registry.get_revision(revision['dataset_id'], 'successful') is None
-
-            if flow_status == STATE_SUCCESS or no_succesful_revision:
-                descriptor : dict = get_descriptor(flow_id)
-                if descriptor is not None:
-                    if no_succesful_revision and descriptor['datahub'].get('findability') == 'published':
-                        descriptor['datahub']['findability'] = 'unlisted'
-                    send_dataset(
-                        descriptor.get('id'),
-                        descriptor.get('name'),
-                        descriptor.get('title'),
-                        descriptor.get('description'),
-                        descriptor.get('datahub'),
-                        descriptor,
-                        dataset.get('certified') or False)
+                for dependant in dependants
+            ])
+        flow_status = registry.check_flow_status(flow_id)
 
-            return {
-                'status': flow_status,
-                'id': flow_id,
-                'errors': errors
-            }
-        else:
-            return {
-                'status': None,
-                'id': None,
-                'errors': ['pipeline not found']
-            }
+        doc = dict(
+            status = flow_status,
+            updated_at=now,
+        )
+        if errors:
+            doc['errors'] = errors
+        if stats:
+            doc['stats'] = stats
+        if log:
+            doc['logs'] = log
+
+        pipeline_state = STATE_NAMES[pipeline_status]
+
+        registry.update_pipeline_status(flow_id, pipeline_id, dict(
+            title=pipeline.get('title'),
+            status=pipeline_state,
+            stats=stats,
+            error_log=errors,
+            updated_at=now,
+        ))
+        revision = registry.update_revision(flow_id, doc)
+        finished = (flow_status != STATE_PENDING) and (flow_status != STATE_RUNNING)
+        # The spec is only needed for the finish event and incident report
+        dataset = registry.get_dataset(
+            revision['dataset_id'],
+            fields=['owner', 'spec', 'certified'] if finished else ['certified'])
+        if finished:
+            registry.delete_pipelines(flow_id)
+        no_succesful_revision = registry.get_revision(
+            revision['dataset_id'], 'successful', fields=['revision_id']) is None
+
+        # External side effects are delivered by the outbox dispatcher once
+        # the state transition is committed
+        if finished:
+            findability = \
+                flow_status == STATE_SUCCESS and \
+                dataset['spec']['meta']['findability'] == 'published'
+            findability = 'published' if findability else 'private'
+            registry.add_outbox('event', dict(args=[
+                'flow',       # Source of the event
+                'finish',       # What happened
+                'OK' if flow_status == STATE_SUCCESS else 'FAIL',       # Success indication
+                findability,  # one of "published/private/internal":
+                dataset['owner'],       # Actor
+                dataset_getter(dataset['spec']),   # Dataset in question
+                dataset['spec']['meta']['owner'],      # Owner of the dataset
+                dataset['spec']['meta']['ownerid'],      # Ownerid of the dataset
+                flow_id,      # Related flow id
+                pipeline_id,  # Related pipeline id
+                {
+                    'flow-id': flow_id,
+                    'errors': errors,
+
+                }       # Other payload
+            ]), now)
+        if flow_status == STATE_FAILED:
+            registry.add_outbox('incident', dict(
+                title='Pipelines Failed for %s' % dataset['spec']['meta']['dataset'],
+                owner=dataset['spec']['meta']['owner'],
+                errors=errors), now)
+
+        if flow_status == STATE_SUCCESS or no_succesful_revision:
+            registry.add_outbox('dataset', dict(
+                dataset_id=revision['dataset_id'],
+                flow_id=flow_id,
+                unlist=no_succesful_revision,
+                certified=dataset.get('certified') or False), now)
+        return flow_id, flow_status
 
 
 def info(owner, dataset, revision_id, registry: FlowRegistry):
+    return conditional_info(owner, dataset, revision_id, registry)[1]
+
+
+def info_etag(revision, dataset):
+    """Validator of an info() response: changes whenever the revision or the
+    dataset row is written."""
+    validator = '%s:%s:%s:%s' % (revision['revision_id'], revision['version'],
+                                 revision['updated_at'], dataset['version'])
+    return md5(validator.encode('utf-8')).hexdigest()
+
+
+# Response fields of info(), with the dataset and revision columns they need
+# and how they're read from the (spec, revision, pipelines) rows
+INFO_FIELDS = OrderedDict([
+    ('id', ([], [], lambda spec, revision, pipelines: revision['revision_id'])),
+    ('spec_contents', (['spec'], [], lambda spec, revision, pipelines: spec['spec'])),
+    ('modified', (['updated_at'], [], lambda spec, revision, pipelines: spec['updated_at'].isoformat())),
+    ('state', ([], ['status'], lambda spec, revision, pipelines: STATE_NAMES[revision['status']])),
+    ('error_log', ([], ['errors'], lambda spec, revision, pipelines: revision['errors'])),
+    ('logs', ([], ['logs'], lambda spec, revision, pipelines: revision['logs'])),
+    ('stats', ([], ['stats'], lambda spec, revision, pipelines: revision['stats'])),
+    ('pipelines', ([], [], lambda spec, revision, pipelines: pipelines if pipelines is not None else {})),
+    ('certified', (['certified'], [], lambda spec, revision, pipelines: spec.get('certified'))),
+])
+
+
+def parse_info_fields(fields):
+    """Split a `fields` selection such as ['state', 'pipelines.status'] into
+    the response fields and the pipeline fields (None for all of them)."""
+    if fields is None:
+        return list(INFO_FIELDS), None
+    selected = []
+    pipeline_fields = []
+    for field in fields:
+        field, _, pipeline_field = field.strip().partition('.')
+        if field not in INFO_FIELDS or (pipeline_field and field != 'pipelines'):
+            raise BadRequest('Unknown field %s' % field)
+        if pipeline_field:
+            if pipeline_field not in PIPELINE_STATUS_FIELDS:
+                raise BadRequest('Unknown pipeline field %s' % pipeline_field)
+            pipeline_fields.append(pipeline_field)
+        if field not in selected:
+            selected.append(field)
+    return selected, pipeline_fields or None
+
+
+def info_columns(selected):
+    """The dataset and revision columns needed for the `selected` fields."""
+    dataset_columns = {'updated_at'}
+    revision_columns = {'updated_at'}
+    for field in selected:
+        dataset_columns.update(INFO_FIELDS[field][0])
+        revision_columns.update(INFO_FIELDS[field][1])
+    return sorted(dataset_columns), sorted(revision_columns)
+
+
+def info_response(selected, spec, revision, pipelines=None):
+    return {field: INFO_FIELDS[field][2](spec, revision, pipelines) for field in selected}
+
+
+def not_modified_info(dataset_id, revision_id, registry: FlowRegistry, if_none_match, full):
+    """The ETag and cached response of conditional_info() when it can be
+    answered without loading the revision: a response of None when the ETag
+    is in `if_none_match`. Returns (None, None) otherwise."""
+    cached = registry.cache.get(dataset_id, revision_id)
+    if cached is not None:
+        etag = cached['etag']
+        if etag in if_none_match:
+            return etag, None
+        if full:
+            return etag, cached['info']
+    elif if_none_match:
+        spec = registry.get_dataset(dataset_id, fields=['updated_at'])
+        revision = registry.get_revision(dataset_id, revision_id, fields=['updated_at']) \
+            if spec is not None else None
+        if revision is not None:
+            etag = info_etag(revision, spec)
+            if etag in if_none_match:
+                return etag, None
+    return None, None
+
+
+def conditional_info(owner, dataset, revision_id, registry: FlowRegistry, if_none_match=(),
+                     fields=None, pipelines_status=None, pipelines_after=None, pipelines_limit=None):
+    """Return the ETag of the info() response, and the response itself, or
+    None when the ETag is in `if_none_match`. A matching ETag is answered
+    from the cache or from a projected read of the two rows, without loading
+    the JSON columns.
+
+    `fields` selects response fields ('pipelines.<field>' for a pipeline
+    field), and the pipelines can be filtered by status and paginated by
+    pipeline id. Only the full response is cached."""
     dataset_id = FlowRegistry.format_identifier(owner, dataset)
-    spec = registry.get_dataset(dataset_id)
+    selected, pipeline_fields = parse_info_fields(fields)
+    if pipelines_limit is not None:
+        pipelines_limit = page_size(pipelines_limit)
+    full = fields is None and pipelines_status is None and \
+        pipelines_after is None and pipelines_limit is None
+    etag, resp = not_modified_info(dataset_id, revision_id, registry, if_none_match, full)
+    if etag is not None:
+        return etag, resp
+    # Taken before the rows are read, to cache the response only if they
+    # weren't written since
+    generation = registry.cache.generation(dataset_id) if full else None
+
+    # Excluded fields' columns are neither loaded nor decoded
+    dataset_columns, revision_columns = info_columns(selected)
+    spec = registry.get_dataset(dataset_id, fields=dataset_columns)
     if spec is None:
         raise NotFound()
-    revision = registry.get_revision(dataset_id, revision_id)
+    revision = registry.get_revision(dataset_id, revision_id, fields=revision_columns)
     if revision is None:
         raise NotFound()
-    state = {
-        STATE_PENDING: 'QUEUED',
-        STATE_RUNNING: 'INPROGRESS',
-        STATE_SUCCESS: 'SUCCEEDED',
-        STATE_FAILED: 'FAILED',
-    }[revision['status']]
-    pipelines = revision['pipelines']
-    resp = dict(
-        id = revision['revision_id'],
-        spec_contents=spec['spec'],
-        modified=spec['updated_at'].isoformat(),
-        state=state,
-        error_log=revision['errors'],
-        logs=revision['logs'],
-        stats=revision['stats'],
-        pipelines=pipelines if pipelines is not None else {},
-        certified=spec.get('certified')
+    pipelines = None
+    if 'pipelines' in selected:
+        pipelines, cursor = registry.page_pipeline_statuses(
+            revision['revision_id'], fields=pipeline_fields, status=pipelines_status,
+            after=pipelines_after, limit=pipelines_limit)
+    resp = info_response(selected, spec, revision, pipelines)
+    if 'pipelines' in selected and pipelines_limit is not None:
+        resp['pipelines_next'] = cursor
+    etag = info_etag(revision, spec)
+    if full:
+        registry.cache.set(dataset_id, revision_id, dict(etag=etag, info=resp), generation)
+    return etag, resp
+
+
+def batch_info(items, registry: FlowRegistry, fields=None, chunk_size=500):
+    """info() of many {owner, dataset, revision} items (the revision defaults
+    to 'latest'), with the same optional `fields` selection. Returns an
+    iterator over the responses in order, None for items not found. Each
+    chunk of `chunk_size` items is resolved with a constant number of
+    queries, whatever the number of items."""
+    if not isinstance(items, list) or \
+            not all(isinstance(item, dict) and 'owner' in item and 'dataset' in item for item in items):
+        raise BadRequest('Expected a list of {owner, dataset, revision} items')
+    selected, pipeline_fields = parse_info_fields(fields)
+    keys = [(FlowRegistry.format_identifier(item['owner'], item['dataset']), str(item.get('revision', 'latest')))
+            for item in items]
+    dataset_columns, revision_columns = info_columns(selected)
+    if 'pipelines' in selected:
+        # Revisions from before pipeline_status keep their pipelines in the row
+        revision_columns.append('pipelines')
+
+    def responses():
+        for start in range(0, len(keys), chunk_size):
+            chunk = keys[start:start + chunk_size]
+            specs = registry.get_datasets({dataset_id for dataset_id, _ in chunk}, fields=dataset_columns)
+            revisions = registry.get_revisions(chunk, fields=revision_columns, pipeline_fields=pipeline_fields)
+            for dataset_id, selector in chunk:
+                spec = specs.get(dataset_id)
+                revision = revisions.get((dataset_id, selector))
+                if spec is None or revision is None:
+                    yield None
+                    continue
+                pipelines = revision.get('pipelines')
+                if pipelines and pipeline_fields:
+                    pipelines = {
+                        pipeline_id: {field: pipeline.get(field) for field in pipeline_fields}
+                        for pipeline_id, pipeline in pipelines.items()
+                    }
+                yield info_response(selected, spec, revision, pipelines)
+    return responses()
+
+
+def page_size(limit):
+    if limit is None:
+        return LIST_PAGE_SIZE
+    if limit < 1:
+        raise BadRequest('Page size must be positive')
+    return min(limit, MAX_LIST_PAGE_SIZE)
+
+
+def list_datasets(owner, registry: FlowRegistry, after=None, limit=None):
+    datasets, cursor = registry.page_datasets(owner, after=after, limit=page_size(limit),
+                                              fields=['created_at', 'updated_at', 'certified'])
+    return dict(
+        datasets=[
+            dict(
+                id=dataset['identifier'],
+                created=dataset['created_at'].isoformat() if dataset['created_at'] else None,
+                modified=dataset['updated_at'].isoformat() if dataset['updated_at'] else None,
+                certified=dataset['certified'],
+            )
+            for dataset in datasets
+        ],
+        next=cursor
     )
+
+
+def list_revisions(owner, dataset, registry: FlowRegistry, after=None, limit=None, state=None):
+    status = None
+    if state is not None:
+        status = next((status for status, name in STATE_NAMES.items() if name == state), None)
+        if status is None:
+            raise BadRequest('Unknown state %s' % state)
+    dataset_id = FlowRegistry.format_identifier(owner, dataset)
+    revisions, cursor = registry.page_revisions(dataset_id, after=after, limit=page_size(limit),
+                                                status=status, fields=['status', 'created_at', 'updated_at'])
+    return dict(
+        revisions=[
+            dict(
+                id=revision['revision_id'],
+                revision=revision['revision'],
+                state=STATE_NAMES[revision['status']],
+                created=revision['created_at'].isoformat() if revision['created_at'] else None,
+                modified=revision['updated_at'].isoformat() if revision['updated_at'] else None,
+            )
+            for revision in revisions
+        ],
+        next=cursor
+    )
+
+
+def metrics(registry: FlowRegistry):
+    queue = callback_queue(registry)
+    return dict(cache=registry.cache.stats(), events=broker.stats(),
+                callbacks=queue.stats(), progress=queue.callback.stats(),
+                outbox=outbox_dispatcher(registry).stats())
+
+
+def flow_id_for(owner, dataset, revision_id, registry: FlowRegistry):
+    """Revision id of a revision number, or of the revision an alias
+    currently points to."""
+    dataset_id = FlowRegistry.format_identifier(owner, dataset)
+    if str(revision_id).isdigit():
+        return FlowRegistry.format_identifier(dataset_id, revision_id)
+    revision = registry.get_revision(dataset_id, revision_id, fields=['revision_id'])
+    if revision is None:
+        raise NotFound()
+    return revision['revision_id']
+
+
+def snapshot_event(owner, dataset, revision_id, registry: FlowRegistry):
+    _, resp = conditional_info(owner, dataset, revision_id, registry, fields=['id', 'state', 'modified'])
     return resp
 
 
-## helpers
+def final_snapshot(owner, dataset, flow_id, registry: FlowRegistry):
+    """The state of a flow if it finished, or None. A flow can finish without
+    an event of this process's broker, when it's run by the scheduler or
+    another worker process."""
+    snapshot = snapshot_event(owner, dataset, flow_id.rsplit('/', 1)[1], registry)
+    return snapshot if snapshot['state'] in ('SUCCEEDED', 'FAILED') else None
+
+
+def poll_events(owner, dataset, revision_id, registry: FlowRegistry, since=None, timeout=event_poll_timeout):
+    """Long-poll for the state transitions of a flow after cursor `since`.
+    Without a cursor, or when the broker no longer has the events after it,
+    returns the current state and the cursor to poll from."""
+    flow_id = flow_id_for(owner, dataset, revision_id, registry) if since is not None else None
+    if since is None or broker.missed(flow_id, since):
+        cursor = broker.cursor
+        return dict(cursor=cursor, events=[snapshot_event(owner, dataset, revision_id, registry)])
+    try:
+        with broker.subscribe():
+            transitions = broker.wait(flow_id, since, min(timeout, event_poll_timeout))
+    except TooManySubscribers:
+        raise ServiceUnavailable('Too many subscribers')
+    if not transitions:
+        snapshot = final_snapshot(owner, dataset, flow_id, registry)
+        return dict(cursor=since, events=[snapshot] if snapshot is not None else [])
+    return dict(
+        cursor=transitions[-1][0] if transitions else since,
+        events=[event for _, event in transitions]
+    )
+
 
+class EventStream:
+    """Server-Sent Events stream of the state transitions of a flow, which
+    holds a subscriber slot until it's closed. Starts with the current state,
+    unless resuming from a cursor the broker still has every later event of.
+    Ends after the flow finishes, or after `lifetime` seconds so that clients
+    reconnect with Last-Event-ID before the worker's request timeout."""
+
+    def __init__(self, owner, dataset, revision_id, registry: FlowRegistry,
+                 since=None, keepalive=event_poll_timeout, lifetime=event_stream_lifetime):
+        # Resolved before taking a subscriber slot, which isn't released
+        # if they raise NotFound
+        self.flow_id = flow_id_for(owner, dataset, revision_id, registry)
+        self.final_snapshot = functools.partial(final_snapshot, owner, dataset, self.flow_id, registry)
+        self.snapshot = None
+        if since is None or broker.missed(self.flow_id, since):
+            since = broker.cursor
+            self.snapshot = snapshot_event(owner, dataset, revision_id, registry)
+        self.since = since
+        self.keepalive = keepalive
+        self.deadline = time.monotonic() + lifetime
+        try:
+            self.subscription = broker.subscribe()
+        except TooManySubscribers:
+            raise ServiceUnavailable('Too many subscribers')
+
+    @staticmethod
+    def format(cursor, event):
+        return 'id: %s\nevent: status\ndata: %s\n\n' % (cursor, codec.dumps(event))
+
+    def __iter__(self):
+        try:
+            if self.snapshot is not None:
+                yield self.format(self.since, self.snapshot)
+                if self.snapshot['state'] in ('SUCCEEDED', 'FAILED'):
+                    return
+            while True:
+                remaining = self.deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                transitions = broker.wait(self.flow_id, self.since, min(self.keepalive, remaining))
+                if not transitions:
+                    snapshot = self.final_snapshot()
+                    if snapshot is not None:
+                        yield self.format(self.since, snapshot)
+                        return
+                    yield ': keepalive\n\n'
+                for cursor, event in transitions:
+                    self.since = cursor
+                    yield self.format(cursor, event)
+                    if event['state'] in ('SUCCEEDED', 'FAILED'):
+                        return
+        finally:
+            self.close()
+
+    def close(self):
+        self.subscription.release()
 
-def update_dependants(flow_id, pipeline_id, registry):
-    cb = PipelineStatusCallback(registry)
-    for queued_pipeline in \
-        registry.list_pipelines_by_flow_and_status(flow_id):
-        for dep in queued_pipeline.pipeline_details.get('dependencies', []):
-            if dep['pipeline'].lstrip('./') == pipeline_id:
-                cb(queued_pipeline.pipeline_id,
-                   'FAILED',
-                   errors=[
-                    'Dependency unsuccessful. '
-                    'Cannot run until dependency "{}" is successfully'
-                    'executed'.format(pipeline_id)
-                   ])
@@ -0,0 +1,125 @@
+import datetime
+import logging
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table
+from sqlalchemy import func, inspect, select
+
+# `Base.metadata.create_all` creates missing tables but never alters existing
+# ones, so every schema change to an existing table gets a numbered migration
+# here. Migrations must be idempotent: on a fresh database create_all has
+# already produced the final schema and they only record their version.
+
+schema_version = Table(
+    'schema_version', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('description', String(256)),
+    Column('applied_at', DateTime),
+)
+
+# Arbitrary key for pg_advisory_xact_lock, so that the web workers and the
+# scheduler don't race each other applying the same migration.
+MIGRATION_LOCK_ID = 0x5fec5704e
+
+
+def create_index(conn, metadata, table_name, index_name):
+    existing = {index['name'] for index in inspect(conn).get_indexes(table_name)}
+    if index_name not in existing:
+        index = next(index for index in metadata.tables[table_name].indexes
+                     if index.name == index_name)
+        index.create(conn)
+
+
+def add_registry_indexes(conn, metadata):
+    create_index(conn, metadata, 'dataset', 'ix_dataset_owner_identifier')
+    create_index(conn, metadata, 'dataset_revision', 'ix_dataset_revision_dataset_id_revision')
+    create_index(conn, metadata, 'dataset_revision', 'ix_dataset_revision_dataset_id_status_revision')
+    create_index(conn, metadata, 'pipelines', 'ix_pipelines_flow_id_status')
+
+
+JSON_COLUMNS = {
+    'dataset': ['spec'],
+    'dataset_revision': ['errors', 'stats', 'logs', 'pipelines'],
+    'pipelines': ['pipeline_details', 'errors', 'stats', 'logs'],
+}
+
+
+def convert_json_columns_to_jsonb(conn, metadata):
+    if conn.dialect.name != 'postgresql':
+        return
+    for table_name, column_names in JSON_COLUMNS.items():
+        column_types = {column['name']: column['type'] for column in inspect(conn).get_columns(table_name)}
+        for column_name in column_names:
+            if column_types[column_name].__visit_name__ != 'JSONB':
+                conn.execute('ALTER TABLE {0} ALTER COLUMN {1} TYPE JSONB USING {1}::jsonb'.format(
+                    table_name, column_name))
+
+
+def add_column(conn, table_name, column_name, ddl):
+    if column_name not in {column['name'] for column in inspect(conn).get_columns(table_name)}:
+        conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table_name, column_name, ddl))
+
+
+def add_version_columns(conn, metadata):
+    for table_name in ('dataset', 'dataset_revision', 'pipelines'):
+        add_column(conn, table_name, 'version', 'INTEGER NOT NULL DEFAULT 1')
+
+
+def seed_owner_counters(conn, metadata):
+    # Recounting makes this safe to re-run, and correct on a fresh database
+    conn.execute('DELETE FROM owner_counter')
+    conn.execute('INSERT INTO owner_counter (owner, datasets) '
+                 'SELECT owner, COUNT(*) FROM dataset WHERE owner IS NOT NULL GROUP BY owner')
+
+
+def index_pipeline_dependencies(conn, metadata):
+    # Pipelines planned before the index existed may still be running
+    pipelines = metadata.tables['pipelines']
+    dependencies = metadata.tables['pipeline_dependency']
+    conn.execute(dependencies.delete())
+    rows = {}
+    for pipeline_id, flow_id, details in conn.execute(
+            select([pipelines.c.pipeline_id, pipelines.c.flow_id, pipelines.c.pipeline_details])):
+        for dependency in (details or {}).get('dependencies', []):
+            dependency_id = dependency['pipeline'].lstrip('./')
+            rows[(pipeline_id, dependency_id)] = dict(
+                pipeline_id=pipeline_id, dependency_id=dependency_id, flow_id=flow_id)
+    if rows:
+        conn.execute(dependencies.insert(), list(rows.values()))
+
+
+def add_spec_hash_columns(conn, metadata):
+    # Existing revisions have no hash: they never match a new upload
+    for table_name in ('dataset', 'dataset_revision'):
+        add_column(conn, table_name, 'spec_hash', 'VARCHAR(32)')
+
+
+MIGRATIONS = [
+    (1, 'Composite indexes for registry queries', add_registry_indexes),
+    (2, 'Native JSONB storage on PostgreSQL', convert_json_columns_to_jsonb),
+    (3, 'Row versions for optimistic concurrency control', add_version_columns),
+    (4, 'Per-owner dataset counters', seed_owner_counters),
+    (5, 'Reverse index of pipeline dependencies', index_pipeline_dependencies),
+    (6, 'Content hashes of specs', add_spec_hash_columns),
+]
+
+
+def current_version(conn):
+    return conn.execute(select([func.max(schema_version.c.version)])).scalar() or 0
+
+
+def upgrade(engine, metadata):
+    """Apply all pending migrations to the database behind `engine`."""
+    with engine.begin() as conn:
+        if conn.dialect.name == 'postgresql':
+            conn.execute(select([func.pg_advisory_xact_lock(MIGRATION_LOCK_ID)]))
+        schema_version.create(conn, checkfirst=True)
+        version = current_version(conn)
+        for migration_version, description, migration in MIGRATIONS:
+            if migration_version <= version:
+                continue
+            logging.info('Applying schema migration %d: %s', migration_version, description)
+            migration(conn, metadata)
+            conn.execute(schema_version.insert().values(
+                version=migration_version,
+                description=description,
+                applied_at=datetime.datetime.now()))
@@ -1,42 +1,96 @@
 import os
 import json
+import zlib
+import base64
 import datetime
 import logging
+import threading
 from hashlib import md5
+from collections import OrderedDict
 
 from contextlib import contextmanager
+from functools import wraps
 
 import boto3
 from botocore.exceptions import ClientError
 from sqlalchemy import DateTime, types
-from sqlalchemy import inspect, desc
+from sqlalchemy import inspect, desc, func, text, literal_column, and_, tuple_, event
+from sqlalchemy import bindparam, select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Insert
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
 
-from sqlalchemy import Column, Unicode, String, Integer, create_engine, Boolean
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Unicode, String, Integer, create_engine, Boolean, Index
+from sqlalchemy.orm import sessionmaker, Query, deferred, load_only, undefer_group
+from sqlalchemy.orm.exc import StaleDataError
 
 # ## SQL DB
 from flowmanager.schedules import calculate_new_schedule
+from flowmanager.migrations import upgrade
+from flowmanager import codec
+from flowmanager.cache import make_cache
+from flowmanager.config import compression_threshold
 
 Base = declarative_base()
 
 
-# ## Json as string Type
+# ## Json Type: native JSONB on PostgreSQL, encoded text elsewhere
 class JsonType(types.TypeDecorator):
     impl = types.Unicode
 
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(postgresql.JSONB())
+        return dialect.type_descriptor(self.impl)
+
     def process_bind_param(self, value, dialect):
-        return json.dumps(value)
+        if dialect.name == 'postgresql':
+            # Encoded by the engine's json_serializer
+            return value
+        return codec.dumps(value)
 
     def process_result_value(self, value, dialect):
+        if dialect.name == 'postgresql':
+            return value
         if value:
-            return json.loads(value)
+            return codec.loads(value)
         else:
             return None
 
     def copy(self, **kw):
         return JsonType(self.impl.length)
 
+
+# ## Json Type storing large values zlib-compressed
+class CompressedJsonType(JsonType):
+    """Values encoding to at least `threshold` bytes are stored as a
+    {"$zlib": <base64>} envelope. Reads accept both forms, so rows written
+    before compression was enabled (or below the threshold) still load."""
+    ENVELOPE_KEY = '$zlib'
+    threshold = compression_threshold
+
+    def process_bind_param(self, value, dialect):
+        if not self.threshold or value is None:
+            return super().process_bind_param(value, dialect)
+        encoded = codec.dumps(value)
+        if len(encoded) >= self.threshold:
+            compressed = zlib.compress(encoded.encode('utf-8'))
+            value = {self.ENVELOPE_KEY: base64.b64encode(compressed).decode('ascii')}
+        elif dialect.name != 'postgresql':
+            return encoded
+        return super().process_bind_param(value, dialect)
+
+    def process_result_value(self, value, dialect):
+        value = super().process_result_value(value, dialect)
+        if isinstance(value, dict) and len(value) == 1 and self.ENVELOPE_KEY in value:
+            return codec.loads(zlib.decompress(base64.b64decode(value[self.ENVELOPE_KEY])))
+        return value
+
+    def copy(self, **kw):
+        return CompressedJsonType(self.impl.length)
+
 STATE_SUCCESS = 'success'
 STATE_FAILED = 'failed'
 STATE_PENDING = 'pending'
@@ -47,11 +101,18 @@ class Dataset(Base):
     __tablename__ = 'dataset'
     identifier = Column(String, primary_key=True)
     owner = Column(String)
-    spec = Column(JsonType)
+    spec = deferred(Column(JsonType), group='json')
     created_at = Column(DateTime)
     updated_at = Column(DateTime)
     scheduled_for = Column(DateTime, index=True)
     certified = Column(Boolean, default=False)
+    spec_hash = Column(String(32))
+    version = Column(Integer, nullable=False, server_default='1')
+
+    __table_args__ = (
+        Index('ix_dataset_owner_identifier', 'owner', 'identifier'),
+    )
+    __mapper_args__ = {'version_id_col': version}
 
 
 class DatasetRevision(Base):
@@ -60,12 +121,20 @@ class DatasetRevision(Base):
     dataset_id = Column(String)
     revision = Column(Integer)
     status = Column(String(16))
-    errors = Column(JsonType)
-    stats = Column(JsonType)
-    logs = Column(JsonType)
-    pipelines = Column(JsonType)
+    errors = deferred(Column(CompressedJsonType), group='json')
+    stats = deferred(Column(CompressedJsonType), group='json')
+    logs = deferred(Column(CompressedJsonType), group='json')
+    pipelines = deferred(Column(CompressedJsonType), group='json')
     created_at = Column(DateTime)
     updated_at = Column(DateTime)
+    spec_hash = Column(String(32))
+    version = Column(Integer, nullable=False, server_default='1')
+
+    __table_args__ = (
+        Index('ix_dataset_revision_dataset_id_revision', 'dataset_id', 'revision'),
+        Index('ix_dataset_revision_dataset_id_status_revision', 'dataset_id', 'status', 'revision'),
+    )
+    __mapper_args__ = {'version_id_col': version}
 
 
 class Pipelines(Base):
@@ -73,40 +142,181 @@ class Pipelines(Base):
     pipeline_id = Column(String(256), primary_key=True)
     flow_id = Column(String(256))
     title = Column(String(256))
-    pipeline_details = Column(JsonType)
+    pipeline_details = deferred(Column(CompressedJsonType), group='json')
     status = Column(String(16))
-    errors = Column(JsonType)
-    stats = Column(JsonType)
-    logs = Column(JsonType)
+    errors = deferred(Column(JsonType), group='json')
+    stats = deferred(Column(JsonType), group='json')
+    logs = deferred(Column(CompressedJsonType), group='json')
     created_at = Column(DateTime)
     updated_at = Column(DateTime)
+    version = Column(Integer, nullable=False, server_default='1')
+
+    __table_args__ = (
+        Index('ix_pipelines_flow_id_status', 'flow_id', 'status'),
+    )
+    __mapper_args__ = {'version_id_col': version}
+
+
+class PipelineStatus(Base):
+    __tablename__ = 'pipeline_status'
+    revision_id = Column(String, primary_key=True)
+    pipeline_id = Column(String(256), primary_key=True)
+    title = Column(String(256))
+    status = Column(String(16))
+    stats = Column(CompressedJsonType)
+    error_log = Column(CompressedJsonType)
+    updated_at = Column(DateTime)
+
+
+PIPELINE_STATUS_FIELDS = ['title', 'status', 'stats', 'error_log']
+
+
+class InsertOnConflict(Insert):
+    """INSERT ... ON CONFLICT (`index_elements`) DO UPDATE SET `update`, or DO
+    NOTHING when `update` is empty, for SQLite (3.24+), whose dialect has no
+    such construct in this SQLAlchemy version."""
+
+    def __init__(self, table, index_elements, update):
+        super().__init__(table)
+        self.index_elements = index_elements
+        self.update = update
+
+
+@compiles(InsertOnConflict)
+def compile_insert_on_conflict(insert, compiler, **kw):
+    statement = compiler.visit_insert(insert, **kw)
+    target = ', '.join(compiler.preparer.quote(column) for column in insert.index_elements)
+    if not insert.update:
+        return '%s ON CONFLICT (%s) DO NOTHING' % (statement, target)
+    assignments = ', '.join(
+        '%s = %s' % (compiler.preparer.quote(column), compiler.process(expression, **kw))
+        for column, expression in insert.update.items())
+    return '%s ON CONFLICT (%s) DO UPDATE SET %s' % (statement, target, assignments)
+
+
+class RevisionCounter(Base):
+    __tablename__ = 'revision_counter'
+    dataset_id = Column(String, primary_key=True)
+    revision = Column(Integer)
+
+
+# Spec metadata set on every upload, left out of the spec hash
+SPEC_HASH_IGNORED_META = ('update_time', 'create_time')
+
+
+def spec_hash(spec):
+    """md5 of the canonical JSON of `spec`, so that identical specs have the
+    same hash whatever their key order or upload time."""
+    meta = spec.get('meta')
+    if isinstance(meta, dict):
+        spec = dict(spec, meta={key: value for key, value in meta.items()
+                                if key not in SPEC_HASH_IGNORED_META})
+    canonical = json.dumps(spec, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return md5(canonical.encode('utf-8')).hexdigest()
+
+
+class PipelineDependency(Base):
+    """Reverse index of the dependencies of planned pipelines, so that the
+    dependants of a failed pipeline are found without reading every
+    pipeline's details."""
+    __tablename__ = 'pipeline_dependency'
+    pipeline_id = Column(String(256), primary_key=True)
+    dependency_id = Column(String(256), primary_key=True)
+    flow_id = Column(String(256))
+
+    __table_args__ = (
+        Index('ix_pipeline_dependency_flow_id_dependency_id', 'flow_id', 'dependency_id'),
+    )
+
+
+def pipeline_dependencies(pipeline):
+    """PipelineDependency rows of a pipeline, from the dependencies in its
+    planned details."""
+    details = pipeline.get('pipeline_details') or {}
+    dependency_ids = OrderedDict(
+        (dependency['pipeline'].lstrip('./'), None)
+        for dependency in details.get('dependencies', []))
+    return [dict(pipeline_id=pipeline['pipeline_id'], dependency_id=dependency_id,
+                 flow_id=pipeline.get('flow_id'))
+            for dependency_id in dependency_ids]
+
+
+class Outbox(Base):
+    """External side effects of registry writes, recorded in the same
+    transaction and delivered by an OutboxDispatcher. Entries that ran out of
+    attempts are kept, with a NULL available_at, for inspection."""
+    __tablename__ = 'outbox'
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(64), nullable=False)
+    payload = Column(JsonType)
+    created_at = Column(DateTime)
+    available_at = Column(DateTime)
+    attempts = Column(Integer, nullable=False, server_default='0')
+    last_error = Column(Unicode)
+
+    __table_args__ = (
+        Index('ix_outbox_available_at_id', 'available_at', 'id'),
+    )
+
+
+class OwnerCounter(Base):
+    __tablename__ = 'owner_counter'
+    owner = Column(String, primary_key=True)
+    datasets = Column(Integer, nullable=False, server_default='0')
+
+
+def retry_on_conflict(method):
+    """Run a FlowRegistry method through run_in_transaction()."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self.run_in_transaction(method, self, *args, **kwargs)
+    return wrapper
 
 
 class FlowRegistry:
+    # Optimistic concurrency control: times a conflicting unit of work is rerun
+    retries = 5
 
-    def __init__(self, db_connection_string):
+    def __init__(self, db_connection_string, cache=None):
         self._db_connection_string = db_connection_string
+        self.cache = cache if cache is not None else make_cache()
         self._engine = None
         self._session = None
+        self._local = threading.local()
+        self._engine_lock = threading.Lock()
 
 
     @property
     def engine(self):
         if self._engine is None:
-            self._engine = create_engine(self._db_connection_string)
-            Base.metadata.create_all(self._engine)
+            with self._engine_lock:
+                if self._engine is None:
+                    kwargs = {}
+                    if make_url(self._db_connection_string).get_backend_name() == 'postgresql':
+                        kwargs.update(json_serializer=codec.dumps, json_deserializer=codec.loads)
+                    engine = create_engine(self._db_connection_string, **kwargs)
+                    Base.metadata.create_all(engine)
+                    upgrade(engine, Base.metadata)
+                    self._engine = engine
         return self._engine
 
 
     @contextmanager
     def session_scope(self):
         """Provide a transactional scope around a series of operations."""
+        session = getattr(self._local, 'session', None)
+        if session is not None:
+            # Joining the unit of work opened by transaction()
+            yield session
+            return
         if self._session is None:
             self._session = sessionmaker(bind=self.engine)
         session = self._session()
         try:
             yield session
             session.commit()
+            for dataset_id in session.info.pop('invalidated', ()):
+                self.cache.invalidate(dataset_id)
         except: #noqa
             session.rollback()
             raise
@@ -114,10 +324,152 @@ class FlowRegistry:
             session.expunge_all()
             session.close()
 
+    @contextmanager
+    def transaction(self):
+        """Run every registry call made in this block (on this thread) in one
+        session, committed once on exit and rolled back on error."""
+        if getattr(self._local, 'session', None) is not None:
+            yield self
+            return
+        with self.session_scope() as session:
+            # The identity map only holds weak references. Keep every object
+            # loaded in the unit of work alive, so that a row read early on is
+            # version checked against what was read when it's updated later.
+            loaded = []
+            event.listen(session, 'loaded_as_persistent',
+                         lambda session, instance: loaded.append(instance))
+            self._local.session = session
+            try:
+                yield self
+            finally:
+                self._local.session = None
+
+    @staticmethod
+    def invalidate(session, dataset_id):
+        """Drop the cached info() responses of `dataset_id` once `session`
+        commits. Readers pass the cache generation they started from to
+        Cache.set(), so that a response read before the write isn't cached
+        after it."""
+        session.info.setdefault('invalidated', set()).add(dataset_id)
+
+    def run_in_transaction(self, fn, *args, **kwargs):
+        """Call `fn` inside transaction(). If a concurrent writer changed a
+        versioned row that `fn` updates, the whole unit of work is rolled back
+        and run again on fresh data, at most `retries` more times. Inside an
+        enclosing transaction the conflict is left to that transaction."""
+        nested = getattr(self._local, 'session', None) is not None
+        attempt = 0
+        while True:
+            try:
+                with self.transaction():
+                    return fn(*args, **kwargs)
+            except StaleDataError:
+                if nested or attempt >= self.retries:
+                    raise
+                attempt += 1
+                logging.info('Concurrent update in %s, retrying (%d/%d)',
+                             getattr(fn, '__name__', fn), attempt, self.retries)
+
+    def iterate(self, query, keys, batch_size=1000):
+        """Stream the rows of `query` as detached objects, fetching them in
+        batches of `batch_size` by keyset pagination on the `keys` columns
+        (which must be unique together), so memory use doesn't grow with the
+        size of the table."""
+        last = None
+        while True:
+            with self.session_scope() as session:
+                batch_query = query.with_session(session)
+                if last is not None:
+                    batch_query = batch_query.filter(tuple_(*keys) > tuple_(*last))
+                batch = batch_query.order_by(*keys).limit(batch_size).all()
+                for obj in batch:
+                    session.expunge(obj)
+            yield from batch
+            if len(batch) < batch_size:
+                return
+            last = [getattr(batch[-1], key.key) for key in keys]
+
+    def page(self, query, keys, after=None, limit=100, descending=False):
+        """One page of `query` by keyset pagination on the `keys` columns
+        (which must be unique together): the first `limit` rows after the
+        `after` key values, in ascending or descending key order. Returns the
+        rows as dicts, and the key values to pass as `after` for the next page
+        (None on the last page). Deep pages cost the same as the first one."""
+        with self.session_scope() as session:
+            query = query.with_session(session)
+            if after is not None:
+                if descending:
+                    query = query.filter(tuple_(*keys) < tuple_(*after))
+                else:
+                    query = query.filter(tuple_(*keys) > tuple_(*after))
+            order = [desc(key) for key in keys] if descending else keys
+            rows = query.order_by(*order).limit(limit + 1).all()
+            cursor = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                cursor = [getattr(rows[-1], key.key) for key in keys]
+            return [FlowRegistry.object_as_dict(row) for row in rows], cursor
+
     @staticmethod
     def object_as_dict(obj):
+        state = inspect(obj)
+        # Columns left out by a projection (or deferred) are not loaded here
+        unloaded = state.unloaded if state.has_identity else ()
         return {c.key: getattr(obj, c.key)
-                for c in inspect(obj).mapper.column_attrs}
+                for c in state.mapper.column_attrs
+                if c.key not in unloaded}
+
+    @staticmethod
+    def load_fields(fields):
+        """Query option loading just `fields` (and the primary key and row
+        version), or every column including the deferred JSON ones when
+        `fields` is None. The version is loaded with the row so that updating
+        a projected object still detects concurrent writers."""
+        if fields is None:
+            return undefer_group('json')
+        return load_only(*fields, 'version')
+
+    @staticmethod
+    def upsert(session, model, values, update_columns):
+        """Insert `values`, or update `update_columns` of the existing row with
+        the same primary key. Returns the resulting row as a dict, and whether
+        it was inserted.
+
+        On PostgreSQL this is a single INSERT ... ON CONFLICT DO UPDATE ...
+        RETURNING. SQLite gets the same INSERT ... ON CONFLICT DO UPDATE, which
+        takes its database write lock, so the follow-up SELECT can't interleave
+        with other writers. SQLite can't tell whether the row was inserted, so
+        it's told by the row's version: None for tables without one.
+        """
+        table = model.__table__
+        key = {column.name: values[column.name] for column in table.primary_key}
+        # Core statements bypass the unit of work: flush pending changes first,
+        # and expire any instance of this row that the session already holds.
+        session.flush()
+        instance = session.identity_map.get(
+            inspect(model).identity_key_from_primary_key(list(key.values())))
+        if instance is not None:
+            session.expire(instance)
+
+        if session.bind.dialect.name == 'postgresql':
+            statement = postgresql.insert(table).values(**values)
+            update = {column: statement.excluded[column] for column in update_columns}
+            if 'version' in table.c:
+                update['version'] = table.c.version + 1
+            statement = statement.on_conflict_do_update(
+                index_elements=list(key), set_=update
+            ).returning(*table.c, literal_column('(xmax = 0)').label('inserted'))
+            row = session.execute(statement).first()
+            return {column.name: row[column.name] for column in table.c}, row['inserted']
+
+        update = {column: literal_column('excluded.%s' % column) for column in update_columns}
+        if update and 'version' in table.c:
+            update['version'] = table.c.version + 1
+        session.execute(InsertOnConflict(table, list(key), update).values(**values))
+        where = [table.c[name] == value for name, value in key.items()]
+        row = session.execute(table.select().where(and_(*where))).first()
+        inserted = row['version'] == 1 if 'version' in table.c else None
+        return {column.name: row[column.name] for column in table.c}, inserted
 
     @staticmethod
     def format_identifier(*args):
@@ -128,75 +480,136 @@ class FlowRegistry:
         with self.session_scope() as session:
             dataset = Dataset(**dataset)
             session.add(dataset)
+            session.flush()
+            self.count_datasets(session, dataset.owner, 1)
+            self.invalidate(session, dataset.identifier)
             return FlowRegistry.object_as_dict(dataset)
 
-    def get_dataset(self, identifier):
+    def get_dataset(self, identifier, fields=None):
         with self.session_scope() as session:
-            ret = session.query(Dataset).filter_by(identifier=identifier).first()
+            ret = session.query(Dataset).options(FlowRegistry.load_fields(fields))\
+                .filter_by(identifier=identifier).first()
             if ret is not None:
                 return FlowRegistry.object_as_dict(ret)
         return None
 
-    def list_datasets(self):
+    def get_datasets(self, identifiers, fields=None):
+        """Datasets by identifier, fetched in a single query."""
         with self.session_scope() as session:
-            all = session.query(Dataset).all()
-            session.expunge_all()
-            yield from all
+            query = session.query(Dataset).options(FlowRegistry.load_fields(fields))\
+                .filter(Dataset.identifier.in_(identifiers))
+            return {ret.identifier: FlowRegistry.object_as_dict(ret) for ret in query}
+
+    def list_datasets(self, batch_size=1000):
+        query = Query(Dataset).options(undefer_group('json'))
+        return self.iterate(query, [Dataset.identifier], batch_size)
+
+    @staticmethod
+    def count_datasets(session, owner, delta):
+        """Add `delta` to the dataset counter of `owner`, in the transaction
+        that creates or deletes the dataset."""
+        if owner is None:
+            return
+        session.execute(text("""
+            INSERT INTO owner_counter (owner, datasets) VALUES (:owner, :delta)
+            ON CONFLICT (owner) DO UPDATE
+            SET datasets = owner_counter.datasets + excluded.datasets
+        """), dict(owner=owner, delta=delta))
+
+    def page_datasets(self, owner, after=None, limit=100, fields=None):
+        """A page of the datasets of `owner` ordered by identifier, starting
+        after identifier `after`. Loads just `fields` when given, else every
+        column but the JSON ones. Returns the page and the cursor of the next
+        one, or None."""
+        query = Query(Dataset).filter_by(owner=owner)
+        if fields is not None:
+            query = query.options(FlowRegistry.load_fields(list(fields) + ['owner']))
+        datasets, cursor = self.page(query, [Dataset.owner, Dataset.identifier],
+                                     after=(owner, after) if after is not None else None,
+                                     limit=limit)
+        return datasets, cursor[1] if cursor else None
 
     def num_datasets_for_owner(self, owner):
         with self.session_scope() as session:
-            count = session.query(Dataset).filter_by(owner=owner).count()
-            return count
+            count = session.query(OwnerCounter.datasets).filter_by(owner=owner).scalar()
+            return count or 0
 
+    def num_datasets_and_exists(self, owner, identifier):
+        """Number of datasets of `owner`, and whether dataset `identifier`
+        exists, fetched in a single query."""
+        with self.session_scope() as session:
+            count, exists = session.query(
+                session.query(OwnerCounter.datasets).filter_by(owner=owner).as_scalar(),
+                session.query(Dataset.identifier).filter_by(identifier=identifier).exists()
+            ).one()
+            return count or 0, bool(exists)
+
+    @retry_on_conflict
     def update_dataset(self, identifier, doc):
         with self.session_scope() as session:
             ret = session.query(Dataset).filter_by(identifier=identifier).first()
             if ret is not None:
                 for key, value in doc.items():
                     setattr(ret, key, value)
-            session.commit()
+                self.invalidate(session, identifier)
+            session.flush()
             return FlowRegistry.object_as_dict(ret)
 
     def create_or_update_dataset(self, identifier, owner, spec, updated_at):
-        dataset = self.get_dataset(identifier)
         document = {
             'identifier': identifier,
             'owner': owner,
             'spec': spec,
-            'updated_at': updated_at
+            'spec_hash': spec_hash(spec),
+            'updated_at': updated_at,
+            'created_at': updated_at
         }
-        if dataset is None:
-            document['created_at'] = updated_at
-            return self.save_dataset(document)
-        else:
-            return self.update_dataset(identifier, document)
+        with self.session_scope() as session:
+            dataset, inserted = self.upsert(session, Dataset, document,
+                                            ['owner', 'spec', 'spec_hash', 'updated_at'])
+            if inserted:
+                self.count_datasets(session, owner, 1)
+            self.invalidate(session, identifier)
+            return dataset
+
+    def delete_dataset(self, identifier):
+        with self.session_scope() as session:
+            dataset = session.query(Dataset).options(FlowRegistry.load_fields(['owner']))\
+                .filter_by(identifier=identifier).first()
+            if dataset is None:
+                return False
+            session.delete(dataset)
+            session.flush()
+            self.count_datasets(session, dataset.owner, -1)
+            self.invalidate(session, identifier)
+            return True
 
     def update_dataset_schedule(self, identifier, period_in_seconds, now):
-        dataset = self.get_dataset(identifier)
+        dataset = self.get_dataset(identifier, fields=['scheduled_for'])
         update = dict(
             scheduled_for=calculate_new_schedule(dataset['scheduled_for'], period_in_seconds, now)
         )
         self.update_dataset(identifier, update)
 
-    def get_expired_datasets(self, now):
-        with self.session_scope() as session:
-            all = session.query(Dataset).filter(Dataset.scheduled_for <= now).all()
-            session.expunge_all()
-            yield from all
+    def get_expired_datasets(self, now, batch_size=1000):
+        query = Query(Dataset).options(undefer_group('json')).filter(Dataset.scheduled_for <= now)
+        return self.iterate(query, [Dataset.scheduled_for, Dataset.identifier], batch_size)
 
     # Revisions
     def save_dataset_revision(self, dataset_revision):
         with self.session_scope() as session:
             dataset_revision = DatasetRevision(**dataset_revision)
             session.add(dataset_revision)
+            self.invalidate(session, dataset_revision.dataset_id)
 
-    def get_revision(self, dataset, revision_id='latest'):
+    def get_revision(self, dataset, revision_id='latest', fields=None):
         with self.session_scope() as session:
+            query = session.query(DatasetRevision).options(FlowRegistry.load_fields(fields))
             if revision_id == 'latest':
-                ret = session.query(DatasetRevision).filter_by(dataset_id=dataset)\
+                ret = query.filter_by(dataset_id=dataset)\
                     .order_by(desc(DatasetRevision.revision)).first()
             elif revision_id == 'successful':
-                ret = session.query(DatasetRevision).filter_by(
+                ret = query.filter_by(
                     dataset_id=dataset, status=STATE_SUCCESS)\
                     .order_by(desc(DatasetRevision.revision)).first()
             else:
@@ -204,36 +617,158 @@ class FlowRegistry:
                     revision_id = int(revision_id)
                 except ValueError:
                     return None
-                ret = session.query(DatasetRevision).filter_by(
+                ret = query.filter_by(
                     dataset_id=dataset, revision=revision_id).first()
             if ret is not None:
-                return FlowRegistry.object_as_dict(ret)
+                return self.revision_as_dict(session, ret)
         return None
 
-    def get_revision_by_revision_id(self, revision_id):
+    def get_revision_by_revision_id(self, revision_id, fields=None):
         with self.session_scope() as session:
-            ret = session.query(DatasetRevision).filter_by(
+            ret = session.query(DatasetRevision).options(FlowRegistry.load_fields(fields)).filter_by(
                 revision_id=revision_id).first()
             if ret is not None:
-                return FlowRegistry.object_as_dict(ret)
+                return self.revision_as_dict(session, ret)
         return None
 
-    def create_revision(self, dataset_id, created_at, status, errors):
-        ret = self.get_revision(dataset_id)
-        revision = 1 if ret is None else ret['revision'] + 1
-        assert status in (STATE_FAILED, STATE_PENDING, STATE_RUNNING, STATE_SUCCESS)
-        document = {
-            'revision_id': self.format_identifier(dataset_id, revision),
-            'dataset_id': dataset_id,
-            'revision': revision,
-            'created_at': created_at,
-            'updated_at': created_at,
-            'status': status,
-            'errors': errors
+    def get_revisions(self, selectors, fields=None, pipeline_fields=None):
+        """Revisions by (dataset id, revision number or alias), fetched with
+        one query per kind of selector whatever their number, and one for the
+        pipeline statuses. Returns a dict keyed on (dataset id, str(selector)).
+        `pipeline_fields` restricts the pipeline status columns loaded."""
+        numbers = {}
+        aliases = {'latest': set(), 'successful': set()}
+        for dataset_id, selector in selectors:
+            selector = str(selector)
+            if selector in aliases:
+                aliases[selector].add(dataset_id)
+            elif selector.isdigit():
+                numbers[self.format_identifier(dataset_id, int(selector))] = (dataset_id, selector)
+        revisions = {}
+        with self.session_scope() as session:
+            query = session.query(DatasetRevision).options(FlowRegistry.load_fields(fields))
+            if numbers:
+                for revision in query.filter(DatasetRevision.revision_id.in_(list(numbers))):
+                    revisions[numbers[revision.revision_id]] = revision
+            for alias, dataset_ids in aliases.items():
+                if dataset_ids:
+                    revisions.update(self.resolve_aliases(session, query, alias, dataset_ids))
+            statuses = {}
+            if revisions and (fields is None or 'pipelines' in fields):
+                pipeline_fields = pipeline_fields or PIPELINE_STATUS_FIELDS
+                rows = session.query(PipelineStatus)\
+                    .options(load_only('revision_id', *pipeline_fields))\
+                    .filter(PipelineStatus.revision_id.in_(
+                        list({revision.revision_id for revision in revisions.values()})))
+                for row in rows:
+                    statuses.setdefault(row.revision_id, {})[row.pipeline_id] = {
+                        field: getattr(row, field) for field in pipeline_fields
+                    }
+            return {
+                key: self.revision_as_dict(session, revision, statuses.get(revision.revision_id, {}))
+                for key, revision in revisions.items()
+            }
+
+    @staticmethod
+    def resolve_aliases(session, query, alias, dataset_ids):
+        """The revisions of `query` that `alias` ('latest' or 'successful')
+        resolves to for each of `dataset_ids`, in one query, keyed on
+        (dataset id, alias)."""
+        newest = session.query(DatasetRevision.dataset_id,
+                               func.max(DatasetRevision.revision).label('revision'))\
+            .filter(DatasetRevision.dataset_id.in_(list(dataset_ids)))
+        if alias == 'successful':
+            newest = newest.filter(DatasetRevision.status == STATE_SUCCESS)
+        newest = newest.group_by(DatasetRevision.dataset_id).subquery()
+        return {
+            (revision.dataset_id, alias): revision
+            for revision in query.join(newest, and_(
+                DatasetRevision.dataset_id == newest.c.dataset_id,
+                DatasetRevision.revision == newest.c.revision))
         }
-        self.save_dataset_revision(document)
+
+    def revision_as_dict(self, session, revision, statuses=None):
+        ret = FlowRegistry.object_as_dict(revision)
+        if 'pipelines' in ret:
+            if statuses is None:
+                statuses = self.pipeline_statuses(session, revision.revision_id)
+            if statuses:
+                # Revisions from before pipeline_status keep their map in the row
+                pipelines = dict(ret['pipelines'] or {})
+                pipelines.update(statuses)
+                ret['pipelines'] = pipelines
+        return ret
+
+    def page_revisions(self, dataset_id, after=None, limit=100, status=None, fields=None):
+        """A page of the revisions of `dataset_id`, newest first, starting
+        after revision number `after`, optionally only those in `status`.
+        Loads just `fields` when given, else every column but the JSON ones.
+        Returns the page and the cursor of the next one, or None."""
+        query = Query(DatasetRevision).filter_by(dataset_id=dataset_id)
+        if status is not None:
+            query = query.filter_by(status=status)
+        if fields is not None:
+            query = query.options(FlowRegistry.load_fields(list(fields) + ['dataset_id', 'revision']))
+        revisions, cursor = self.page(query, [DatasetRevision.dataset_id, DatasetRevision.revision],
+                                      after=(dataset_id, after) if after is not None else None,
+                                      limit=limit, descending=True)
+        return revisions, cursor[1] if cursor else None
+
+    @staticmethod
+    def supports_returning(dialect):
+        return dialect.name == 'postgresql' or \
+            (dialect.name == 'sqlite' and dialect.server_version_info >= (3, 35))
+
+    def allocate_revision(self, session, dataset_id):
+        """Atomically bump and return the revision counter of a dataset.
+
+        The upsert takes the counter row's write lock, so concurrent callers
+        are serialized until the allocating transaction commits. A missing
+        (or lagging) counter is seeded from the revisions already stored.
+        """
+        dialect = session.bind.dialect
+        greatest = 'GREATEST' if dialect.name == 'postgresql' else 'MAX'
+        statement = """
+            INSERT INTO revision_counter (dataset_id, revision)
+            SELECT :dataset_id, COALESCE(MAX(revision), 0) + 1
+            FROM dataset_revision WHERE dataset_id = :dataset_id
+            ON CONFLICT (dataset_id) DO UPDATE
+            SET revision = {}(revision_counter.revision + 1, excluded.revision)
+        """.format(greatest)
+        if FlowRegistry.supports_returning(dialect):
+            return session.execute(
+                text(statement + ' RETURNING revision'), dict(dataset_id=dataset_id)).scalar()
+        session.execute(text(statement), dict(dataset_id=dataset_id))
+        return session.query(RevisionCounter.revision).filter_by(dataset_id=dataset_id).scalar()
+
+    def reserve_revision(self, dataset_id):
+        """Allocate the next revision number of a dataset, to be passed to a
+        later create_revision(). Outside of transaction() the counter's lock
+        is released right away."""
+        with self.session_scope() as session:
+            return self.allocate_revision(session, dataset_id)
+
+    def create_revision(self, dataset_id, created_at, status, errors, spec_hash=None, revision=None):
+        assert status in (STATE_FAILED, STATE_PENDING, STATE_RUNNING, STATE_SUCCESS)
+        with self.session_scope() as session:
+            if revision is None:
+                revision = self.allocate_revision(session, dataset_id)
+            document = {
+                'revision_id': self.format_identifier(dataset_id, revision),
+                'dataset_id': dataset_id,
+                'revision': revision,
+                'created_at': created_at,
+                'updated_at': created_at,
+                'status': status,
+                'errors': errors
+            }
+            if spec_hash is not None:
+                document['spec_hash'] = spec_hash
+            session.add(DatasetRevision(**document))
+            self.invalidate(session, dataset_id)
         return document
 
+    @retry_on_conflict
     def update_revision(self, revision_id, doc):
         with self.session_scope() as session:
             ret = session.query(DatasetRevision).filter_by(
@@ -241,74 +776,175 @@ class FlowRegistry:
             if ret is not None:
                 for key, value in doc.items():
                     setattr(ret, key, value)
-            session.commit()
+                self.invalidate(session, ret.dataset_id)
+            session.flush()
             return FlowRegistry.object_as_dict(ret)
 
 
+    # Pipeline statuses
+    @staticmethod
+    def pipeline_statuses(session, revision_id):
+        return {
+            row.pipeline_id: dict(
+                title=row.title,
+                status=row.status,
+                stats=row.stats,
+                error_log=row.error_log,
+            )
+            for row in session.query(PipelineStatus).filter_by(revision_id=revision_id)
+        }
+
+    def get_pipeline_statuses(self, revision_id):
+        with self.session_scope() as session:
+            return self.pipeline_statuses(session, revision_id)
+
+    def page_pipeline_statuses(self, revision_id, fields=None, status=None, after=None, limit=None):
+        """Pipeline statuses of a revision ordered by pipeline id: only those
+        in `status`, after pipeline id `after`, and at most `limit` of them.
+        Only the `fields` columns are loaded. Returns the page, and the cursor
+        of the next page or None."""
+        fields = fields or PIPELINE_STATUS_FIELDS
+        with self.session_scope() as session:
+            legacy = session.query(DatasetRevision.pipelines).filter_by(
+                revision_id=revision_id).scalar()
+            if legacy:
+                # Revisions from before pipeline_status are merged in memory
+                legacy = dict(legacy)
+                legacy.update(self.pipeline_statuses(session, revision_id))
+                pipelines = {
+                    pipeline_id: pipeline for pipeline_id, pipeline in legacy.items()
+                    if (status is None or pipeline.get('status') == status) and
+                    (after is None or pipeline_id > after)
+                }
+            else:
+                query = session.query(PipelineStatus).options(load_only(*fields))\
+                    .filter_by(revision_id=revision_id)
+                if status is not None:
+                    query = query.filter_by(status=status)
+                if after is not None:
+                    query = query.filter(PipelineStatus.pipeline_id > after)
+                query = query.order_by(PipelineStatus.pipeline_id)
+                if limit is not None:
+                    query = query.limit(limit + 1)
+                pipelines = {
+                    row.pipeline_id: {field: getattr(row, field) for field in fields}
+                    for row in query
+                }
+        pipeline_ids = sorted(pipelines)
+        cursor = None
+        if limit is not None and len(pipeline_ids) > limit:
+            pipeline_ids = pipeline_ids[:max(limit, 0)]
+            cursor = pipeline_ids[-1] if pipeline_ids else after
+        page = {
+            pipeline_id: {field: pipelines[pipeline_id].get(field) for field in fields}
+            for pipeline_id in pipeline_ids
+        }
+        return page, cursor
+
+    def save_pipeline_statuses(self, revision_id, docs):
+        """Replace the status rows of many pipelines of `revision_id` in two
+        statements. Each doc includes its pipeline_id."""
+        if not docs:
+            return
+        with self.session_scope() as session:
+            session.flush()
+            session.query(PipelineStatus).filter(
+                PipelineStatus.revision_id == revision_id,
+                PipelineStatus.pipeline_id.in_([doc['pipeline_id'] for doc in docs]))\
+                .delete(synchronize_session='fetch')
+            session.bulk_insert_mappings(
+                PipelineStatus, [dict(doc, revision_id=revision_id) for doc in docs])
+            self.invalidate(session, revision_id.rsplit('/', 1)[0])
+
+    def update_pipeline_status(self, revision_id, pipeline_id, doc):
+        document = dict(doc, revision_id=revision_id, pipeline_id=pipeline_id)
+        with self.session_scope() as session:
+            self.upsert(session, PipelineStatus, document, list(doc))
+            # Revision ids are the dataset id followed by the revision number
+            self.invalidate(session, revision_id.rsplit('/', 1)[0])
+
     # Pipelines
     def save_pipeline(self, pipelines):
+        self.save_pipelines([pipelines])
+
+    def save_pipelines(self, pipelines):
         with self.session_scope() as session:
-            pipelines = Pipelines(**pipelines)
-            session.add(pipelines)
+            session.bulk_insert_mappings(Pipelines, pipelines)
+            dependencies = [dependency for pipeline in pipelines
+                            for dependency in pipeline_dependencies(pipeline)]
+            if dependencies:
+                session.bulk_insert_mappings(PipelineDependency, dependencies)
 
-    def get_pipeline(self, p_identifier):
+    def get_pipeline(self, p_identifier, fields=None):
         with self.session_scope() as session:
-            ret = session.query(Pipelines).filter_by(
+            ret = session.query(Pipelines).options(FlowRegistry.load_fields(fields)).filter_by(
                 pipeline_id=p_identifier).first()
             if ret is not None:
                 return FlowRegistry.object_as_dict(ret)
         return None
 
     def get_flow_id(self, id):
-        ret = self.get_pipeline(id)
+        ret = self.get_pipeline(id, fields=['flow_id'])
         if ret is not None:
             return ret['flow_id']
         return None
 
-    def list_pipelines_by_id(self, flow_id):
-        with self.session_scope() as session:
-            all = session.query(Pipelines).filter_by(
-                flow_id=flow_id).all()
-            session.expunge_all()
-            yield from all
+    def list_pipelines_by_id(self, flow_id, batch_size=1000):
+        query = Query(Pipelines).options(undefer_group('json')).filter_by(flow_id=flow_id)
+        return self.iterate(query, [Pipelines.pipeline_id], batch_size)
 
-    def list_pipelines_by_flow_and_status(self, flow_id, status=STATE_PENDING):
-        with self.session_scope() as session:
-            all = session.query(Pipelines).filter_by(
-                flow_id=flow_id, status=status).all()
-            session.expunge_all()
-            yield from all
+    def list_pipelines_by_flow_and_status(self, flow_id, status=STATE_PENDING, batch_size=1000):
+        query = Query(Pipelines).options(undefer_group('json')).filter_by(flow_id=flow_id, status=status)
+        return self.iterate(query, [Pipelines.pipeline_id], batch_size)
+
+    def list_pipelines(self, batch_size=1000):
+        query = Query(Pipelines).options(undefer_group('json'))
+        return self.iterate(query, [Pipelines.pipeline_id], batch_size)
+
+    def lock_flow(self, pipeline_id):
+        """Lock the revision of the flow `pipeline_id` belongs to until the
+        transaction ends, and return the flow id (None when there's no such
+        pipeline). Status updates of one flow are serialized on this lock, so
+        that each one counts the pipeline statuses committed by the others.
 
-    def list_pipelines(self):
+        This must be the transaction's first statement: PostgreSQL takes the
+        row lock with SELECT ... FOR UPDATE, while SQLite, which has no row
+        locks, gets a no-op write that takes its database write lock before
+        anything is read."""
+        revisions = DatasetRevision.__table__
+        flow_id = select([Pipelines.flow_id]).where(Pipelines.pipeline_id == pipeline_id).as_scalar()
         with self.session_scope() as session:
-            all = session.query(Pipelines).all()
-            session.expunge_all()
-            yield from all
+            if session.bind.dialect.name == 'sqlite':
+                session.execute(revisions.update()
+                                .where(revisions.c.revision_id == flow_id)
+                                .values(version=revisions.c.version))
+            return session.execute(select([revisions.c.revision_id])
+                                   .where(revisions.c.revision_id == flow_id)
+                                   .with_for_update()).scalar()
 
     def check_flow_status(self, flow_id):
         with self.session_scope() as session:
-            running = session.query(Pipelines).filter_by(
-                flow_id=flow_id, status=STATE_RUNNING).first()
-            if running is not None:
-                return STATE_RUNNING
+            statuses = dict(
+                session.query(Pipelines.status, func.count(Pipelines.pipeline_id))
+                .filter_by(flow_id=flow_id)
+                .group_by(Pipelines.status)
+            )
+        return FlowRegistry.flow_status_from_counts(statuses)
 
-            success = session.query(Pipelines).filter_by(
-                flow_id=flow_id, status=STATE_SUCCESS).first()
-            pending = session.query(Pipelines).filter_by(
-                flow_id=flow_id, status=STATE_PENDING).first()
-            failed = session.query(Pipelines).filter_by(
-                flow_id=flow_id, status=STATE_FAILED).first()
-
-            if pending is not None:
-              if (success is not None) or (failed is not None):
-                 return STATE_RUNNING
-              else:
-                 return STATE_PENDING
-            else:
-              if failed is not None:
-                  return STATE_FAILED
-            return STATE_SUCCESS
+    @staticmethod
+    def flow_status_from_counts(statuses):
+        """Derive the flow state from a {pipeline status: count} mapping."""
+        if statuses.get(STATE_RUNNING):
+            return STATE_RUNNING
+        if statuses.get(STATE_PENDING):
+            if statuses.get(STATE_SUCCESS) or statuses.get(STATE_FAILED):
+                return STATE_RUNNING
+            return STATE_PENDING
+        if statuses.get(STATE_FAILED):
+            return STATE_FAILED
+        return STATE_SUCCESS
 
+    @retry_on_conflict
     def update_pipeline(self, identifier, doc):
         with self.session_scope() as session:
             ret = session.query(Pipelines).filter_by(
@@ -318,22 +954,120 @@ class FlowRegistry:
                     setattr(ret, key, value)
             else:
                 logging.warning('Failed to find pipeline %s to update', identifier)
-            session.commit()
+            session.flush()
             return ret is not None
 
     def create_or_update_pipeline(self, p_id, **args):
-        pipeline = self.get_pipeline(p_id)
-        if pipeline is None:
-            self.save_pipeline(args)
-        else:
-            self.update_pipeline(p_id, args)
+        document = dict(args, pipeline_id=p_id)
+        with self.session_scope() as session:
+            pipeline, _ = self.upsert(session, Pipelines, document,
+                                      [key for key in args if key != 'pipeline_id'])
+            if 'pipeline_details' in args:
+                session.query(PipelineDependency).filter_by(pipeline_id=p_id).delete()
+                session.bulk_insert_mappings(PipelineDependency, pipeline_dependencies(pipeline))
 
+    def fail_dependants(self, flow_id, pipeline_id, error, now):
+        """Mark every pending pipeline of `flow_id` that depends on
+        `pipeline_id`, directly or transitively, as failed, with the error
+        `error.format(dependency_id)`. The dependants are found with one
+        recursive query and updated with one statement. Returns the failed
+        pipelines as dicts of pipeline_id, title and errors."""
+        dependencies = PipelineDependency.__table__
+        pipelines = Pipelines.__table__
+        closure = select([dependencies.c.pipeline_id, dependencies.c.dependency_id])\
+            .where(and_(dependencies.c.flow_id == flow_id,
+                        dependencies.c.dependency_id == pipeline_id))\
+            .cte('closure', recursive=True)
+        closure = closure.union(
+            select([dependencies.c.pipeline_id, dependencies.c.dependency_id])
+            .select_from(dependencies.join(closure, and_(
+                dependencies.c.flow_id == flow_id,
+                dependencies.c.dependency_id == closure.c.pipeline_id))))
+        with self.session_scope() as session:
+            rows = session.execute(
+                select([closure.c.pipeline_id, closure.c.dependency_id, pipelines.c.title])
+                .select_from(closure.join(pipelines, pipelines.c.pipeline_id == closure.c.pipeline_id))
+                .where(pipelines.c.status == STATE_PENDING)
+                .order_by(closure.c.pipeline_id))
+            dependants = {}
+            for dependant_id, dependency_id, title in rows:
+                dependants.setdefault(dependency_id, []).append((dependant_id, title))
+
+            # Breadth first, so each dependant is reported as failing because
+            # of its nearest failed dependency
+            failed = OrderedDict()
+            queue = [pipeline_id]
+            for dependency_id in queue:
+                for dependant_id, title in dependants.get(dependency_id, ()):
+                    if dependant_id not in failed and dependant_id != pipeline_id:
+                        failed[dependant_id] = dict(
+                            pipeline_id=dependant_id, title=title,
+                            errors=[error.format(dependency_id)])
+                        queue.append(dependant_id)
+            if not failed:
+                return []
+
+            # Core statements bypass the unit of work, as in upsert()
+            session.flush()
+            for dependant_id in failed:
+                instance = session.identity_map.get(
+                    inspect(Pipelines).identity_key_from_primary_key([dependant_id]))
+                if instance is not None:
+                    session.expire(instance)
+            session.execute(
+                pipelines.update()
+                .where(pipelines.c.pipeline_id == bindparam('b_pipeline_id'))
+                .values(status=STATE_FAILED,
+                        errors=bindparam('b_errors', type_=pipelines.c.errors.type),
+                        updated_at=now,
+                        version=pipelines.c.version + 1),
+                [dict(b_pipeline_id=dependant['pipeline_id'], b_errors=dependant['errors'])
+                 for dependant in failed.values()])
+            return list(failed.values())
+
+    # Outbox
+    def add_outbox(self, kind, payload, now):
+        """Record a side effect to deliver once the current transaction
+        commits."""
+        with self.session_scope() as session:
+            session.add(Outbox(kind=kind, payload=payload, created_at=now, available_at=now))
+
+    def claim_outbox(self, now, limit, lease_until):
+        """Claim up to `limit` entries due by `now`, oldest first, hiding them
+        from other dispatchers until `lease_until`. On PostgreSQL entries
+        being claimed by another dispatcher are skipped rather than waited
+        for."""
+        with self.session_scope() as session:
+            entries = session.query(Outbox)\
+                .filter(Outbox.available_at <= now)\
+                .order_by(Outbox.available_at, Outbox.id)\
+                .limit(limit)\
+                .with_for_update(skip_locked=True)\
+                .all()
+            for entry in entries:
+                entry.available_at = lease_until
+            return [dict(id=entry.id, kind=entry.kind, payload=entry.payload, attempts=entry.attempts)
+                    for entry in entries]
+
+    def retry_outbox(self, identifier, attempts, available_at, error):
+        with self.session_scope() as session:
+            session.query(Outbox).filter_by(id=identifier).update(dict(
+                attempts=attempts, available_at=available_at, last_error=error),
+                synchronize_session=False)
+
+    def delete_outbox(self, identifiers):
+        if not identifiers:
+            return
+        with self.session_scope() as session:
+            session.query(Outbox).filter(Outbox.id.in_(identifiers))\
+                .delete(synchronize_session=False)
 
     def delete_pipelines(self, flow_id):
         with self.session_scope() as session:
             session.query(Pipelines).filter_by(
                 flow_id=flow_id).delete()
-            session.commit()
+            session.query(PipelineDependency).filter_by(
+                flow_id=flow_id).delete()
 
 
 # S3
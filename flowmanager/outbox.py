@@ -0,0 +1,94 @@
+import datetime
+import logging
+import threading
+
+
+class OutboxDispatcher:
+    """Delivers the external side effects recorded in the registry's outbox.
+
+    Entries are claimed in batches of `batch_size` and passed to the handler
+    of their kind. An entry is deleted once its handler returns, so it's
+    delivered at least once: a failed entry is retried with exponential
+    backoff, up to `max_attempts` times, and the entries of a dispatcher
+    that dies mid-batch are claimed again once their `lease` (in seconds)
+    expires. Several dispatchers can share an outbox.
+    """
+
+    def __init__(self, registry, handlers, batch_size=100, interval=1.0, max_attempts=10,
+                 backoff=1.0, max_backoff=300.0, lease=300.0, clock=datetime.datetime.now):
+        self.registry = registry
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lease = lease
+        self.clock = clock
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.delivered = 0
+        self.retried = 0
+        self.dead = 0
+
+    def start(self):
+        """Dispatch in a background thread, started once."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='outbox-dispatcher', daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        """Dispatch now rather than at the next interval, after new entries
+        were committed."""
+        self._wakeup.set()
+
+    def dispatch(self):
+        """Deliver one batch of due entries. Returns how many were claimed."""
+        now = self.clock()
+        entries = self.registry.claim_outbox(now, self.batch_size,
+                                             now + datetime.timedelta(seconds=self.lease))
+        delivered = []
+        for entry in entries:
+            try:
+                self.handlers[entry['kind']](entry['payload'])
+            except Exception as error:
+                self._failed(entry, error)
+            else:
+                delivered.append(entry['id'])
+        self.registry.delete_outbox(delivered)
+        with self._lock:
+            self.delivered += len(delivered)
+        return len(entries)
+
+    def _failed(self, entry, error):
+        attempts = entry['attempts'] + 1
+        if attempts >= self.max_attempts:
+            logging.error('Giving up on outbox entry %s (%s) after %d attempts: %s',
+                          entry['id'], entry['kind'], attempts, error)
+            available_at = None
+            with self._lock:
+                self.dead += 1
+        else:
+            logging.warning('Outbox entry %s (%s) failed, retrying: %s', entry['id'], entry['kind'], error)
+            delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+            available_at = self.clock() + datetime.timedelta(seconds=delay)
+            with self._lock:
+                self.retried += 1
+        self.registry.retry_outbox(entry['id'], attempts, available_at, str(error))
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                if self.dispatch() >= self.batch_size:
+                    continue
+            except Exception:
+                logging.exception('Failed to dispatch the outbox')
+            self._wakeup.wait(self.interval)
+
+    def stats(self):
+        with self._lock:
+            return dict(delivered=self.delivered, retried=self.retried, dead=self.dead,
+                        running=self._thread is not None)
@@ -4,11 +4,12 @@ import time
 import requests
 
 from flowmanager.config import db_connection_string
-from flowmanager.controllers import _internal_upload
+from flowmanager.controllers import _internal_upload, outbox_dispatcher
 from flowmanager.models import FlowRegistry
 
 if __name__ == '__main__':
     fr = FlowRegistry(db_connection_string)
+    outbox_dispatcher(fr).start()
     base = datetime.datetime.now()
     now = base
     while True:
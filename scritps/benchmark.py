@@ -0,0 +1,248 @@
+import argparse
+import datetime
+import os
+import tempfile
+import time
+
+from flowmanager import codec
+from flowmanager.models import FlowRegistry, Pipelines, JsonType, CompressedJsonType
+from flowmanager.models import STATE_PENDING, STATE_RUNNING, STATE_SUCCESS, STATE_FAILED
+
+
+def make_registry():
+    db_string = os.environ.get('BENCHMARK_DATABASE_URL')
+    if db_string is None:
+        db_string = 'sqlite:///' + tempfile.mktemp(suffix='.sqlite')
+    return FlowRegistry(db_string)
+
+
+def report(name, count, elapsed, unit='ops'):
+    print('%-50s %10.1f %s/sec' % (name, count / elapsed, unit))
+
+
+# Flow status
+
+def legacy_check_flow_status(registry, flow_id):
+    with registry.session_scope() as session:
+        running = session.query(Pipelines).filter_by(
+            flow_id=flow_id, status=STATE_RUNNING).first()
+        if running is not None:
+            return STATE_RUNNING
+        success = session.query(Pipelines).filter_by(
+            flow_id=flow_id, status=STATE_SUCCESS).first()
+        pending = session.query(Pipelines).filter_by(
+            flow_id=flow_id, status=STATE_PENDING).first()
+        failed = session.query(Pipelines).filter_by(
+            flow_id=flow_id, status=STATE_FAILED).first()
+        if pending is not None:
+            if (success is not None) or (failed is not None):
+                return STATE_RUNNING
+            return STATE_PENDING
+        if failed is not None:
+            return STATE_FAILED
+        return STATE_SUCCESS
+
+
+def bench_flow_status(registry, sizes, rounds):
+    now = datetime.datetime.now()
+    for size in sizes:
+        flow_id = 'bench/flow-status/%d' % size
+        for i in range(size):
+            registry.save_pipeline(dict(
+                pipeline_id='%s:%d' % (flow_id, i), flow_id=flow_id,
+                pipeline_details={}, status=STATE_SUCCESS,
+                created_at=now, updated_at=now))
+        # Worst case for the legacy code path: no running pipeline, so all
+        # four probes are issued on every callback.
+        for name, check in (('legacy', lambda f: legacy_check_flow_status(registry, f)),
+                            ('grouped', registry.check_flow_status)):
+            start = time.perf_counter()
+            for i in range(rounds):
+                pipeline_id = '%s:%d' % (flow_id, i % size)
+                registry.update_pipeline(pipeline_id, dict(status=STATE_SUCCESS, updated_at=now))
+                check(flow_id)
+            report('flow status %-8s %5d pipelines' % (name, size),
+                   rounds, time.perf_counter() - start, 'callbacks')
+
+
+# Upload registration
+
+def pipeline_docs(flow_id, size, now):
+    return [
+        dict(pipeline_id='%s:%d' % (flow_id, i), flow_id=flow_id,
+             title='Pipeline %d' % i, pipeline_details={'dependencies': []},
+             status=STATE_PENDING, errors=[], logs=[], stats={},
+             created_at=now, updated_at=now)
+        for i in range(size)
+    ]
+
+
+def bench_upload(registry, sizes, rounds):
+    now = datetime.datetime.now()
+    rounds = max(1, rounds // 10)
+
+    def legacy(dataset_id, size):
+        revision = registry.create_revision(dataset_id, now, STATE_PENDING, [])
+        for doc in pipeline_docs(revision['revision_id'], size, now):
+            registry.save_pipeline(doc)
+
+    def bulk(dataset_id, size):
+        with registry.transaction():
+            revision = registry.create_revision(dataset_id, now, STATE_PENDING, [])
+            registry.save_pipelines(pipeline_docs(revision['revision_id'], size, now))
+
+    for size in sizes:
+        for name, register in (('legacy', legacy), ('bulk', bulk)):
+            dataset_id = 'bench/upload-%s/%d' % (name, size)
+            start = time.perf_counter()
+            for i in range(rounds):
+                register(dataset_id, size)
+            elapsed = time.perf_counter() - start
+            print('%-50s %10.2f ms/upload' % ('upload %-8s %5d pipelines' % (name, size),
+                                              elapsed * 1000 / rounds))
+
+
+# Callback reads
+
+def bench_callback_reads(registry, sizes, rounds):
+    now = datetime.datetime.now()
+    stats = dict(bytes=0, seconds=0.0)
+    decode = JsonType.process_result_value
+
+    def counting_decode(self, value, dialect):
+        start = time.perf_counter()
+        ret = decode(self, value, dialect)
+        stats['seconds'] += time.perf_counter() - start
+        stats['bytes'] += len(value) if value else 0
+        return ret
+
+    def legacy(dataset_id, flow_id, pipeline_id):
+        registry.get_pipeline(pipeline_id)
+        registry.get_flow_id(pipeline_id)
+        registry.get_revision_by_revision_id(flow_id)
+        registry.get_dataset(dataset_id)
+        registry.get_revision(dataset_id, 'successful')
+
+    def projected(dataset_id, flow_id, pipeline_id):
+        registry.get_pipeline(pipeline_id, fields=['flow_id', 'title'])
+        registry.get_dataset(dataset_id, fields=['certified'])
+        registry.get_revision(dataset_id, 'successful', fields=['revision_id'])
+
+    JsonType.process_result_value = counting_decode
+    try:
+        for size in sizes:
+            dataset_id = 'bench/callback-reads-%d' % size
+            spec = {'meta': {'dataset': dataset_id, 'ownerid': 'bench'},
+                    'inputs': [{'kind': 'datapackage', 'parameters': {'descriptor': {
+                        'resources': [{'name': 'res%d' % i, 'path': 'data/res%d.csv' % i,
+                                       'schema': {'fields': [{'name': 'f%d' % j, 'type': 'string'}
+                                                             for j in range(10)]}}
+                                      for i in range(size)]}}}]}
+            registry.save_dataset(dict(identifier=dataset_id, owner='bench', spec=spec,
+                                       created_at=now, updated_at=now))
+            revision = registry.create_revision(dataset_id, now, STATE_RUNNING, [])
+            flow_id = revision['revision_id']
+            docs = pipeline_docs(flow_id, size, now)
+            registry.save_pipelines(docs)
+            registry.update_revision(flow_id, dict(
+                logs=['log line %d' % i for i in range(size * 10)],
+                pipelines={doc['pipeline_id']: dict(title=doc['title'], status='SUCCEEDED',
+                                                    stats={'rows': 1000, 'bytes': 10000}, error_log=[])
+                           for doc in docs}))
+            for name, reads in (('legacy', legacy), ('projected', projected)):
+                stats.update(bytes=0, seconds=0.0)
+                for i in range(rounds):
+                    reads(dataset_id, flow_id, docs[i % size]['pipeline_id'])
+                print('%-50s %10.0f bytes %8.3f ms json decode per callback' % (
+                    'callback reads %-9s %4d pipelines' % (name, size),
+                    stats['bytes'] / rounds, stats['seconds'] * 1000 / rounds))
+    finally:
+        JsonType.process_result_value = decode
+
+
+# JSON codecs
+
+def realistic_flow(size, now):
+    spec = {'meta': {'dataset': 'bench', 'ownerid': 'bench', 'owner': 'bench',
+                     'findability': 'published', 'update_time': now.isoformat()},
+            'inputs': [{'kind': 'datapackage', 'url': 'http://example.com/datapackage.json',
+                        'parameters': {'resource-mapping': {'res%d' % i: 'data/res%d.csv' % i
+                                                            for i in range(size)},
+                                       'descriptor': {'name': 'bench', 'resources': [
+                                           {'name': 'res%d' % i, 'path': 'data/res%d.csv' % i,
+                                            'format': 'csv',
+                                            'schema': {'fields': [{'name': 'f%d' % j, 'type': 'number'}
+                                                                  for j in range(10)]}}
+                                           for i in range(size)]}}}]}
+    pipelines = {'bench/%d:%d' % (size, i): dict(title='Creating CSV', status='SUCCEEDED',
+                                                 stats={'rows': 1000 * i, 'bytes': 123456, 'hash': 'ab' * 16},
+                                                 error_log=[])
+                 for i in range(size)}
+    return [('spec', spec), ('pipelines', pipelines)]
+
+
+def bench_codec(registry, sizes, rounds):
+    now = datetime.datetime.now()
+    for size in sizes:
+        for label, doc in realistic_flow(size, now):
+            for name in sorted(codec.CODECS):
+                dumps, loads = codec.get_codec(name)
+                encoded = dumps(doc)
+                start = time.perf_counter()
+                for i in range(rounds):
+                    dumps(doc)
+                encode = time.perf_counter() - start
+                start = time.perf_counter()
+                for i in range(rounds):
+                    loads(encoded)
+                decode = time.perf_counter() - start
+                print('%-50s %8.1f MB/s encode %8.1f MB/s decode' % (
+                    'codec %-7s %-10s %5d entries (%d KB)' % (name, label, size, len(encoded) // 1024),
+                    len(encoded) * rounds / encode / 1e6, len(encoded) * rounds / decode / 1e6))
+
+
+# Compressed blobs
+
+def bench_compression(registry, sizes, rounds):
+    now = datetime.datetime.now()
+    rounds = max(1, rounds // 10)
+    threshold = CompressedJsonType.threshold
+    try:
+        for size in sizes:
+            logs = ['%s INFO pipeline row %d processed, %d bytes written' % (now.isoformat(), i, i * 17)
+                    for i in range(size * 10)]
+            for compress in (0, 1024):
+                CompressedJsonType.threshold = compress
+                path = tempfile.mktemp(suffix='.sqlite')
+                sized = FlowRegistry('sqlite:///' + path)
+                start = time.perf_counter()
+                for i in range(rounds):
+                    revision = sized.create_revision('bench/compression', now, STATE_RUNNING, [])
+                    sized.update_revision(revision['revision_id'], dict(logs=logs, stats={'rows': size}))
+                elapsed = time.perf_counter() - start
+                print('%-50s %10d KB %8.2f ms/update' % (
+                    'compression %-4s %6d log lines' % ('on' if compress else 'off', len(logs)),
+                    os.path.getsize(path) // 1024, elapsed * 1000 / rounds))
+                os.unlink(path)
+    finally:
+        CompressedJsonType.threshold = threshold
+
+
+BENCHMARKS = {
+    'flow-status': lambda registry, args: bench_flow_status(registry, args.sizes, args.rounds),
+    'upload': lambda registry, args: bench_upload(registry, args.sizes, args.rounds),
+    'callback-reads': lambda registry, args: bench_callback_reads(registry, args.sizes, args.rounds),
+    'codec': lambda registry, args: bench_codec(registry, args.sizes, args.rounds),
+    'compression': lambda registry, args: bench_compression(registry, args.sizes, args.rounds),
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Registry micro-benchmarks')
+    parser.add_argument('benchmarks', nargs='*', default=sorted(BENCHMARKS))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--rounds', type=int, default=500)
+    args = parser.parse_args()
+    registry = make_registry()
+    for name in args.benchmarks:
+        BENCHMARKS[name](registry, args)
@@ -0,0 +1,61 @@
+import datetime
+
+import auth
+import jwt
+import pytest
+from flask import Flask
+
+import flowmanager.blueprint
+from flowmanager.models import FlowRegistry
+
+private_key = open('tests/private.pem').read()
+public_key = open('tests/public.pem').read()
+
+
+class NoDispatcher:
+    def start(self):
+        pass
+
+
+def token_of(owner):
+    return jwt.encode(dict(userid=owner, permissions={}, service='source'),
+                      private_key, algorithm='RS256').decode('ascii')
+
+
+@pytest.fixture
+def client(monkeypatch):
+    registry = FlowRegistry('sqlite://')
+    now = datetime.datetime.now()
+    for owner in ('metrics', 'upload'):
+        registry.save_dataset(dict(identifier='%s/id' % owner, owner=owner, spec={},
+                                   updated_at=now, created_at=now))
+    monkeypatch.setattr(flowmanager.blueprint, 'FlowRegistry', lambda connection_string: registry)
+    monkeypatch.setattr(flowmanager.blueprint, 'Verifyer',
+                        lambda auth_endpoint: auth.lib.Verifyer(public_key=public_key))
+    monkeypatch.setattr(flowmanager.blueprint, 'outbox_dispatcher', lambda registry: NoDispatcher())
+    app = Flask(__name__)
+    app.register_blueprint(flowmanager.blueprint.make_blueprint(), url_prefix='/source/')
+    return app.test_client()
+
+
+def test_listings_of_owners_named_like_routes(client):
+    for owner in ('metrics', 'upload'):
+        headers = {'auth-token': token_of(owner)}
+        ret = client.get('/source/datasets?owner=%s' % owner, headers=headers)
+        assert [dataset['id'] for dataset in ret.get_json()['datasets']] == ['%s/id' % owner]
+        ret = client.get('/source/revisions?owner=%s&dataset=id' % owner, headers=headers)
+        assert ret.get_json() == dict(revisions=[], next=None)
+    assert 'cache' in client.get('/source/metrics').get_json()
+
+
+def test_listings_need_an_owner(client):
+    headers = {'auth-token': token_of('metrics')}
+    assert client.get('/source/datasets', headers=headers).status_code == 400
+    assert client.get('/source/revisions?owner=metrics', headers=headers).status_code == 400
+
+
+@pytest.mark.parametrize('path', ['datasets?owner=metrics', 'revisions?owner=metrics&dataset=id'])
+def test_listings_need_the_owners_token(client, path):
+    assert client.get('/source/' + path).status_code == 403
+    assert client.get('/source/' + path, headers={'auth-token': token_of('upload')}).status_code == 403
+    assert client.get('/source/%s&jwt=%s' % (path, token_of('metrics'))).status_code == 200
@@ -0,0 +1,66 @@
+import threading
+import time
+
+import pytest
+
+from flowmanager.broker import Broker, TooManySubscribers
+
+
+def test_wait_returns_events_after_cursor():
+    broker = Broker()
+    since = broker.cursor
+    broker.publish('me/id/1', 'first')
+    broker.publish('me/id/2', 'other')
+    broker.publish('me/id/1', 'second')
+    events = broker.wait('me/id/1', since, 0)
+    assert [event for _, event in events] == ['first', 'second']
+    assert broker.wait('me/id/1', events[-1][0], 0) == []
+
+
+def test_wait_blocks_until_published():
+    broker = Broker()
+    since = broker.cursor
+    timer = threading.Timer(0.05, broker.publish, ('me/id/1', 'done'))
+    timer.start()
+    start = time.monotonic()
+    events = broker.wait('me/id/1', since, 5)
+    assert [event for _, event in events] == ['done']
+    assert time.monotonic() - start < 5
+    assert broker.wait('me/id/1', events[-1][0], 0.01) == []
+
+
+def test_history_is_bounded():
+    broker = Broker(history=2, max_flows=2)
+    since = broker.cursor
+    for i in range(3):
+        broker.publish('me/id/1', i)
+    broker.publish('me/id/2', 'a')
+    broker.publish('me/id/3', 'b')
+    assert broker.events('me/id/1', since) == []
+    assert [event for _, event in broker.events('me/id/2', since)] == ['a']
+    assert broker.stats()['flows'] == 2
+
+
+def test_subscribers_are_bounded():
+    broker = Broker(max_subscribers=1)
+    with broker.subscribe():
+        with pytest.raises(TooManySubscribers):
+            broker.subscribe()
+    broker.subscribe().release()
+    assert broker.stats()['subscribers'] == 0
+
+
+def test_missed_events():
+    broker = Broker(history=2, max_flows=2)
+    since = broker.cursor
+    assert broker.missed('me/id/1', since - 1)
+    assert not broker.missed('me/id/1', since)
+    for i in range(3):
+        broker.publish('me/id/1', i)
+    assert broker.missed('me/id/1', since)
+    assert not broker.missed('me/id/1', since + 1)
+    broker.publish('me/id/2', 'a')
+    broker.publish('me/id/3', 'b')
+    assert broker.missed('me/id/1', since + 2)
+    assert not broker.missed('me/id/1', since + 3)
+    assert not broker.missed('me/id/2', since)
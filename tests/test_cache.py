@@ -0,0 +1,146 @@
+import datetime
+
+from flowmanager.cache import LocalCache, NullCache, RedisCache, make_cache
+from flowmanager.models import FlowRegistry
+
+now = datetime.datetime.now()
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRedis:
+    """Just the subset of the redis client RedisCache uses."""
+
+    def __init__(self):
+        self.hashes = {}
+        self.values = {}
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[field] = value.encode('utf-8')
+
+    def hdel(self, key, field):
+        self.hashes.get(key, {}).pop(field, None)
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def incr(self, key):
+        self.values[key] = str(int(self.values.get(key) or 0) + 1).encode('utf-8')
+        return int(self.values[key])
+
+    def expire(self, key, seconds):
+        pass
+
+    def delete(self, key):
+        self.hashes.pop(key, None)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((getattr(self.client, name), args))
+
+    def execute(self):
+        return [command(*args) for command, args in self.commands]
+
+
+def test_local_cache_evicts_least_recently_used():
+    cache = LocalCache(size=2)
+    cache.set('me/a', 1, 'a1')
+    cache.set('me/a', 'latest', 'a-latest')
+    assert cache.get('me/a', '1') == 'a1'
+    cache.set('me/b', 1, 'b1')
+    assert len(cache) == 2
+    assert cache.get('me/a', 'latest') is None
+    assert cache.get('me/a', 1) == 'a1'
+    assert cache.get('me/b', 1) == 'b1'
+
+
+def test_local_cache_expires_entries():
+    clock = Clock()
+    cache = LocalCache(ttl=10, clock=clock)
+    cache.set('me/a', 1, 'a1')
+    clock.now = 9
+    assert cache.get('me/a', 1) == 'a1'
+    clock.now = 10
+    assert cache.get('me/a', 1) is None
+    assert len(cache) == 0
+
+
+def test_local_cache_invalidates_every_selector_of_a_dataset():
+    cache = LocalCache()
+    for selector in (1, 'latest', 'successful'):
+        cache.set('me/a', selector, 'a')
+    cache.set('me/b', 'latest', 'b')
+    cache.invalidate('me/a')
+    for selector in (1, 'latest', 'successful'):
+        assert cache.get('me/a', selector) is None
+    assert cache.get('me/b', 'latest') == 'b'
+    assert cache.stats() == dict(backend='LocalCache', hits=1, misses=3,
+                                 invalidations=1, hit_ratio=0.25)
+
+
+def test_redis_cache():
+    cache = RedisCache(FakeRedis())
+    cache.set('me/a', 'latest', dict(id='me/a/1', state='QUEUED'))
+    cache.set('me/a', 1, dict(id='me/a/1', state='QUEUED'))
+    assert cache.get('me/a', 'latest') == dict(id='me/a/1', state='QUEUED')
+    cache.invalidate('me/a')
+    assert cache.get('me/a', 1) is None
+    assert cache.stats()['hits'] == 1
+
+
+def test_responses_read_before_an_invalidation_are_not_cached():
+    for cache in (LocalCache(), RedisCache(FakeRedis())):
+        generation = cache.generation('me/a')
+        cache.invalidate('me/a')
+        cache.set('me/a', 'latest', dict(state='QUEUED'), generation)
+        assert cache.get('me/a', 'latest') is None
+        cache.set('me/a', 'latest', dict(state='RUNNING'), cache.generation('me/a'))
+        assert cache.get('me/a', 'latest') == dict(state='RUNNING')
+
+
+def test_make_cache():
+    assert isinstance(make_cache('none'), NullCache)
+    assert isinstance(make_cache('local'), LocalCache)
+
+
+def test_registry_writes_invalidate_after_commit():
+    cache = LocalCache()
+    registry = FlowRegistry('sqlite://', cache=cache)
+    registry.save_dataset(dict(identifier='me/a', owner='me', spec={}))
+    for selector in ('latest', 'successful'):
+        cache.set('me/a', selector, {})
+    with registry.transaction():
+        revision = registry.create_revision('me/a', now, 'pending', [])
+        assert cache.get('me/a', 'latest') == {}
+    assert cache.get('me/a', 'latest') is None
+    assert cache.get('me/a', 'successful') is None
+
+    cache.set('me/a', 1, {})
+    registry.update_pipeline_status(revision['revision_id'], 'me/a:csv', dict(status='FAILED'))
+    assert cache.get('me/a', 1) is None
+
+    cache.set('me/a', 1, {})
+    try:
+        with registry.transaction():
+            registry.update_revision(revision['revision_id'], dict(status='failed'))
+            raise RuntimeError()
+    except RuntimeError:
+        pass
+    assert cache.get('me/a', 1) == {}
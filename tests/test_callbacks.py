@@ -0,0 +1,121 @@
+import threading
+
+from flowmanager.callbacks import CallbackQueue
+
+
+class Recorder:
+    """Records applied callbacks, holding the first one until released, and
+    failing those in state `fail_on` (the first `failures` of them)."""
+
+    def __init__(self, fail_on=None, failures=None):
+        self.calls = []
+        self.errors = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.fail_on = fail_on
+        self.failures = failures
+
+    def __call__(self, pipeline_id, state, errors=None, stats=None):
+        self.started.set()
+        self.release.wait(5)
+        self.calls.append((pipeline_id, state, stats))
+        self.errors.append(errors)
+        if state == self.fail_on and self.failures != 0:
+            if self.failures is not None:
+                self.failures -= 1
+            raise RuntimeError(state)
+
+
+def test_progress_is_coalesced_in_order():
+    callback = Recorder()
+    queue = CallbackQueue(callback, workers=2)
+    queue('me/id:a', 'INPROGRESS', stats=dict(rows=1))
+    assert callback.started.wait(5)
+    for rows in (2, 3, 4):
+        queue('me/id:a', 'INPROGRESS', stats=dict(rows=rows))
+    queue('me/id:a', 'SUCCESS', stats=dict(rows=5))
+    queue('me/id:a', 'INPROGRESS', stats=dict(rows=6))
+    callback.release.set()
+    assert queue.join(5)
+    assert callback.calls == [
+        ('me/id:a', 'INPROGRESS', dict(rows=1)),
+        ('me/id:a', 'INPROGRESS', dict(rows=4)),
+        ('me/id:a', 'SUCCESS', dict(rows=5)),
+        ('me/id:a', 'INPROGRESS', dict(rows=6)),
+    ]
+    stats = queue.stats()
+    assert stats['enqueued'] == 6
+    assert stats['coalesced'] == 2
+    assert stats['applied'] == 4
+    assert stats['depth'] == 0
+    assert stats['max_depth'] == 3
+
+
+def test_coalesced_progress_keeps_errors():
+    callback = Recorder()
+    queue = CallbackQueue(callback, workers=1)
+    queue('me/id:a', 'INPROGRESS')
+    assert callback.started.wait(5)
+    queue('me/id:a', 'INPROGRESS', errors=['bad row'], stats=dict(rows=2))
+    queue('me/id:a', 'INPROGRESS', errors=['bad row', 'bad header'], stats=dict(rows=3))
+    queue('me/id:a', 'INPROGRESS', stats=dict(rows=4))
+    callback.release.set()
+    assert queue.join(5)
+    assert callback.calls[-1] == ('me/id:a', 'INPROGRESS', dict(rows=4))
+    assert callback.errors == [None, ['bad row', 'bad header']]
+
+
+def test_full_queue_drops_progress_and_blocks_finish():
+    callback = Recorder()
+    queue = CallbackQueue(callback, workers=1, max_size=1)
+    queue('me/id:a', 'INPROGRESS')
+    assert callback.started.wait(5)
+    queue('me/id:b', 'INPROGRESS')
+    queue('me/id:c', 'INPROGRESS')
+    assert queue.stats()['dropped'] == 1
+
+    finished = threading.Event()
+
+    def finish():
+        queue('me/id:c', 'FAILED')
+        finished.set()
+
+    threading.Thread(target=finish, daemon=True).start()
+    assert not finished.wait(0.05)
+    callback.release.set()
+    assert finished.wait(5)
+    assert queue.join(5)
+    assert [call[:2] for call in callback.calls] == [
+        ('me/id:a', 'INPROGRESS'),
+        ('me/id:b', 'INPROGRESS'),
+        ('me/id:c', 'FAILED'),
+    ]
+
+
+def test_failing_callback_does_not_stop_the_worker():
+    callback = Recorder(fail_on='FAILED')
+    callback.release.set()
+    queue = CallbackQueue(callback, workers=1, final_attempts=2, retry_delay=0)
+    queue('me/id:a', 'INPROGRESS')
+    queue('me/id:a', 'FAILED')
+    queue('me/id:b', 'SUCCESS')
+    assert queue.join(5)
+    assert sorted(call[:2] for call in callback.calls) == [
+        ('me/id:a', 'FAILED'), ('me/id:a', 'FAILED'), ('me/id:a', 'INPROGRESS'), ('me/id:b', 'SUCCESS')]
+    stats = queue.stats()
+    assert stats['applied'] == 3
+    assert stats['retried'] == 1
+    assert stats['failed'] == 1
+
+
+def test_failing_finish_is_retried_before_later_callbacks():
+    callback = Recorder(fail_on='SUCCESS', failures=2)
+    callback.release.set()
+    queue = CallbackQueue(callback, workers=2, final_attempts=3, retry_delay=0)
+    queue('me/id:a', 'SUCCESS')
+    queue('me/id:a', 'INPROGRESS')
+    assert queue.join(5)
+    assert [call[:2] for call in callback.calls] == [('me/id:a', 'SUCCESS')] * 3 + [('me/id:a', 'INPROGRESS')]
+    stats = queue.stats()
+    assert stats['retried'] == 2
+    assert stats['failed'] == 0
@@ -0,0 +1,82 @@
+import datetime
+import decimal
+import json
+
+import pytest
+from sqlalchemy.dialects import postgresql, sqlite
+
+from flowmanager import codec
+from flowmanager.models import JsonType, CompressedJsonType, FlowRegistry
+
+from .config import load_spec
+
+
+@pytest.mark.parametrize('name', sorted(codec.CODECS))
+def test_codec_round_trip(name):
+    dumps, loads = codec.get_codec(name)
+    spec = load_spec('simple')
+    assert loads(dumps(spec)) == spec
+
+
+@pytest.mark.parametrize('name', sorted(codec.CODECS))
+def test_codec_encodes_datetime_and_decimal(name):
+    dumps, loads = codec.get_codec(name)
+    now = datetime.datetime(2018, 1, 2, 3, 4, 5, 6)
+    ret = loads(dumps({'created': now, 'day': now.date(), 'bytes': decimal.Decimal('1.5')}))
+    assert ret == {'created': '2018-01-02T03:04:05.000006', 'day': '2018-01-02', 'bytes': 1.5}
+
+
+def test_unknown_codec_falls_back_to_json():
+    assert codec.get_codec('no-such-codec') == codec.CODECS['json']
+
+
+def test_json_type_is_dialect_aware():
+    json_type = JsonType()
+    assert isinstance(json_type.load_dialect_impl(postgresql.dialect()), postgresql.JSONB)
+    assert json_type.process_bind_param({'a': 1}, postgresql.dialect()) == {'a': 1}
+
+    dialect = sqlite.dialect()
+    assert json_type.process_result_value(json_type.process_bind_param({'a': [1]}, dialect), dialect) == {'a': [1]}
+    assert json_type.process_result_value(None, dialect) is None
+
+
+@pytest.fixture
+def compression():
+    threshold = CompressedJsonType.threshold
+    CompressedJsonType.threshold = 256
+    yield
+    CompressedJsonType.threshold = threshold
+
+
+@pytest.mark.parametrize('dialect', [sqlite.dialect(), postgresql.dialect()])
+def test_compressed_json_type(compression, dialect):
+    json_type = CompressedJsonType()
+    small = ['a', 'log']
+    large = ['log line %d' % i for i in range(1000)]
+    stored = json_type.process_bind_param(large, dialect)
+    assert len(str(stored)) < len(codec.dumps(large)) / 4
+    assert json_type.process_result_value(stored, dialect) == large
+    stored = json_type.process_bind_param(small, dialect)
+    assert CompressedJsonType.ENVELOPE_KEY not in str(stored)
+    assert json_type.process_result_value(stored, dialect) == small
+
+
+def test_compressed_json_reads_uncompressed_rows(compression):
+    registry = FlowRegistry('sqlite://')
+    logs = ['log line %d' % i for i in range(1000)]
+    CompressedJsonType.threshold = 0
+    registry.save_dataset_revision(dict(revision_id='me/id/1', dataset_id='me/id', revision=1, logs=logs))
+    CompressedJsonType.threshold = 256
+    registry.save_dataset_revision(dict(revision_id='me/id/2', dataset_id='me/id', revision=2, logs=logs))
+    assert registry.get_revision('me/id', 1)['logs'] == logs
+    assert registry.get_revision('me/id', 2)['logs'] == logs
+    raw = registry.engine.execute('SELECT revision, logs FROM dataset_revision').fetchall()
+    sizes = dict(raw)
+    assert len(sizes[2]) < len(sizes[1]) / 4
+
+
+def test_iterdumps():
+    now = datetime.datetime.now()
+    values = [{'a': 1}, None, [now]]
+    assert json.loads(''.join(codec.iterdumps(values))) == [{'a': 1}, None, [now.isoformat()]]
+    assert ''.join(codec.iterdumps([])) == '[]'
@@ -1,5 +1,6 @@
 import copy
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 import json
 
 import auth
@@ -9,16 +10,30 @@ import os
 import requests
 import time
 
+from flowmanager.broker import Broker
+from flowmanager.cache import NullCache
+from flowmanager.config import get_dedup
 from flowmanager.models import FlowRegistry, get_descriptor, get_s3_client
-from werkzeug.exceptions import NotFound
+from sqlalchemy import event
+from werkzeug.exceptions import BadRequest, NotFound, ServiceUnavailable
 import requests_mock
+import yaml
 
 from .config import load_spec
 
 import flowmanager.controllers
 upload = flowmanager.controllers.upload
+upload_batch = flowmanager.controllers.upload_batch
 callback = flowmanager.controllers.PipelineStatusCallback
 info = flowmanager.controllers.info
+conditional_info = flowmanager.controllers.conditional_info
+batch_info = flowmanager.controllers.batch_info
+list_datasets = flowmanager.controllers.list_datasets
+list_revisions = flowmanager.controllers.list_revisions
+poll_events = flowmanager.controllers.poll_events
+EventStream = flowmanager.controllers.EventStream
+metrics = flowmanager.controllers.metrics
+outbox_dispatcher = flowmanager.controllers.outbox_dispatcher
 flowmanager.controllers.dpp_server = 'http://dpp/'
 
 os.environ['PKGSTORE_BUCKET'] = 'testing.bucket.com'
@@ -244,6 +259,231 @@ def test_grabs_info_for_latest_successful(full_registry):
     }
 
 
+def test_info_is_cached_until_updated(full_registry):
+    statements = []
+    event.listen(full_registry.engine, 'before_cursor_execute',
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+    ret = info('me', 'id', 'latest', full_registry)
+    queries = len(statements)
+    assert info('me', 'id', 'latest', full_registry) == ret
+    assert len(statements) == queries
+    assert metrics(full_registry)['cache']['hits'] == 1
+
+    update({"pipeline_id": "me/id", "event": "progress", "success": None, "errors": []},
+           full_registry)
+    ret = info('me', 'id', 'latest', full_registry)
+    assert ret['state'] == 'INPROGRESS'
+    assert metrics(full_registry)['cache']['misses'] == 2
+
+
+def test_conditional_info(full_registry):
+    etag, ret = conditional_info('me', 'id', 'latest', full_registry)
+    assert ret == info('me', 'id', 'latest', full_registry)
+    assert conditional_info('me', 'id', 'latest', full_registry, [etag]) == (etag, None)
+    assert conditional_info('me', 'id', 1, full_registry, [etag]) == (etag, None)
+
+    # Without the cache, a matching ETag doesn't load the JSON columns
+    full_registry.cache = NullCache()
+    statements = []
+    event.listen(full_registry.engine, 'before_cursor_execute',
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+    assert conditional_info('me', 'id', 'latest', full_registry, [etag]) == (etag, None)
+    assert statements
+    assert not any('spec' in statement or 'logs' in statement for statement in statements)
+
+    update({"pipeline_id": "me/id", "event": "progress", "success": None, "errors": []},
+           full_registry)
+    new_etag, ret = conditional_info('me', 'id', 'latest', full_registry, [etag])
+    assert new_etag != etag
+    assert ret['state'] == 'INPROGRESS'
+
+
+def test_info_read_before_a_write_is_not_cached(full_registry, monkeypatch):
+    get_revision = full_registry.get_revision
+
+    def get_revision_then_write(*args, **kwargs):
+        revision = get_revision(*args, **kwargs)
+        # A writer commits after the revision was read
+        full_registry.update_revision('me/id/1', dict(status='failed'))
+        return revision
+
+    monkeypatch.setattr(full_registry, 'get_revision', get_revision_then_write)
+    assert conditional_info('me', 'id', 1, full_registry)[1]['state'] == 'QUEUED'
+    monkeypatch.undo()
+    assert conditional_info('me', 'id', 1, full_registry)[1]['state'] == 'FAILED'
+
+
+def test_info_fields_and_pipeline_pages(full_registry):
+    for pipeline_id, status in (('me/id:a', 'FAILED'), ('me/id:b', 'SUCCEEDED'), ('me/id:c', 'FAILED')):
+        full_registry.update_pipeline_status('me/id/1', pipeline_id, dict(
+            title=pipeline_id, status=status, stats={'rows': 1}, error_log=['log'], updated_at=now))
+    statements = []
+    event.listen(full_registry.engine, 'before_cursor_execute',
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+    etag, ret = conditional_info('me', 'id', 1, full_registry,
+                                 fields=['state', 'pipelines.status'], pipelines_limit=2)
+    assert ret == {
+        'state': 'QUEUED',
+        'pipelines': {'me/id:a': {'status': 'FAILED'}, 'me/id:b': {'status': 'SUCCEEDED'}},
+        'pipelines_next': 'me/id:b',
+    }
+    assert not any(column in statement for statement in statements
+                   for column in ('spec', 'logs', 'stats', 'error_log'))
+    assert etag == conditional_info('me', 'id', 1, full_registry)[0]
+
+    _, ret = conditional_info('me', 'id', 1, full_registry, fields=['pipelines'],
+                              pipelines_status='FAILED', pipelines_after='me/id:a')
+    assert ret == {'pipelines': {'me/id:c': dict(title='me/id:c', status='FAILED',
+                                                 stats={'rows': 1}, error_log=['log'])}}
+
+    with pytest.raises(BadRequest):
+        conditional_info('me', 'id', 1, full_registry, fields=['state.status'])
+    for limit in (0, -1):
+        with pytest.raises(BadRequest):
+            conditional_info('me', 'id', 1, full_registry, pipelines_limit=limit)
+
+
+def test_batch_info(full_registry):
+    items = [
+        dict(owner='me', dataset='id'),
+        dict(owner='you', dataset='id', revision=2),
+        dict(owner='you', dataset='id', revision='successful'),
+        dict(owner='you', dataset='id', revision='1'),
+        dict(owner='me', dataset='id', revision=99),
+        dict(owner='nobody', dataset='id'),
+    ]
+    assert list(batch_info(items, full_registry)) == [
+        info('me', 'id', 'latest', full_registry),
+        info('you', 'id', 2, full_registry),
+        info('you', 'id', 'successful', full_registry),
+        info('you', 'id', 1, full_registry),
+        None,
+        None,
+    ]
+    assert list(batch_info(items[:2], full_registry, fields=['state', 'pipelines.status'])) == [
+        dict(state='QUEUED', pipelines={}),
+        dict(state='SUCCEEDED', pipelines={}),
+    ]
+    with pytest.raises(BadRequest):
+        batch_info([dict(owner='me')], full_registry)
+
+
+def test_batch_info_queries_are_constant(full_registry):
+    statements = []
+    event.listen(full_registry.engine, 'before_cursor_execute',
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+    counts = []
+    for size in (1, 50):
+        del statements[:]
+        list(batch_info([dict(owner='me', dataset='id%d' % i if i else 'id', revision=revision)
+                         for i in range(size) for revision in ('latest', 'successful', 1)],
+                        full_registry))
+        counts.append(len(statements))
+    assert counts[0] == counts[1]
+
+
+def test_list_datasets(full_registry):
+    assert list_datasets('me', full_registry) == dict(
+        datasets=[dict(id='me/id', created=now.isoformat(), modified=now.isoformat(), certified=False)],
+        next=None)
+    assert list_datasets('nobody', full_registry) == dict(datasets=[], next=None)
+
+
+def test_list_revisions(full_registry):
+    ret = list_revisions('you', 'id', full_registry, limit=2)
+    assert [(revision['id'], revision['state']) for revision in ret['revisions']] == \
+        [('you/id/3', 'QUEUED'), ('you/id/2', 'SUCCEEDED')]
+    assert ret['next'] == 2
+    ret = list_revisions('you', 'id', full_registry, after=ret['next'])
+    assert [revision['id'] for revision in ret['revisions']] == ['you/id/1']
+    assert ret['next'] is None
+    ret = list_revisions('you', 'id', full_registry, state='SUCCEEDED')
+    assert [revision['revision'] for revision in ret['revisions']] == [2]
+    with pytest.raises(BadRequest):
+        list_revisions('you', 'id', full_registry, state='DONE')
+
+
+def test_poll_events(full_registry):
+    ret = poll_events('me', 'id', 'latest', full_registry)
+    assert ret['events'] == [dict(id='me/id/1', state='QUEUED', modified=now.isoformat())]
+    assert poll_events('me', 'id', 1, full_registry, since=ret['cursor'], timeout=0) == \
+        dict(cursor=ret['cursor'], events=[])
+
+    update({"pipeline_id": "me/id", "event": "progress", "success": None, "errors": []},
+           full_registry)
+    ret = poll_events('me', 'id', 'latest', full_registry, since=ret['cursor'], timeout=0)
+    assert [(event['id'], event['state'], event['pipeline'], event['pipeline_state'])
+            for event in ret['events']] == [('me/id/1', 'INPROGRESS', 'me/id', 'INPROGRESS')]
+
+
+def test_event_stream(full_registry):
+    stream = iter(EventStream('me', 'id', 1, full_registry, keepalive=0))
+    snapshot = next(stream)
+    assert snapshot.startswith('id: ')
+    assert '"state":"QUEUED"' in snapshot.replace(' ', '')
+    assert next(stream) == ': keepalive\n\n'
+    with requests_mock.Mocker() as mock:
+        mock.get('https://api.statuspage.io/v1/pages/None/components', status_code=200, json={})
+        for pipeline_id in ('me/id', 'me/id:non-tabular'):
+            update({"pipeline_id": pipeline_id, "event": "finish", "success": False,
+                    "errors": ['error']}, full_registry)
+    events = list(stream)
+    assert len(events) == 2
+    assert '"state":"FAILED"' in events[-1].replace(' ', '')
+    assert flowmanager.controllers.broker.subscribers == 0
+
+
+def test_event_stream_ends_after_its_lifetime(full_registry):
+    stream = iter(EventStream('me', 'id', 1, full_registry, keepalive=0, lifetime=0))
+    snapshot = next(stream)
+    assert list(stream) == []
+    assert flowmanager.controllers.broker.subscribers == 0
+
+    # A reconnecting client resumes after the last event it received
+    cursor = snapshot.split('\n')[0][len('id: '):]
+    update({"pipeline_id": "me/id", "event": "progress", "success": None, "errors": []}, full_registry)
+    stream = EventStream('me', 'id', 1, full_registry, since=int(cursor), lifetime=10)
+    assert '"state":"INPROGRESS"' in next(iter(stream)).replace(' ', '')
+    stream.close()
+
+
+def test_reconnecting_after_the_flow_finished_out_of_band(full_registry, monkeypatch):
+    since = flowmanager.controllers.broker.cursor
+    # Finished by another process, without an event in this one
+    full_registry.update_revision('me/id/1', dict(status='failed'))
+    stream = EventStream('me', 'id', 1, full_registry, since=since, keepalive=0)
+    events = list(stream)
+    assert len(events) == 1 and '"state":"FAILED"' in events[0].replace(' ', '')
+    ret = poll_events('me', 'id', 1, full_registry, since=since, timeout=0)
+    assert [(event['state'], ret['cursor']) for event in ret['events']] == [('FAILED', since)]
+
+    # After a restart the history of the old process is gone
+    monkeypatch.setattr(flowmanager.controllers, 'broker', Broker())
+    events = list(EventStream('me', 'id', 1, full_registry, since=since))
+    assert len(events) == 1 and '"state":"FAILED"' in events[0].replace(' ', '')
+    ret = poll_events('me', 'id', 1, full_registry, since=since)
+    assert [event['state'] for event in ret['events']] == ['FAILED']
+    assert ret['cursor'] == flowmanager.controllers.broker.cursor
+
+
+def test_event_streams_of_missing_datasets_release_their_slot(full_registry, monkeypatch):
+    monkeypatch.setattr(flowmanager.controllers, 'broker', Broker(max_subscribers=2))
+    for _ in range(3):
+        with pytest.raises(NotFound):
+            EventStream('nobody', 'id', 1, full_registry)
+    stream = iter(EventStream('me', 'id', 1, full_registry, keepalive=0))
+    assert '"state":"QUEUED"' in next(stream).replace(' ', '')
+    assert flowmanager.controllers.broker.subscribers == 1
+
+
+def test_event_subscribers_are_bounded(full_registry, monkeypatch):
+    monkeypatch.setattr(flowmanager.controllers, 'broker', Broker(max_subscribers=0))
+    with pytest.raises(ServiceUnavailable):
+        EventStream('me', 'id', 1, full_registry)
+    with pytest.raises(ServiceUnavailable):
+        poll_events('me', 'id', 1, full_registry, since=flowmanager.controllers.broker.cursor, timeout=0)
+
+
 def test_updates_and_displays_info_with_pipelines(full_registry):
     with requests_mock.Mocker() as mock:
         mock.get('https://api.statuspage.io/v1/pages/None/components', status_code=200, json={})
@@ -320,6 +560,102 @@ def test_updates_and_displays_info_with_pipelines(full_registry):
         # check flow status is failed
         assert ret['state'] == 'FAILED'
 
+
+def test_progress_updates_are_throttled(full_registry):
+    cb = callback(full_registry, progress_interval=60)
+    statements = []
+    event.listen(full_registry.engine, 'before_cursor_execute',
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+    for count in range(1, 4):
+        cb('me/id', 'INPROGRESS', errors=[], stats={'count': count})
+    assert len([statement for statement in statements
+                if statement.startswith('UPDATE pipelines ')]) == 1
+    ret = info('me', 'id', 'latest', full_registry)
+    assert ret['pipelines']['me/id']['stats'] == {'count': 1}
+
+    # Errors are written right away, with the held stats
+    cb('me/id', 'INPROGRESS', errors=['warning'], stats={'rows': 10})
+    ret = info('me', 'id', 'latest', full_registry)
+    assert ret['pipelines']['me/id']['stats'] == {'count': 3, 'rows': 10}
+
+    cb('me/id', 'INPROGRESS', errors=[], stats={'count': 4})
+    with requests_mock.Mocker() as mock:
+        mock.get('https://api.statuspage.io/v1/pages/None/components', status_code=200, json={})
+        cb('me/id', 'SUCCESS', errors=[], stats={'rows': 20})
+    ret = info('me', 'id', 'latest', full_registry)
+    assert ret['pipelines']['me/id'] == {
+        'status': 'SUCCEEDED',
+        'stats': {'count': 4, 'rows': 20},
+        'error_log': [],
+        'title': 'Creating Package'
+    }
+    assert cb.stats() == dict(progress_interval=60, received=5, written=2, throttled=3)
+
+def test_side_effects_are_delivered_from_the_outbox(full_registry, monkeypatch):
+    sent = []
+    monkeypatch.setattr(flowmanager.controllers.statuspage, 'on_incident',
+                        lambda *args: sent.append(('incident',) + args))
+    monkeypatch.setattr(flowmanager.controllers.events, 'send_event',
+                        lambda *args: sent.append(('event',) + args[:3]))
+    monkeypatch.setattr(flowmanager.controllers, 'get_descriptor', lambda flow_id: None)
+    for pipeline_id in ('me/id', 'me/id:non-tabular'):
+        update({"pipeline_id": pipeline_id, "event": "finish", "success": False,
+                "errors": ['error']}, full_registry)
+    assert sent == []
+
+    assert outbox_dispatcher(full_registry).dispatch() == 4
+    assert sent == [
+        ('event', 'flow', 'finish', 'FAIL'),
+        ('incident', 'Pipelines Failed for id', 'me', ['error']),
+    ]
+    assert outbox_dispatcher(full_registry).dispatch() == 0
+
+
+def test_dataset_entries_index_the_current_successful_revision(full_registry, monkeypatch):
+    indexed = []
+    monkeypatch.setattr(flowmanager.controllers, 'get_descriptor', lambda flow_id: indexed.append(flow_id))
+    send_dataset = flowmanager.controllers.OUTBOX_HANDLERS['dataset']
+    # A retried entry of an older revision, delivered after a newer one succeeded
+    stale = dict(dataset_id='you/id', flow_id='you/id/1', unlist=True, certified=False)
+    send_dataset(full_registry, stale)
+    full_registry.update_revision('you/id/3', dict(status='success'))
+    send_dataset(full_registry, stale)
+    send_dataset(full_registry, dict(flow_id='you/id/1', unlist=True, certified=False))
+    assert indexed == ['you/id/2', 'you/id/3', 'you/id/1']
+
+
+def test_callbacks_lock_the_flow_before_reading(full_registry):
+    statements = []
+    event.listen(full_registry.engine, 'before_cursor_execute',
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+    update({"pipeline_id": "me/id", "event": "progress", "success": None, "errors": []}, full_registry)
+    # Without row locks SQLite takes the database write lock instead
+    assert statements[0].startswith('UPDATE dataset_revision SET version=dataset_revision.version')
+
+
+@pytest.mark.parametrize('failing', [0, 1])
+def test_concurrent_callbacks_of_one_flow_finish_it(tmpdir, failing):
+    registry = FlowRegistry('sqlite:///%s/registry.sqlite?timeout=60' % tmpdir)
+    registry.save_dataset(dict(identifier='me/id', owner='me', spec=spec, updated_at=now))
+    registry.create_revision('me/id', now, 'pending', [])
+    pipeline_ids = ['me/id:%d' % i for i in range(16)]
+    registry.save_pipelines([dict(pipeline_id=pipeline_id, flow_id='me/id/1', title=pipeline_id,
+                                  status='pending', pipeline_details={})
+                             for pipeline_id in pipeline_ids])
+    cb = callback(registry, progress_interval=0)
+
+    def run(pipeline_id):
+        cb(pipeline_id, 'INPROGRESS', errors=[], stats={'rows': 1})
+        state = 'FAILED' if failing and pipeline_id == pipeline_ids[-1] else 'SUCCESS'
+        cb(pipeline_id, state, errors=[], stats={'rows': 2})
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(run, pipeline_ids))
+    assert registry.get_revision_by_revision_id('me/id/1')['status'] == ('failed' if failing else 'success')
+    assert info('me', 'id', 1, registry)['state'] == ('FAILED' if failing else 'SUCCEEDED')
+    assert list(registry.list_pipelines_by_id('me/id/1')) == []
+
+
 def test_all_pipeline_statuses_are_updated_if_failed(full_registry):
     with requests_mock.Mocker() as mock:
         mock.get('https://api.statuspage.io/v1/pages/None/components', status_code=200, json={})
@@ -426,6 +762,150 @@ def test_upload_new(empty_registry: FlowRegistry):
         assert len(pipelines) == 7
 
 
+def test_upload_batch(empty_registry, monkeypatch):
+    starts = []
+    monkeypatch.setattr(flowmanager.controllers.runner, 'start', lambda *args, **kwargs: starts.append(args))
+    token = generate_token('me')
+    ret = upload_batch(token, [copy.deepcopy(spec), copy.deepcopy(spec_unauth), copy.deepcopy(spec2), None],
+                       empty_registry, auth.lib.Verifyer(public_key=public_key))
+    assert [(r['success'], r['dataset_id'], r['flow_id']) for r in ret] == [
+        (True, 'me/id', 'me/id/1'),
+        (True, 'me/id2', 'me/id2/1'),
+        (False, None, None),
+        (False, None, None),
+    ]
+    assert ret[2]['errors'] == ['No token or token not authorised for owner']
+    assert len(starts) == 1
+    pipeline_spec = yaml.safe_load(starts[0][1])
+    assert len(pipeline_spec) == 14
+    assert len(list(empty_registry.list_pipelines())) == 14
+    assert empty_registry.num_datasets_for_owner('me') == 2
+
+
+def test_upload_plans_outside_of_transactions(empty_registry, monkeypatch):
+    monkeypatch.setattr(flowmanager.controllers.runner, 'start', lambda *args, **kwargs: None)
+    plan = flowmanager.controllers.planner.plan
+    planned = []
+
+    def checked_plan(revision, contents, **config):
+        planned.append((revision, getattr(empty_registry._local, 'session', None)))
+        return plan(revision, contents, **config)
+
+    monkeypatch.setattr(flowmanager.controllers.planner, 'plan', checked_plan)
+    token = generate_token('me')
+    ret = upload(token, copy.deepcopy(spec), empty_registry, auth.lib.Verifyer(public_key=public_key))
+    assert ret['flow_id'] == 'me/id/1'
+    assert planned == [(1, None)]
+    assert empty_registry.get_revision('me/id')['revision'] == 1
+
+
+def test_upload_dedup(empty_registry, monkeypatch):
+    starts = []
+    monkeypatch.setattr(flowmanager.controllers.runner, 'start', lambda *args, **kwargs: starts.append(args))
+    token = generate_token('me')
+    verifyer = auth.lib.Verifyer(public_key=public_key)
+    assert upload(token, copy.deepcopy(spec), empty_registry, verifyer)['flow_id'] == 'me/id/1'
+
+    # An identical spec reuses the running flow
+    monkeypatch.setattr(flowmanager.controllers, 'dedup', 'reuse')
+    ret = upload(token, copy.deepcopy(spec), empty_registry, verifyer)
+    assert (ret['success'], ret['flow_id']) == (True, 'me/id/1')
+    assert len(starts) == 1
+
+    empty_registry.update_revision('me/id/1', dict(status='success'))
+    empty_registry.delete_pipelines('me/id/1')
+    assert upload(token, copy.deepcopy(spec), empty_registry, verifyer)['flow_id'] == 'me/id/1'
+
+    # 'successful' still resolves to the revision whose outputs are stored
+    monkeypatch.setattr(flowmanager.controllers, 'dedup', 'unchanged')
+    ret = upload(token, copy.deepcopy(spec), empty_registry, verifyer)
+    assert (ret['success'], ret['flow_id']) == (True, 'me/id/1')
+    assert empty_registry.get_revision('me/id', 'successful')['revision_id'] == 'me/id/1'
+    assert empty_registry.get_revision('me/id', 'latest')['revision_id'] == 'me/id/1'
+    assert len(starts) == 1
+
+    changed = copy.deepcopy(spec)
+    changed['meta']['title'] = 'Changed'
+    assert upload(token, changed, empty_registry, verifyer)['flow_id'] == 'me/id/2'
+    assert len(starts) == 2
+
+    # A failed revision is run again
+    empty_registry.update_revision('me/id/2', dict(status='failed'))
+    assert upload(token, copy.deepcopy(changed), empty_registry, verifyer)['flow_id'] == 'me/id/3'
+    assert len(starts) == 3
+
+
+def test_upload_returns_its_errors_when_incidents_cant_be_recorded(empty_registry, monkeypatch):
+    def unavailable(*args, **kwargs):
+        raise RuntimeError('database is unavailable')
+
+    monkeypatch.setattr(flowmanager.controllers, '_internal_upload', unavailable)
+    monkeypatch.setattr(empty_registry, 'add_outbox', unavailable)
+    ret = upload(generate_token('me'), copy.deepcopy(spec), empty_registry,
+                 auth.lib.Verifyer(public_key=public_key))
+    assert not ret['success']
+    assert ret['errors'] == ['Unexpected error: database is unavailable']
+
+
+@pytest.mark.parametrize('name, mode', [('reuse', 'reuse'), ('unchanged', 'unchanged'),
+                                        ('off', 'off'), ('false', 'off'), ('resue', 'off')])
+def test_dedup_setting_is_validated(name, mode):
+    assert get_dedup(name) == mode
+
+
+def test_upload_batch_checks_quota_once(full_registry, monkeypatch):
+    monkeypatch.setattr(flowmanager.controllers.runner, 'start', lambda *args, **kwargs: None)
+    token = generate_token('me', max_datasets=1)
+    ret = upload_batch(token, [copy.deepcopy(spec), copy.deepcopy(spec_unauth)],
+                       full_registry, auth.lib.Verifyer(public_key=public_key))
+    assert [(r['success'], r['flow_id']) for r in ret] == [(True, 'me/id/2'), (False, None)]
+    assert ret[1]['errors'] == ['Max datasets for user exceeded plan limit (1)']
+
+
+def test_upload_batch_rolls_back(empty_registry, monkeypatch):
+    starts = []
+    monkeypatch.setattr(flowmanager.controllers.runner, 'start', lambda *args, **kwargs: starts.append(args))
+    plan = flowmanager.controllers.planner.plan
+    plans = []
+
+    def failing_plan(*args, **kwargs):
+        plans.append(args)
+        if len(plans) == 2:
+            raise ValueError()
+        return plan(*args, **kwargs)
+
+    monkeypatch.setattr(flowmanager.controllers.planner, 'plan', failing_plan)
+    ret = upload_batch(generate_token('me'), [copy.deepcopy(spec), copy.deepcopy(spec_unauth)],
+                       empty_registry, auth.lib.Verifyer(public_key=public_key))
+    assert [(r['success'], r['flow_id']) for r in ret] == [(False, None), (False, None)]
+    assert ret[0]['errors'] == ['Batch registration rolled back']
+    assert ret[1]['errors'] == ['Validation failed for contents']
+    assert starts == []
+    assert list(empty_registry.list_datasets()) == []
+    assert empty_registry.num_datasets_for_owner('me') == 0
+
+
+def test_upload_batch_commit_failure_is_reported_on_the_batch(empty_registry, monkeypatch):
+    starts = []
+    monkeypatch.setattr(flowmanager.controllers.runner, 'start', lambda *args, **kwargs: starts.append(args))
+    save_pipelines = empty_registry.save_pipelines
+    saved = []
+
+    def failing_save_pipelines(pipelines):
+        saved.append(pipelines)
+        if len(saved) == 2:
+            raise RuntimeError('disk full')
+        return save_pipelines(pipelines)
+
+    monkeypatch.setattr(empty_registry, 'save_pipelines', failing_save_pipelines)
+    ret = upload_batch(generate_token('me'), [copy.deepcopy(spec), copy.deepcopy(spec_unauth)],
+                       empty_registry, auth.lib.Verifyer(public_key=public_key))
+    assert [(r['success'], r['flow_id']) for r in ret] == [(False, None), (False, None)]
+    assert [r['errors'] for r in ret] == [['Batch registration rolled back: Unexpected error: disk full']] * 2
+    assert starts == []
+    assert list(empty_registry.list_datasets()) == []
+
+
 def test_upload_existing(full_registry):
     with requests_mock.Mocker() as mock:
         mock.get('http://dpp/api/refresh', status_code=200)
@@ -467,7 +947,7 @@ def test_upload_append(full_registry):
         assert ret['errors'] == []
         specs = list(full_registry.list_datasets())
         assert len(specs) == 3
-        first = specs[2]
+        first = specs[1]
 
         assert first.owner == 'me2'
         assert first.identifier == 'me2/id2'
@@ -531,6 +1011,21 @@ def test_update_running(full_registry):
     assert revision['pipelines']['me/id']['error_log'] == []
     assert revision['pipelines']['me/id']['title'] == 'Creating Package'
 
+def test_update_commits_once(full_registry):
+    commits = []
+    event.listen(full_registry.engine, 'commit', lambda conn: commits.append(conn))
+    payload = {
+      "pipeline_id": "me/id",
+      "event": "progress",
+      "success": None,
+      "errors": []
+    }
+    update(payload, full_registry)
+    assert len(commits) == 1
+    revision = full_registry.get_revision_by_revision_id('me/id/1')
+    assert revision['pipelines']['me/id']['status'] == 'INPROGRESS'
+
+
 def test_update_fail(full_registry):
     with requests_mock.Mocker() as mock:
         mock.get('https://api.statuspage.io/v1/pages/None/components', status_code=200, json={})
@@ -580,6 +1075,7 @@ def test_update_fail(full_registry):
         assert revision['pipelines']['me/id']['stats'] == {}
         assert revision['pipelines']['me/id']['error_log'] == ['error']
         assert revision['pipelines']['me/id']['title'] == 'Creating Package'
+        outbox_dispatcher(full_registry).dispatch()
 
     time.sleep(5)
     res = requests.get('http://localhost:9200/datahub/_search')
@@ -664,6 +1160,7 @@ def test_update_success(full_registry):
     assert revision['pipelines']['me/id:non-tabular']['title'] == 'Copying source data'
 
     # Test exported to Elasticsearch
+    outbox_dispatcher(full_registry).dispatch()
     time.sleep(5)
     res = requests.get('http://localhost:9200/datahub/_search')
     assert res.status_code == 200
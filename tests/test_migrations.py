@@ -0,0 +1,136 @@
+import datetime
+import re
+
+import pytest
+from sqlalchemy import create_engine, event, inspect
+
+from flowmanager.migrations import MIGRATIONS, current_version, upgrade
+from flowmanager.models import Base, FlowRegistry
+
+now = datetime.datetime.now()
+
+REGISTRY_INDEXES = {
+    'dataset': ['ix_dataset_owner_identifier'],
+    'dataset_revision': ['ix_dataset_revision_dataset_id_revision',
+                         'ix_dataset_revision_dataset_id_status_revision'],
+    'pipelines': ['ix_pipelines_flow_id_status'],
+}
+
+FULL_SCAN = re.compile(r'SCAN (TABLE )?(dataset|dataset_revision|pipelines|pipeline_status|owner_counter|pipeline_dependency|outbox)\b')
+
+
+def index_names(engine, table):
+    return {index['name'] for index in inspect(engine).get_indexes(table)}
+
+
+def test_fresh_database_is_at_latest_version():
+    registry = FlowRegistry('sqlite://')
+    with registry.engine.connect() as conn:
+        assert current_version(conn) == MIGRATIONS[-1][0]
+
+
+def test_upgrade_adds_indexes_to_existing_tables():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    for indexes in REGISTRY_INDEXES.values():
+        for index in indexes:
+            engine.execute('DROP INDEX %s' % index)
+
+    upgrade(engine, Base.metadata)
+    for table, indexes in REGISTRY_INDEXES.items():
+        assert set(indexes) <= index_names(engine, table)
+    with engine.connect() as conn:
+        assert current_version(conn) == MIGRATIONS[-1][0]
+
+    # Applying again is a no-op
+    upgrade(engine, Base.metadata)
+
+
+def test_upgrade_seeds_owner_counters():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    for identifier, owner in (('me/a', 'me'), ('me/b', 'me'), ('you/a', 'you')):
+        engine.execute("INSERT INTO dataset (identifier, owner) VALUES ('%s', '%s')" % (identifier, owner))
+
+    upgrade(engine, Base.metadata)
+    assert dict(engine.execute('SELECT owner, datasets FROM owner_counter').fetchall()) == \
+        dict(me=2, you=1)
+
+
+def test_upgrade_indexes_pipeline_dependencies():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    for pipeline_id, flow_id, details in (
+            ('me/id:csv', 'me/id/1', '{"dependencies": []}'),
+            ('me/id', 'me/id/1', '{"dependencies": [{"pipeline": "./me/id:csv"}]}'),
+            ('me/other', 'me/other/1', None)):
+        engine.execute('INSERT INTO pipelines (pipeline_id, flow_id, pipeline_details) VALUES (?, ?, ?)',
+                       (pipeline_id, flow_id, details))
+
+    upgrade(engine, Base.metadata)
+    assert engine.execute('SELECT pipeline_id, dependency_id, flow_id FROM pipeline_dependency').fetchall() == \
+        [('me/id', 'me/id:csv', 'me/id/1')]
+
+
+@pytest.fixture
+def explained_registry():
+    r = FlowRegistry('sqlite://')
+    for i in range(3):
+        r.save_dataset(dict(identifier='me/id%d' % i, owner='me', spec={}, created_at=now, updated_at=now))
+        r.create_revision('me/id%d' % i, now, 'success', [])
+        r.save_pipeline(dict(pipeline_id='me/id%d:csv' % i, flow_id='me/id%d/1' % i, status='pending'))
+        r.save_pipeline(dict(pipeline_id='me/id%d' % i, flow_id='me/id%d/1' % i, status='pending',
+                             pipeline_details={'dependencies': [{'pipeline': './me/id%d:csv' % i}]}))
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters[0] if executemany else parameters))
+
+    event.listen(r.engine, 'before_cursor_execute', capture)
+    yield r, statements
+    event.remove(r.engine, 'before_cursor_execute', capture)
+
+
+@pytest.mark.parametrize('query', [
+    lambda r: r.get_dataset('me/id1'),
+    lambda r: r.num_datasets_for_owner('me'),
+    lambda r: r.num_datasets_and_exists('me', 'me/id1'),
+    lambda r: r.delete_dataset('me/id2'),
+    lambda r: list(r.get_expired_datasets(now)),
+    lambda r: r.get_revision('me/id1'),
+    lambda r: r.get_revision('me/id1', 'successful'),
+    lambda r: r.get_revision('me/id1', 1),
+    lambda r: r.get_revision_by_revision_id('me/id1/1'),
+    lambda r: r.get_datasets(['me/id1', 'me/id2']),
+    lambda r: r.page_datasets('me', after='me/id0', limit=1),
+    lambda r: r.page_revisions('me/id1', after=2, limit=1),
+    lambda r: r.page_revisions('me/id1', after=2, limit=1, status='success'),
+    lambda r: r.get_revisions([('me/id1', 'latest'), ('me/id2', 'successful'), ('me/id0', 1)]),
+    lambda r: r.get_pipeline('me/id1:csv'),
+    lambda r: list(r.list_pipelines_by_id('me/id1/1')),
+    lambda r: list(r.list_pipelines_by_flow_and_status('me/id1/1')),
+    lambda r: r.check_flow_status('me/id1/1'),
+    lambda r: r.update_pipeline('me/id1:csv', dict(status='running')),
+    lambda r: r.delete_pipelines('me/id1/1'),
+    lambda r: r.fail_dependants('me/id1/1', 'me/id1:csv', '{}', now),
+    lambda r: r.save_pipeline_statuses('me/id1/1', [dict(pipeline_id='me/id1', status='FAILED')]),
+    lambda r: r.get_pipeline_statuses('me/id1/1'),
+    lambda r: r.claim_outbox(now, 10, now),
+    lambda r: r.retry_outbox(1, 1, now, 'error'),
+    lambda r: r.delete_outbox([1, 2]),
+])
+def test_registry_queries_use_indexes(explained_registry, query):
+    registry, statements = explained_registry
+    query(registry)
+    assert statements
+    conn = registry.engine.raw_connection()
+    try:
+        for statement, parameters in statements:
+            if not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'WITH')):
+                continue
+            plan = conn.execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+            for row in plan:
+                detail = row[-1]
+                assert not FULL_SCAN.match(detail), '%s\n-> %s' % (statement, detail)
+    finally:
+        conn.close()
@@ -1,11 +1,16 @@
 import datetime
 import json
 import os
+import resource
+import tempfile
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
 
-from flowmanager.models import FlowRegistry, get_descriptor, get_s3_client
+from flowmanager.models import FlowRegistry, Dataset, PipelineDependency, get_descriptor, get_s3_client, spec_hash, Outbox
 
 registry = FlowRegistry('sqlite://')
 
@@ -27,7 +32,9 @@ class ModelsTestCase(unittest.TestCase):
             updated_at=now,
             created_at=now,
             scheduled_for=None,
-            certified=False
+            certified=False,
+            spec_hash=None,
+            version=1
         )
         registry.save_dataset(response)
         ret = registry.get_dataset('non-existing')
@@ -43,17 +50,60 @@ class ModelsTestCase(unittest.TestCase):
             updated_at=now,
             created_at=now,
             scheduled_for=None,
-            certified=False
+            certified=False,
+            spec_hash=None,
+            version=1
         )
         registry.save_dataset(response)
         registry.create_or_update_dataset('2', 'datahub', spec, now)
         ret = registry.get_dataset('2')
+        response['version'] = 2
+        response['spec_hash'] = spec_hash(spec)
         self.assertEqual(response, ret)
 
         registry.create_or_update_dataset('3', 'datahub', spec, now)
         ret = registry.get_dataset('3')
         self.assertEqual(ret['identifier'], '3')
 
+    def test_create_or_update_dataset_keeps_created_at(self):
+        later = now + datetime.timedelta(hours=1)
+        registry.create_or_update_dataset('upsert', 'datahub', spec, now)
+        registry.update_dataset('upsert', dict(scheduled_for=later, certified=True))
+        with registry.transaction():
+            self.assertEqual(registry.get_dataset('upsert')['updated_at'], now)
+            ret = registry.create_or_update_dataset('upsert', 'datahub', {'meta': {}}, later)
+            self.assertEqual(registry.get_dataset('upsert'), ret)
+        self.assertEqual(ret['created_at'], now)
+        self.assertEqual(ret['updated_at'], later)
+        self.assertEqual(ret['scheduled_for'], later)
+        self.assertEqual(ret['spec'], {'meta': {}})
+        self.assertTrue(ret['certified'])
+
+    def test_spec_hash(self):
+        first = {'meta': {'dataset': 'id', 'owner': 'me', 'update_time': '2020-01-01'}, 'inputs': [1, 2]}
+        second = {'inputs': [1, 2], 'meta': {'create_time': '2019-01-01', 'owner': 'me', 'dataset': 'id'}}
+        self.assertEqual(spec_hash(first), spec_hash(second))
+        self.assertNotEqual(spec_hash(first), spec_hash(dict(first, inputs=[2, 1])))
+
+        registry.create_or_update_dataset('datahub/hashed', 'datahub', first, now)
+        self.assertEqual(registry.get_dataset('datahub/hashed', fields=['spec_hash'])['spec_hash'],
+                         spec_hash(first))
+        revision = registry.create_revision('datahub/hashed', now, 'pending', [], spec_hash=spec_hash(first))
+        self.assertEqual(registry.get_revision_by_revision_id(revision['revision_id'])['spec_hash'],
+                         spec_hash(first))
+
+    def test_owner_counters(self):
+        self.assertEqual(registry.num_datasets_and_exists('counted', 'counted/a'), (0, False))
+        registry.save_dataset(dict(identifier='counted/a', owner='counted', spec=spec))
+        registry.create_or_update_dataset('counted/b', 'counted', spec, now)
+        registry.create_or_update_dataset('counted/b', 'counted', spec, now)
+        self.assertEqual(registry.num_datasets_for_owner('counted'), 2)
+        self.assertEqual(registry.num_datasets_and_exists('counted', 'counted/a'), (2, True))
+        self.assertTrue(registry.delete_dataset('counted/a'))
+        self.assertFalse(registry.delete_dataset('counted/a'))
+        self.assertIsNone(registry.get_dataset('counted/a'))
+        self.assertEqual(registry.num_datasets_and_exists('counted', 'counted/a'), (1, False))
+
     def test_save_and_get_revision(self):
         response = dict(
             revision_id='datahub/id/100',
@@ -65,7 +115,9 @@ class ModelsTestCase(unittest.TestCase):
             pipelines=None,
             errors=['some not useful errors'],
             logs=['a','log','line'],
-            stats={'rows':1000}
+            stats={'rows':1000},
+            spec_hash=None,
+            version=1
         )
         registry.save_dataset_revision(response)
         ret = registry.get_revision('non-existing')
@@ -89,6 +141,23 @@ class ModelsTestCase(unittest.TestCase):
         ret = registry.get_revision('datahub/revision')
         self.assertEqual(ret['revision'], 2)
 
+    def test_create_revision_continues_from_saved_revisions(self):
+        registry.save_dataset_revision(dict(
+            revision_id='datahub/saved/7', dataset_id='datahub/saved', revision=7))
+        ret = registry.create_revision('datahub/saved', now, 'pending', [])
+        self.assertEqual(ret['revision'], 8)
+        self.assertEqual(ret['revision_id'], 'datahub/saved/8')
+
+    def test_create_revision_concurrently(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            concurrent = FlowRegistry('sqlite:///%s/registry.sqlite?timeout=60' % tmpdir)
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                revisions = list(executor.map(
+                    lambda _: concurrent.create_revision('datahub/concurrent', now, 'pending', [])['revision'],
+                    range(300)))
+            self.assertEqual(sorted(revisions), list(range(1, 301)))
+            self.assertEqual(concurrent.get_revision('datahub/concurrent')['revision'], 300)
+
     def test_update_revision(self):
         registry.create_revision('datahub/update', now, 'success', [])
         ret = registry.get_revision_by_revision_id('datahub/update/1')
@@ -111,7 +180,8 @@ class ModelsTestCase(unittest.TestCase):
             logs = [],
             stats = {},
             updated_at = now,
-            created_at = now
+            created_at = now,
+            version = 1
         )
         registry.save_pipeline(response)
         ret = registry.get_pipeline('non-existing')
@@ -119,6 +189,27 @@ class ModelsTestCase(unittest.TestCase):
         ret = registry.get_pipeline('datahub/dataset')
         self.assertEqual(response, ret)
 
+    def test_save_pipelines(self):
+        docs = [
+            dict(
+                pipeline_id='datahub/bulk:%d' % i,
+                flow_id='datahub/bulk/1',
+                title='Pipeline %d' % i,
+                pipeline_details={'dependencies': []},
+                status='pending',
+                errors=[],
+                logs=[],
+                stats={},
+                updated_at=now,
+                created_at=now
+            )
+            for i in range(5)
+        ]
+        registry.save_pipelines(docs)
+        pipelines = list(registry.list_pipelines_by_id('datahub/bulk/1'))
+        self.assertEqual(len(pipelines), 5)
+        self.assertEqual(registry.get_pipeline('datahub/bulk:3'), dict(docs[3], version=1))
+
     def test_update_pipeline(self):
         response = dict(
             pipeline_id = 'datahub/pipelines',
@@ -130,7 +221,8 @@ class ModelsTestCase(unittest.TestCase):
             logs = [],
             stats = {},
             updated_at = now,
-            created_at = now
+            created_at = now,
+            version = 1
         )
         ret = registry.get_pipeline('datahub/pipelines')
         self.assertIsNone(ret)
@@ -142,6 +234,253 @@ class ModelsTestCase(unittest.TestCase):
         ret = registry.get_pipeline('datahub/pipelines')
         self.assertEqual('success', ret['status'])
 
+    def test_check_flow_status(self):
+        cases = [
+            ([], 'success'),
+            (['pending', 'pending'], 'pending'),
+            (['pending', 'running'], 'running'),
+            (['pending', 'success'], 'running'),
+            (['pending', 'failed'], 'running'),
+            (['success', 'running'], 'running'),
+            (['success', 'failed'], 'failed'),
+            (['success', 'success'], 'success'),
+        ]
+        for i, (statuses, expected) in enumerate(cases):
+            flow_id = 'datahub/status/%d' % i
+            for j, status in enumerate(statuses):
+                registry.save_pipeline(dict(
+                    pipeline_id='%s:%d' % (flow_id, j),
+                    flow_id=flow_id,
+                    status=status))
+            self.assertEqual(registry.check_flow_status(flow_id), expected)
+
+    def test_transaction_rolls_back_all_changes(self):
+        with self.assertRaises(ValueError):
+            with registry.transaction():
+                registry.create_revision('datahub/transaction', now, 'pending', [])
+                registry.save_pipeline(dict(
+                    pipeline_id='datahub/transaction:csv',
+                    flow_id='datahub/transaction/1',
+                    status='pending'))
+                self.assertIsNotNone(registry.get_pipeline('datahub/transaction:csv'))
+                raise ValueError()
+        self.assertIsNone(registry.get_revision('datahub/transaction'))
+        self.assertIsNone(registry.get_pipeline('datahub/transaction:csv'))
+
+    def test_create_or_update_pipeline(self):
+        registry.create_or_update_pipeline('datahub/upsert', flow_id='datahub/upsert/1', status='pending')
+        registry.create_or_update_pipeline('datahub/upsert', status='running')
+        ret = registry.get_pipeline('datahub/upsert')
+        self.assertEqual(ret['flow_id'], 'datahub/upsert/1')
+        self.assertEqual(ret['status'], 'running')
+
+    def test_upsert_is_one_statement_that_raises_constraint_violations(self):
+        statements = []
+
+        def capture(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(registry.engine, 'before_cursor_execute', capture)
+        with registry.session_scope() as session:
+            row, inserted = FlowRegistry.upsert(session, Outbox, dict(id=1000, kind='first'), ['kind'])
+            self.assertEqual((row['kind'], inserted), ('first', None))
+            row, _ = FlowRegistry.upsert(session, Outbox, dict(id=1000, kind='second'), ['kind'])
+            self.assertEqual(row['kind'], 'second')
+        event.remove(registry.engine, 'before_cursor_execute', capture)
+        self.assertEqual(len([statement for statement in statements
+                              if 'ON CONFLICT (id) DO UPDATE SET kind = excluded.kind' in statement]), 2)
+        with self.assertRaises(IntegrityError):
+            with registry.session_scope() as session:
+                FlowRegistry.upsert(session, Outbox, dict(id=1001, kind=None), ['kind'])
+
+    def test_list_datasets_streams_in_batches(self):
+        streaming = FlowRegistry('sqlite://')
+        for i in range(25):
+            streaming.save_dataset(dict(identifier='me/%02d' % i, owner='me', spec=spec,
+                                        scheduled_for=now - datetime.timedelta(minutes=i % 3)))
+        ids = [ds.identifier for ds in streaming.list_datasets(batch_size=4)]
+        self.assertEqual(ids, ['me/%02d' % i for i in range(25)])
+        expired = list(streaming.get_expired_datasets(now, batch_size=4))
+        self.assertEqual(len(expired), 25)
+        self.assertEqual(len({ds.identifier for ds in expired}), 25)
+        self.assertEqual(expired[0].spec, spec)
+
+    def test_list_datasets_memory_is_flat(self):
+        streaming = FlowRegistry('sqlite://')
+        total = 500000
+        with streaming.engine.begin() as conn:
+            for start in range(0, total, 50000):
+                conn.execute(Dataset.__table__.insert(), [
+                    dict(identifier='me/%07d' % i, owner='me', spec=spec, created_at=now, updated_at=now)
+                    for i in range(start, start + 50000)])
+        count = 0
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        for _ in streaming.list_datasets(batch_size=5000):
+            count += 1
+        growth_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+        self.assertEqual(count, total)
+        # Materializing 500k mapped rows takes hundreds of MB
+        self.assertLess(growth_kb, 32 * 1024)
+
+    def test_get_with_fields(self):
+        registry.save_dataset(dict(identifier='datahub/fields', owner='datahub', spec=spec))
+        registry.create_revision('datahub/fields', now, 'pending', ['error'])
+        registry.save_pipeline(dict(pipeline_id='datahub/fields:csv', flow_id='datahub/fields/1',
+                                    pipeline_details={'dependencies': []}, title='CSV'))
+        self.assertEqual(registry.get_dataset('datahub/fields', fields=['owner']),
+                         dict(identifier='datahub/fields', owner='datahub', version=1))
+        self.assertEqual(registry.get_revision('datahub/fields', fields=['status']),
+                         dict(revision_id='datahub/fields/1', status='pending', version=1))
+        self.assertEqual(registry.get_revision_by_revision_id('datahub/fields/1', fields=['errors']),
+                         dict(revision_id='datahub/fields/1', errors=['error'], version=1))
+        self.assertEqual(registry.get_pipeline('datahub/fields:csv', fields=['flow_id', 'title']),
+                         dict(pipeline_id='datahub/fields:csv', flow_id='datahub/fields/1', title='CSV',
+                              version=1))
+        self.assertEqual(registry.get_flow_id('datahub/fields:csv'), 'datahub/fields/1')
+        self.assertEqual(registry.get_dataset('datahub/fields')['spec'], spec)
+
+    def test_update_pipeline_status(self):
+        registry.save_dataset_revision(dict(
+            revision_id='datahub/statuses/1', dataset_id='datahub/statuses', revision=1,
+            pipelines={'datahub/statuses:legacy': dict(title='Legacy', status='SUCCEEDED',
+                                                       stats={}, error_log=[])}))
+        registry.update_pipeline_status('datahub/statuses/1', 'datahub/statuses:csv', dict(
+            title='CSV', status='INPROGRESS', stats={}, error_log=[], updated_at=now))
+        registry.update_pipeline_status('datahub/statuses/1', 'datahub/statuses:csv', dict(
+            title='CSV', status='FAILED', stats={'rows': 1}, error_log=['error'], updated_at=now))
+        self.assertEqual(registry.get_pipeline_statuses('datahub/statuses/1'), {
+            'datahub/statuses:csv': dict(title='CSV', status='FAILED', stats={'rows': 1}, error_log=['error'])
+        })
+        ret = registry.get_revision_by_revision_id('datahub/statuses/1')
+        self.assertEqual(ret['pipelines'], {
+            'datahub/statuses:legacy': dict(title='Legacy', status='SUCCEEDED', stats={}, error_log=[]),
+            'datahub/statuses:csv': dict(title='CSV', status='FAILED', stats={'rows': 1}, error_log=['error'])
+        })
+        ret = registry.get_revision('datahub/statuses', fields=['status'])
+        self.assertNotIn('pipelines', ret)
+
+
+    def test_fail_dependants(self):
+        # csv <- zip <- package, csv <- package, json <- preview, and a finished report
+        dependencies = {
+            'csv': [], 'json': [], 'zip': ['csv'], 'preview': ['json'],
+            'package': ['csv', 'zip'], 'report': ['zip'],
+        }
+        registry.save_pipelines([
+            dict(pipeline_id='datahub/deps:%s' % name, flow_id='datahub/deps/1', title=name,
+                 status='success' if name == 'report' else 'pending',
+                 pipeline_details={'dependencies': [{'pipeline': './datahub/deps:%s' % dependency}
+                                                    for dependency in names]})
+            for name, names in dependencies.items()
+        ])
+        self.assertEqual(registry.fail_dependants('datahub/deps/1', 'datahub/deps:json', '{}', now), [
+            dict(pipeline_id='datahub/deps:preview', title='preview', errors=['datahub/deps:json'])
+        ])
+        self.assertEqual(registry.fail_dependants('datahub/deps/1', 'datahub/deps:csv', '{}', now), [
+            dict(pipeline_id='datahub/deps:package', title='package', errors=['datahub/deps:csv']),
+            dict(pipeline_id='datahub/deps:zip', title='zip', errors=['datahub/deps:csv']),
+        ])
+        statuses = {pipeline.pipeline_id.split(':')[1]: (pipeline.status, pipeline.errors)
+                    for pipeline in registry.list_pipelines_by_id('datahub/deps/1')}
+        self.assertEqual(statuses, {
+            'csv': ('pending', None),
+            'json': ('pending', None),
+            'zip': ('failed', ['datahub/deps:csv']),
+            'preview': ('failed', ['datahub/deps:json']),
+            'package': ('failed', ['datahub/deps:csv']),
+            'report': ('success', None),
+        })
+        self.assertEqual(registry.get_pipeline('datahub/deps:zip', fields=['status'])['version'], 2)
+        self.assertEqual(registry.fail_dependants('datahub/deps/1', 'datahub/deps:csv', '{}', now), [])
+
+        registry.delete_pipelines('datahub/deps/1')
+        with registry.session_scope() as session:
+            self.assertEqual(session.query(PipelineDependency).filter_by(flow_id='datahub/deps/1').count(), 0)
+
+    def test_page_datasets(self):
+        for i in range(5):
+            registry.save_dataset(dict(identifier='paged/%d' % i, owner='paged', spec=spec))
+        registry.save_dataset(dict(identifier='paged-other/0', owner='paged-other', spec=spec))
+        pages = []
+        cursor = None
+        while True:
+            page, cursor = registry.page_datasets('paged', after=cursor, limit=2)
+            pages.append([dataset['identifier'] for dataset in page])
+            self.assertNotIn('spec', page[0])
+            if cursor is None:
+                break
+        self.assertEqual(pages, [['paged/0', 'paged/1'], ['paged/2', 'paged/3'], ['paged/4']])
+        page, _ = registry.page_datasets('paged', limit=1, fields=['spec'])
+        self.assertEqual(page[0]['spec'], spec)
+
+    def test_page_revisions(self):
+        for i in range(5):
+            registry.create_revision('datahub/paged', now, 'success' if i % 2 else 'failed', [])
+        page, cursor = registry.page_revisions('datahub/paged', limit=2)
+        self.assertEqual([revision['revision'] for revision in page], [5, 4])
+        page, cursor = registry.page_revisions('datahub/paged', after=cursor, limit=2)
+        self.assertEqual([revision['revision'] for revision in page], [3, 2])
+        page, cursor = registry.page_revisions('datahub/paged', after=cursor, limit=2)
+        self.assertEqual([revision['revision'] for revision in page], [1])
+        self.assertIsNone(cursor)
+        page, cursor = registry.page_revisions('datahub/paged', status='success', limit=1)
+        self.assertEqual([revision['revision'] for revision in page], [4])
+        page, cursor = registry.page_revisions('datahub/paged', status='success', after=cursor)
+        self.assertEqual([revision['revision'] for revision in page], [2])
+        self.assertIsNone(cursor)
+
+    def test_page_pipeline_statuses(self):
+        for i in range(5):
+            registry.update_pipeline_status('datahub/pages/1', 'datahub/pages:%d' % i, dict(
+                title='P%d' % i, status='FAILED' if i % 2 else 'SUCCEEDED', stats={}, error_log=[]))
+        page, cursor = registry.page_pipeline_statuses('datahub/pages/1', fields=['title'], limit=2)
+        self.assertEqual(page, {'datahub/pages:0': dict(title='P0'), 'datahub/pages:1': dict(title='P1')})
+        self.assertEqual(cursor, 'datahub/pages:1')
+        page, cursor = registry.page_pipeline_statuses('datahub/pages/1', fields=['title'],
+                                                       after=cursor, limit=2, status='SUCCEEDED')
+        self.assertEqual(page, {'datahub/pages:2': dict(title='P2'), 'datahub/pages:4': dict(title='P4')})
+        self.assertIsNone(cursor)
+        page, cursor = registry.page_pipeline_statuses('datahub/pages/1', fields=['title'],
+                                                       after='datahub/pages:1', limit=0)
+        self.assertEqual((page, cursor), ({}, 'datahub/pages:1'))
+
+    def test_page_pipeline_statuses_of_legacy_revisions(self):
+        registry.save_dataset_revision(dict(
+            revision_id='datahub/legacy/1', dataset_id='datahub/legacy', revision=1,
+            pipelines={'datahub/legacy:%d' % i: dict(title='P%d' % i, status='SUCCEEDED',
+                                                    stats={}, error_log=[])
+                       for i in range(3)}))
+        registry.update_pipeline_status('datahub/legacy/1', 'datahub/legacy:1', dict(
+            title='P1', status='FAILED', stats={}, error_log=['error']))
+        page, cursor = registry.page_pipeline_statuses(
+            'datahub/legacy/1', fields=['status'], status='SUCCEEDED', limit=1)
+        self.assertEqual(page, {'datahub/legacy:0': dict(status='SUCCEEDED')})
+        self.assertEqual(cursor, 'datahub/legacy:0')
+        page, cursor = registry.page_pipeline_statuses(
+            'datahub/legacy/1', fields=['status'], status='SUCCEEDED', after=cursor, limit=1)
+        self.assertEqual(page, {'datahub/legacy:2': dict(status='SUCCEEDED')})
+        self.assertIsNone(cursor)
+
+    def test_run_in_transaction_retries_stale_updates(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            concurrent = FlowRegistry('sqlite:///%s/registry.sqlite?timeout=60' % tmpdir)
+            concurrent.create_revision('datahub/stale', now, 'pending', [])
+            attempts = []
+
+            def update():
+                attempts.append(concurrent.get_revision_by_revision_id(
+                    'datahub/stale/1', fields=['stats']))
+                if len(attempts) == 1:
+                    with ThreadPoolExecutor(max_workers=1) as executor:
+                        executor.submit(concurrent.update_revision, 'datahub/stale/1',
+                                        dict(stats={'other': 1})).result()
+                stats = dict(attempts[-1]['stats'] or {}, mine=1)
+                return concurrent.update_revision('datahub/stale/1', dict(stats=stats))
+
+            ret = concurrent.run_in_transaction(update)
+            self.assertEqual(len(attempts), 2)
+            self.assertEqual(ret['stats'], {'other': 1, 'mine': 1})
+            self.assertEqual(ret['version'], 3)
 
 class S3ModelsTestCase(unittest.TestCase):
     @classmethod
@@ -0,0 +1,88 @@
+import datetime
+
+from flowmanager.models import FlowRegistry
+from flowmanager.outbox import OutboxDispatcher
+
+start = datetime.datetime(2020, 1, 1)
+
+
+class Clock:
+    def __init__(self):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += datetime.timedelta(seconds=seconds)
+
+
+def make_dispatcher(handlers, **kwargs):
+    registry = FlowRegistry('sqlite://')
+    clock = Clock()
+    return registry, clock, OutboxDispatcher(registry, handlers, clock=clock, **kwargs)
+
+
+def test_delivers_in_batches_and_deletes_delivered_entries():
+    delivered = []
+    registry, clock, dispatcher = make_dispatcher(dict(log=delivered.append), batch_size=2)
+    with registry.transaction():
+        for i in range(3):
+            registry.add_outbox('log', dict(i=i), start)
+    assert dispatcher.dispatch() == 2
+    assert dispatcher.dispatch() == 1
+    assert dispatcher.dispatch() == 0
+    assert delivered == [dict(i=0), dict(i=1), dict(i=2)]
+    assert dispatcher.stats() == dict(delivered=3, retried=0, dead=0, running=False)
+
+
+def test_retries_failed_entries_with_backoff():
+    attempts = []
+
+    def flaky(payload):
+        attempts.append(clock.now)
+        if len(attempts) < 3:
+            raise RuntimeError('unavailable')
+
+    registry, clock, dispatcher = make_dispatcher(dict(flaky=flaky), backoff=1.0)
+    registry.add_outbox('flaky', {}, start)
+    assert dispatcher.dispatch() == 1
+    assert dispatcher.dispatch() == 0
+    clock.advance(1)
+    assert dispatcher.dispatch() == 1
+    clock.advance(1)
+    assert dispatcher.dispatch() == 0
+    clock.advance(1)
+    assert dispatcher.dispatch() == 1
+    clock.advance(60)
+    assert dispatcher.dispatch() == 0
+    assert [(attempt - start).seconds for attempt in attempts] == [0, 1, 3]
+    assert dispatcher.stats()['retried'] == 2
+
+
+def test_gives_up_after_max_attempts():
+    def failing(payload):
+        raise RuntimeError('broken')
+
+    registry, clock, dispatcher = make_dispatcher(dict(failing=failing), max_attempts=2, backoff=1.0)
+    registry.add_outbox('failing', {}, start)
+    registry.add_outbox('unknown', {}, start)
+    assert dispatcher.dispatch() == 2
+    clock.advance(1)
+    assert dispatcher.dispatch() == 2
+    clock.advance(3600)
+    assert dispatcher.dispatch() == 0
+    assert dispatcher.stats()['dead'] == 2
+
+
+def test_claimed_entries_are_leased():
+    registry, clock, dispatcher = make_dispatcher({}, lease=60)
+    registry.add_outbox('log', {}, start)
+    # A dispatcher that died after claiming the entry
+    assert len(registry.claim_outbox(start, 10, start + datetime.timedelta(seconds=60))) == 1
+    assert registry.claim_outbox(start, 10, start) == []
+    delivered = []
+    dispatcher.handlers['log'] = delivered.append
+    clock.advance(60)
+    assert dispatcher.dispatch() == 1
+    assert delivered == [{}]